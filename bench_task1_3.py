@@ -0,0 +1,340 @@
+"""
+This script benchmarks the access log analyzer from task1_3.py.
+
+Synthetic logs of increasing size are built by repeating the lines of a
+sample log, and each one is analyzed in a fresh process so that the peak
+resident memory (RSS) reported belongs to that run alone. With --parsers,
+the line parsers are compared on the sample lines instead.
+
+With --generate, a reproducible Combined Log Format log is generated from
+a seed instead, with a chosen number of lines and distinct User-Agents, a
+share of malformed lines and optional compression, and every analysis
+mode is measured on it in lines and megabytes per second and peak RSS.
+
+Usage:
+    python bench_task1_3.py [--sample <access_log_file>] [--repeats N ...]
+    python bench_task1_3.py --parsers [--sample <access_log_file>]
+    python bench_task1_3.py --generate [--lines N] [--agents N] [--malformed RATIO]
+                            [--compression {none,gzip,bz2,xz}] [--modes MODE ...]
+"""
+
+import os
+import bz2
+import sys
+import gzip
+import lzma
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import log_formats
+import log_sketches
+import log_reports
+import log_columns
+import log_analysis
+import log_checkpoint
+
+
+def build_log(sample_path, repeats, output_path):
+    """
+    Writes a log made of the sample log repeated a number of times.
+
+    Args:
+        sample_path (str): The path to the sample log file.
+        repeats (int): How many times the sample is repeated.
+        output_path (str): The path of the file to create.
+
+    Returns:
+        int: The size of the created file in bytes.
+    """
+    with open(sample_path, 'rb') as sample_file:
+        sample = sample_file.read()
+    with open(output_path, 'wb') as output_file:
+        for _ in range(repeats):
+            output_file.write(sample)
+    return os.path.getsize(output_path)
+
+
+# Compressed file openers of the generated logs
+GENERATED_OPENERS = {
+    'none': open,
+    'gzip': gzip.open,
+    'bz2': bz2.open,
+    'xz': lzma.open,
+}
+
+# Parts of the generated log lines
+METHODS = ('GET', 'GET', 'GET', 'GET', 'POST', 'HEAD')
+PATHS = ('/', '/index.html', '/login', '/api/items', '/static/app.js', '/images/logo.png')
+STATUSES = ('200', '200', '200', '200', '301', '304', '404', '500')
+BROWSERS = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/{major}.0.{build}.{patch} Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:{major}.0) Gecko/20100101 Firefox/{major}.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 '
+    '(KHTML, like Gecko) Version/{major}.1 Safari/605.1.15',
+    'Mozilla/5.0 (compatible; Crawler{build}/{major}.{patch}; +http://example.com/bot)',
+)
+
+
+def make_agents(count, rng):
+    """
+    Returns distinct synthetic User-Agents.
+
+    Args:
+        count (int): The number of User-Agents.
+        rng (random.Random): The random generator.
+
+    Returns:
+        list: The User-Agents.
+    """
+    agents = set()
+    while len(agents) < count:
+        agents.add(rng.choice(BROWSERS).format(
+            major=rng.randint(40, 120), build=rng.randint(1000, 5000), patch=rng.randint(0, 200)))
+    return sorted(agents)
+
+
+def generate_log(output_path, lines, agents=100, malformed=0.0, compression='none', seed=0):
+    """
+    Writes a reproducible synthetic Combined Log Format log.
+
+    User-Agents follow a Zipf-like distribution, as in real traffic, and
+    dates increase by about a second per line.
+
+    Args:
+        output_path (str): The path of the file to create.
+        lines (int): The number of lines.
+        agents (int): The number of distinct User-Agents.
+        malformed (float): The share of malformed lines, between 0 and 1.
+        compression (str): One of GENERATED_OPENERS.
+        seed (int): The seed of the random generator.
+
+    Returns:
+        int: The size of the log in bytes, before compression.
+    """
+    rng = random.Random(seed)
+    agent_pool = make_agents(agents, rng)
+    weights = [1 / rank for rank in range(1, agents + 1)]
+    moment = 1563951065
+    size = 0
+    with GENERATED_OPENERS[compression](output_path, 'wb') as output_file:
+        for start in range(0, lines, 10000):
+            batch = []
+            chosen = rng.choices(agent_pool, weights, k=min(10000, lines - start))
+            for agent in chosen:
+                moment += rng.randint(0, 2)
+                date = time.strftime('%d/%b/%Y:%H:%M:%S +0000', time.gmtime(moment))
+                line = (f'{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.'
+                        f'{rng.randint(1, 254)} - - [{date}] '
+                        f'"{rng.choice(METHODS)} {rng.choice(PATHS)} HTTP/1.1" '
+                        f'{rng.choice(STATUSES)} {rng.randint(100, 50000)} "-" "{agent}"')
+                if malformed and rng.random() < malformed:
+                    line = line[:rng.randint(10, len(line) - 1)]
+                batch.append(line)
+            data = ('\n'.join(batch) + '\n').encode()
+            output_file.write(data)
+            size += len(data)
+    return size
+
+
+def run_mode(mode, file_path):
+    """
+    Analyzes a log in one of the benchmarked modes.
+
+    Args:
+        mode (str): One of MODES.
+        file_path (str): The path to the log file.
+
+    Returns:
+        int: The number of requests counted.
+    """
+    if mode == 'parse':
+        return sum(log_checkpoint.parse_access_log(file_path).values())
+    if mode == 'columns':
+        return len(log_analysis.load_log_columns([file_path], jobs=1))
+    specs = MODES[mode]
+    jobs = None if mode == 'parallel' else 1
+    malformed = log_reports.MalformedLines(lenient=mode == 'lenient')
+    reports = log_analysis.analyze_access_logs([file_path], specs, jobs, malformed=malformed)
+    report = reports[0]
+    if isinstance(report, log_reports.ApproximateReport):
+        return report.requests
+    return sum(report.counts.values())
+
+
+# Benchmarked modes and the report specs they build, if any
+MODES = {
+    'parse': None,
+    'grouped': ((('user_agent',), ('bytes', 'ips')), (('status', 'hour'), ())),
+    'classified': ((('browser',), ()), (('os',), ()), (('agent_type',), ())),
+    'approximate': ((('user_agent',), (), (log_sketches.TOP_ERROR, log_sketches.DISTINCT_ERROR)),),
+    'lenient': ((('user_agent',), ()),),
+    'parallel': ((('user_agent',), ()),),
+    'columns': None,
+    'exported': ((('browser',), ()), (('os',), ()), (('agent_type',), ())),
+}
+
+
+def measure(file_path, mode='parse'):
+    """
+    Runs a benchmarked mode on a file and prints its timing and peak RSS.
+
+    Args:
+        file_path (str): The path to the log file.
+        mode (str): One of MODES.
+    """
+    start = time.perf_counter()
+    lines = run_mode(mode, file_path)
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{elapsed:.6f} {peak_kb} {lines}")
+
+
+def measure_in_process(file_path, mode='parse'):
+    """
+    Measures a mode in a fresh process, so that its peak RSS is its own.
+
+    Args:
+        file_path (str): The path to the log file.
+        mode (str): One of MODES.
+
+    Returns:
+        tuple: The elapsed seconds, the peak RSS in KiB and the number of
+        requests counted.
+    """
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--measure', file_path, '--mode', mode],
+        check=True, capture_output=True, encoding='utf-8',
+    ).stdout.split()
+    return float(output[0]), int(output[1]), int(output[2])
+
+
+def run_benchmark(sample_path, repeats_list):
+    """
+    Measures parse_access_log on logs of growing size, one process each.
+
+    Args:
+        sample_path (str): The path to the sample log file.
+        repeats_list (list): The repeat counts of the logs to measure.
+    """
+    print(f"{'size MB':>10} {'lines':>12} {'seconds':>10} {'MB/s':>10} {'peak RSS MB':>12}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        log_path = os.path.join(temp_dir, 'access.log')
+        for repeats in repeats_list:
+            size = build_log(sample_path, repeats, log_path)
+            elapsed, peak_kb, lines = measure_in_process(log_path)
+            size_mb = size / (1024 ** 2)
+            print(f"{size_mb:>10.1f} {lines:>12} {elapsed:>10.3f} "
+                  f"{size_mb / elapsed:>10.1f} {peak_kb / 1024:>12.1f}")
+
+
+def run_generated_benchmark(lines, agents, malformed, compression, modes, seed=0):
+    """
+    Generates a synthetic log and measures every mode on it.
+
+    Throughput is computed from the generated lines, malformed ones
+    included, and from the size of the log before compression. The
+    exported mode reads a column file exported from the log beforehand.
+
+    Args:
+        lines (int): The number of lines of the log.
+        agents (int): The number of distinct User-Agents.
+        malformed (float): The share of malformed lines.
+        compression (str): One of GENERATED_OPENERS.
+        modes (list): The names of the modes to measure, among MODES.
+        seed (int): The seed of the generator.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        log_path = os.path.join(temp_dir, 'access.log')
+        size = generate_log(log_path, lines, agents, malformed, compression, seed)
+        size_mb = size / (1024 ** 2)
+        print(f"{lines} lines, {size_mb:.1f} MB, {agents} agents, "
+              f"{malformed:.1%} malformed, compression: {compression}")
+        print(f"{'mode':>12} {'seconds':>10} {'lines/s':>12} {'MB/s':>10} "
+              f"{'peak RSS MB':>12} {'requests':>10}")
+        for mode in modes:
+            if mode == 'columns' and log_columns.np is None:
+                print(f"{mode:>12} skipped: NumPy is not installed")
+                continue
+            file_path = log_path
+            if mode == 'exported':
+                file_path = os.path.join(temp_dir, 'access.cols')
+                log_analysis.export_log_columns([log_path], file_path)
+            elapsed, peak_kb, requests = measure_in_process(file_path, mode)
+            print(f"{mode:>12} {elapsed:>10.3f} {lines / elapsed:>12,.0f} "
+                  f"{size_mb / elapsed:>10.1f} {peak_kb / 1024:>12.1f} {requests:>10}")
+
+
+def compare_parsers(sample_path, rounds=20):
+    """
+    Prints the lines per second of the regexes and of the fast parser.
+
+    The text regex decodes every line first, as the analyzer used to.
+
+    Args:
+        sample_path (str): The path to the sample log file.
+        rounds (int): How many times the sample lines are parsed.
+    """
+    with open(sample_path, 'rb') as sample_file:
+        lines = sample_file.read().splitlines() * rounds
+
+    def text_regex_parser(line):
+        match = log_formats.log_pattern.match(line.decode('utf-8', errors='replace'))
+        return match.group('user_agent') if match else None
+
+    def regex_parser(line):
+        match = log_formats.log_pattern_bytes.match(line)
+        return match.group('user_agent') if match else None
+
+    results = {}
+    for name, parse in (('text regex', text_regex_parser), ('regex', regex_parser),
+                        ('fast path', log_formats.parse_log_line)):
+        start = time.perf_counter()
+        for line in lines:
+            parse(line)
+        results[name] = len(lines) / (time.perf_counter() - start)
+        print(f"{name:>10}: {results[name]:>12,.0f} lines/s")
+    print(f"{'speedup':>10}: {results['fast path'] / results['text regex']:>12.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Access log analyzer benchmark")
+    parser.add_argument("--sample", default="access.log.5",
+                        help="Sample log whose lines are repeated")
+    parser.add_argument("--repeats", type=int, nargs="+", default=[1, 16, 64, 256],
+                        help="Sample repeat counts of the generated logs")
+    parser.add_argument("--parsers", action="store_true",
+                        help="Compare the regex and the fast line parser")
+    parser.add_argument("--generate", action="store_true",
+                        help="Measure every mode on a generated synthetic log")
+    parser.add_argument("--lines", type=int, default=500000,
+                        help="Number of lines of the generated log")
+    parser.add_argument("--agents", type=int, default=1000,
+                        help="Number of distinct User-Agents of the generated log")
+    parser.add_argument("--malformed", type=float, default=0.001,
+                        help="Share of malformed lines of the generated log")
+    parser.add_argument("--compression", choices=GENERATED_OPENERS, default="none",
+                        help="Compression of the generated log")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES),
+                        help="Modes measured on the generated log")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the generated log")
+    parser.add_argument("--measure", metavar="FILE", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", choices=MODES, default="parse", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, args.mode)
+    elif args.generate:
+        if not 0 <= args.malformed < 1:
+            parser.error("--malformed must be between 0 and 1")
+        run_generated_benchmark(args.lines, args.agents, args.malformed, args.compression,
+                                args.modes, args.seed)
+    elif args.parsers:
+        compare_parsers(args.sample)
+    else:
+        run_benchmark(args.sample, args.repeats)
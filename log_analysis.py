@@ -0,0 +1,571 @@
+"""
+Parallel analysis of log files: planning the tasks of files and byte
+ranges, parsing them in worker processes, caching the results of
+unchanged files and merging the partial reports.
+"""
+
+import io
+import os
+import sys
+import glob
+import mmap
+import gzip
+import pickle
+import hashlib
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+from log_formats import compile_log_format, in_time_range
+from log_files import (
+    CHUNK_SIZE, READ_BLOCK_SIZE, FileRange, detect_compression, exit_on_read_error, file_identity,
+    find_time_range, index_time_range, iter_log_lines, iter_mapped_lines, open_log, split_log_file,
+    update_time_index,
+)
+from log_dimensions import ip_table_identity
+from log_reports import MALFORMED_SAMPLES, MalformedLines, make_report, normalize_specs
+from log_columns import (
+    ROW_GROUP_SIZE, ColumnFileWriter, LogColumns, aggregate_column_file, is_column_file,
+    plan_column_tasks, require_numpy,
+)
+
+# Version of the format of cached results, part of every cache key
+CACHE_VERSION = 8
+
+
+def aggregate_lines(lines, reports, time_range=None, log_format=None):
+    """
+    Parses log lines and adds them to every report.
+
+    Lines that cannot be parsed are given to the MalformedLines object
+    among the reports, if any, and skipped otherwise; well-formed lines
+    never reach it.
+
+    Args:
+        lines (iterable): The undecoded log lines.
+        reports (list): The LogReport objects to update, optionally with
+            a MalformedLines object.
+        time_range (tuple): The (since, until) timestamps of the lines to
+            add, as accepted by in_time_range, or None to add all lines.
+        log_format (str): The format of the lines, as accepted by
+            compile_log_format.
+
+    Returns:
+        list: The updated reports.
+    """
+    parse_line = compile_log_format(log_format)
+    malformed = None
+    adders = []
+    for report in reports:
+        if isinstance(report, MalformedLines):
+            malformed = report
+        else:
+            adders.append(report.add)
+    for line in lines:
+        fields = parse_line(line)
+        if not fields:
+            if malformed is None:
+                continue
+            fields = malformed.add(line)
+            if fields is None:
+                continue
+        if time_range is None or in_time_range(fields, time_range):
+            for add in adders:
+                add(fields)
+    return reports
+
+
+def aggregate_log_file(file_path, reports, time_range=None, log_format=None):
+    """
+    Adds all lines of a log file to the given reports.
+
+    Args:
+        file_path (str): The path to the log file.
+        reports (list): The LogReport objects to update.
+        time_range (tuple): The (since, until) timestamps of the lines to
+            add, or None to add all lines.
+        log_format (str): The format of the lines, as accepted by
+            compile_log_format.
+
+    Returns:
+        list: The updated reports.
+    """
+    with exit_on_read_error(file_path):
+        with open_log(file_path) as stream:
+            return aggregate_lines(iter_log_lines(stream), reports, time_range, log_format)
+
+
+def aggregate_log_range(file_path, start, end, reports, time_range=None, log_format=None):
+    """
+    Adds the lines of a byte range of a plain log file to the reports.
+
+    The file is memory-mapped, so worker processes parsing different
+    ranges of the same file share its pages instead of copying them.
+
+    Args:
+        file_path (str): The path to the log file.
+        start (int): The offset of the first line of the range.
+        end (int): The offset just after the last line of the range.
+        reports (list): The LogReport objects to update.
+        time_range (tuple): The (since, until) timestamps of the lines to
+            add, or None to add all lines.
+        log_format (str): The format of the lines, as accepted by
+            compile_log_format.
+
+    Returns:
+        list: The updated reports.
+    """
+    if start >= end:
+        return reports
+    with exit_on_read_error(file_path):
+        with open(file_path, 'rb') as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return aggregate_lines(iter_mapped_lines(mapped, start, end), reports,
+                                   time_range, log_format)
+
+
+def aggregate_gzip_range(file_path, start, end, reports, time_range=None, log_format=None):
+    """
+    Adds the lines of a range of whole members of a gzip log to the reports.
+
+    Args:
+        file_path (str): The path to the gzip log file.
+        start (int): The offset of the first member of the range.
+        end (int): The offset just after the last member of the range.
+        reports (list): The LogReport objects to update.
+        time_range (tuple): The (since, until) timestamps of the lines to
+            add, or None to add all lines.
+        log_format (str): The format of the lines, as accepted by
+            compile_log_format.
+
+    Returns:
+        list: The updated reports.
+    """
+    if start >= end:
+        return reports
+    with exit_on_read_error(file_path):
+        with open(file_path, 'rb') as file:
+            members = io.BufferedReader(FileRange(file, start, end), READ_BLOCK_SIZE)
+            with gzip.GzipFile(fileobj=members) as stream:
+                return aggregate_lines(iter_log_lines(stream), reports, time_range, log_format)
+
+
+def plan_indexed_tasks(file_path, index, chunk_size, time_range):
+    """
+    Splits the analysis of an indexed log file into tasks.
+
+    Args:
+        file_path (str): The path to the log file.
+        index (dict): The time index of the log.
+        chunk_size (int): The approximate size of each range in bytes.
+        time_range (tuple): The (since, until) timestamps of the lines to
+            analyze, or None to analyze all lines.
+
+    Returns:
+        list: (file_path, start, end) tasks. Ranges of gzip logs start and
+        end on member boundaries.
+    """
+    size = os.path.getsize(file_path)
+    start, end = (0, size) if time_range is None else index_time_range(index, time_range, size)
+    if not index['gzip']:
+        return [(file_path, range_start, range_end) for range_start, range_end
+                in split_log_file(file_path, chunk_size, start, end)]
+    boundaries = [start]
+    for offset in index['offsets']:
+        if start < offset < end and offset - boundaries[-1] >= chunk_size:
+            boundaries.append(offset)
+    boundaries.append(end)
+    if boundaries == [0, size]:
+        return [(file_path, None, None)]
+    return [(file_path, range_start, range_end)
+            for range_start, range_end in zip(boundaries, boundaries[1:])]
+
+
+def plan_log_tasks(file_paths, chunk_size=CHUNK_SIZE, time_range=None, sorted_logs=True,
+                   time_index=False, log_format=None):
+    """
+    Splits the analysis of several log files into independent tasks.
+
+    Plain files larger than the chunk size are split into byte ranges;
+    compressed files cannot be entered mid-stream and are parsed whole,
+    except gzip files made of several members when they are indexed.
+    Files that are not regular, such as pipes, are read whole without
+    being sniffed first, which would consume their data.
+
+    With a time range, only the byte range of plain files, or the gzip
+    members of indexed files, holding its lines is planned.
+
+    Args:
+        file_paths (list): The paths to the log files.
+        chunk_size (int): The approximate size of each range in bytes.
+        time_range (tuple): The (since, until) timestamps of the lines to
+            analyze, or None to analyze all lines.
+        sorted_logs (bool): Whether plain logs are sorted by time, so that
+            a time range can be found by binary search.
+        time_index (bool): Whether to build, update and use the sidecar
+            time indexes of plain and gzip logs.
+        log_format (str): The format of the logs, as accepted by
+            compile_log_format.
+
+    Returns:
+        list: (file_path, start, end) tuples, where start and end are None
+        for files parsed whole.
+    """
+    tasks = []
+    for file_path in file_paths:
+        if not os.path.isfile(file_path):
+            # Pipes and devices can only be read once, from the start
+            tasks.append((file_path, None, None))
+            continue
+        try:
+            if is_column_file(file_path):
+                with exit_on_read_error(file_path):
+                    try:
+                        tasks.extend(plan_column_tasks(file_path, chunk_size, time_range))
+                    except ValueError as error:
+                        print(f"Error: {error}")
+                        sys.exit(1)
+                continue
+            opener = detect_compression(file_path)
+            index = update_time_index(file_path, opener) if time_index else None
+            if index is not None and (index['gzip'] or time_range is not None):
+                tasks.extend(plan_indexed_tasks(file_path, index, chunk_size,
+                                                time_range if sorted_logs else None))
+                continue
+            plain = opener is None
+            splittable = plain and os.path.getsize(file_path) > chunk_size
+            if plain and time_range is not None and sorted_logs:
+                start, end = find_time_range(file_path, time_range, log_format)
+                tasks.extend((file_path, range_start, range_end) for range_start, range_end
+                             in split_log_file(file_path, chunk_size, start, end))
+                continue
+        except OSError:
+            splittable = False
+        if splittable:
+            tasks.extend((file_path, start, end)
+                         for start, end in split_log_file(file_path, chunk_size))
+        else:
+            tasks.append((file_path, None, None))
+    return tasks
+
+
+def aggregate_task(task, reports, time_range=None, log_format=None):
+    """
+    Adds the lines of a task created by plan_log_tasks to the reports.
+
+    Args:
+        task (tuple): The (file_path, start, end) task.
+        reports (list): The objects to update, e.g. LogReport objects.
+        time_range (tuple): The (since, until) timestamps of the lines to
+            add, or None to add all lines.
+        log_format (str): The format of the lines, as accepted by
+            compile_log_format.
+
+    Returns:
+        list: The updated reports.
+    """
+    file_path, start, end = task
+    with exit_on_read_error(file_path):
+        if is_column_file(file_path):
+            return aggregate_column_file(file_path, reports, time_range, start, end)
+    if start is None:
+        return aggregate_log_file(file_path, reports, time_range, log_format)
+    with exit_on_read_error(file_path):
+        compressed = detect_compression(file_path) is not None
+    if compressed:
+        return aggregate_gzip_range(file_path, start, end, reports, time_range, log_format)
+    return aggregate_log_range(file_path, start, end, reports, time_range, log_format)
+
+
+def cache_entry_path(cache_dir, task, identity, variant):
+    """
+    Returns the path of the cache entry of a task.
+
+    Entry names start with a hash of the log path followed by a hash of
+    the file identity, so the entries of older versions of a log can be
+    found and removed.
+
+    Args:
+        cache_dir (str): The cache directory.
+        task (tuple): The (file_path, start, end) task.
+        identity (tuple): The identity of the log file.
+        variant (tuple): What was computed, e.g. the report specs.
+
+    Returns:
+        str: The path of the cache entry.
+    """
+    file_path, start, end = task
+    hashes = [
+        hashlib.sha1(repr(value).encode()).hexdigest()[:16]
+        for value in (os.path.abspath(file_path), (CACHE_VERSION, identity),
+                      (start, end, variant))
+    ]
+    return os.path.join(cache_dir, '-'.join(hashes) + '.pickle')
+
+
+def is_private_path(path):
+    """
+    Checks that a file or directory belongs to the current user and that
+    no one else can write to it.
+
+    Args:
+        path (str): The path to check.
+
+    Returns:
+        bool: Whether the path is private, False if it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    getuid = getattr(os, 'getuid', None)
+    return (getuid is None or stat.st_uid == getuid()) and not stat.st_mode & 0o022
+
+
+def store_cache_entry(entry_path, result):
+    """
+    Writes a cache entry atomically and removes the entries of older
+    versions of the same log file. Failures only mean a cache miss later,
+    so they are ignored.
+
+    Args:
+        entry_path (str): The path of the cache entry.
+        result: The picklable result to store.
+    """
+    cache_dir, entry_name = os.path.split(entry_path)
+    path_hash, identity_hash, _ = entry_name.split('-')
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        temp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb', opener=lambda path, flags: os.open(path, flags, 0o600)) as file:
+            pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, entry_path)
+        for stale_path in glob.glob(os.path.join(cache_dir, f"{path_hash}-*.pickle")):
+            if not os.path.basename(stale_path).startswith(f"{path_hash}-{identity_hash}-"):
+                os.remove(stale_path)
+    except OSError:
+        pass
+
+
+def cached_result(task, variant, cache_dir, compute):
+    """
+    Returns the cached result of a task, computing and storing it if the
+    log file changed since it was cached.
+
+    Entries are pickled, and loading a pickle can run arbitrary code, so
+    they are only trusted in a cache directory of the current user that
+    no one else can write to: other directories are not used at all.
+
+    Args:
+        task (tuple): The (file_path, start, end) task.
+        variant (tuple): What is computed, e.g. the report specs.
+        cache_dir (str): The cache directory, or None to disable caching.
+        compute (callable): Computes the result when it is not cached.
+
+    Returns:
+        The result of the task.
+    """
+    if cache_dir is None or os.path.exists(cache_dir) and not is_private_path(cache_dir):
+        return compute()
+    try:
+        identity = file_identity(task[0])
+    except OSError:
+        return compute()
+    entry_path = cache_entry_path(cache_dir, task, identity, variant)
+    if is_private_path(entry_path):
+        try:
+            with open(entry_path, 'rb') as file:
+                return pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+    result = compute()
+    if file_identity(task[0]) == identity:
+        store_cache_entry(entry_path, result)
+    return result
+
+
+def run_log_task(task, specs, cache_dir=None, time_range=None, lenient=False,
+                 log_format=None, max_samples=MALFORMED_SAMPLES, ip_table=None):
+    """
+    Builds the reports of a task created by plan_log_tasks.
+
+    Args:
+        task (tuple): The (file_path, start, end) task.
+        specs (tuple): The report specs, as accepted by make_report.
+        cache_dir (str): The directory caching the reports of unchanged
+            files, or None to disable caching.
+        time_range (tuple): The (since, until) timestamps of the lines to
+            add, or None to add all lines.
+        lenient (bool): Whether malformed lines are parsed leniently.
+        log_format (str): The format of the lines, as accepted by
+            compile_log_format.
+        max_samples (int): The number of malformed lines kept as samples.
+        ip_table (str): The table the asn and country dimensions are looked
+            up in, as accepted by ip_table_identity.
+
+    Returns:
+        list: The LogReport objects of the task, keyed by bytes, followed
+        by the MalformedLines of the task.
+    """
+    variant = ('reports', specs, time_range, lenient, log_format, max_samples,
+               ip_table_identity(ip_table))
+    reports = [make_report(spec, ip_table) for spec in specs]
+    return cached_result(task, variant, cache_dir, lambda: aggregate_task(
+        task, reports + [MalformedLines(lenient, max_samples)], time_range, log_format))
+
+
+def load_columns_task(task, cache_dir=None):
+    """
+    Loads the lines of a task created by plan_log_tasks into columns.
+
+    Args:
+        task (tuple): The (file_path, start, end) task.
+        cache_dir (str): The directory caching the columns of unchanged
+            files, or None to disable caching.
+
+    Returns:
+        LogColumns: The columns of the task.
+    """
+    return cached_result(task, ('columns',), cache_dir,
+                         lambda: aggregate_task(task, [LogColumns()])[0])
+
+
+def map_log_tasks(function, tasks, jobs=None, args=()):
+    """
+    Applies a function to every task, in worker processes if useful.
+
+    Args:
+        function (callable): A module-level function taking a task and
+            the extra arguments.
+        tasks (list): The tasks created by plan_log_tasks.
+        jobs (int): The maximum number of worker processes. Defaults to
+            the number of CPUs.
+        args (tuple): Extra arguments passed to every call.
+
+    Yields:
+        The results of the calls, in task order.
+    """
+    jobs = min(jobs or os.cpu_count() or 1, len(tasks))
+    if jobs <= 1:
+        for task in tasks:
+            yield function(task, *args)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(function, tasks, *([arg] * len(tasks) for arg in args))
+
+
+def analyze_access_logs(file_paths, specs=((('user_agent',), ()),), jobs=None,
+                        chunk_size=CHUNK_SIZE, cache_dir=None, time_range=None,
+                        sorted_logs=True, time_index=False, malformed=None,
+                        log_format=None, ip_table=None):
+    """
+    Builds reports over several log files in a single pass.
+
+    Each file, or each byte range of a large plain file, is parsed by a
+    separate worker process and the partial reports are merged as the
+    workers finish.
+
+    Args:
+        file_paths (list): The paths to the log files.
+        specs (list): The report specs, as accepted by make_report. Defaults
+            to a single report counting the requests of each User-Agent.
+        jobs (int): The maximum number of worker processes. Defaults to
+            the number of CPUs.
+        chunk_size (int): The approximate size in bytes of the ranges
+            large plain files are split into.
+        cache_dir (str): The directory caching the reports of unchanged
+            files, or None to disable caching.
+        time_range (tuple): The (since, until) timestamps of the requests
+            to count, since included and until excluded, either of them
+            None if unbounded, or None to count all requests.
+        sorted_logs (bool): Whether plain logs are sorted by time, so that
+            the lines of the time range can be found by binary search.
+        time_index (bool): Whether to build, update and use the sidecar
+            time indexes of plain and gzip logs.
+        malformed (MalformedLines): Updated with the lines that could not
+            be parsed, and whose lenient flag enables lenient parsing and
+            max_samples sets the number of samples kept, or None to skip
+            those lines silently.
+        log_format (str): The format of the logs, as accepted by
+            compile_log_format. Defaults to the Combined Log Format.
+        ip_table (str): The table the asn and country dimensions are looked
+            up in, as accepted by ip_table_identity.
+
+    Returns:
+        list: The merged LogReport objects, keyed by strings.
+    """
+    specs = normalize_specs(specs)
+    tasks = plan_log_tasks(file_paths, chunk_size, time_range, sorted_logs, time_index,
+                           log_format)
+    reports = [make_report(spec) for spec in specs]
+    lenient = malformed is not None and malformed.lenient
+    max_samples = MALFORMED_SAMPLES if malformed is None else malformed.max_samples
+    total_malformed = MalformedLines(lenient, max_samples)
+    for partial_reports in map_log_tasks(
+            run_log_task, tasks, jobs,
+            (specs, cache_dir, time_range, lenient, log_format, max_samples, ip_table)):
+        for report, partial in zip(reports + [total_malformed], partial_reports):
+            report.update(partial)
+    if malformed is not None:
+        malformed.update(total_malformed.decode())
+    return [report.decode() for report in reports]
+
+
+def load_log_columns(file_paths, jobs=None, chunk_size=CHUNK_SIZE, cache_dir=None):
+    """
+    Loads log files into columns for vectorized analytics.
+
+    Files and byte ranges are parsed in parallel like analyze_access_logs
+    does, and the partial columns are concatenated.
+
+    Args:
+        file_paths (list): The paths to the log files.
+        jobs (int): The maximum number of worker processes. Defaults to
+            the number of CPUs.
+        chunk_size (int): The approximate size in bytes of the ranges
+            large plain files are split into.
+        cache_dir (str): The directory caching the columns of unchanged
+            files, or None to disable caching.
+
+    Returns:
+        LogColumns: The parsed lines of all files.
+
+    Raises:
+        ImportError: If NumPy is not installed.
+    """
+    require_numpy()
+    columns = LogColumns()
+    tasks = plan_log_tasks(file_paths, chunk_size)
+    for partial in map_log_tasks(load_columns_task, tasks, jobs, (cache_dir,)):
+        columns.update(partial)
+    return columns
+
+
+def export_log_columns(file_paths, output_path, log_format=None,
+                       row_group_size=ROW_GROUP_SIZE):
+    """
+    Parses log files into a column file, streaming row group by row group.
+
+    The file is written under a temporary name and renamed when complete.
+
+    Args:
+        file_paths (list): The paths to the log files.
+        output_path (str): The path to the column file.
+        log_format (str): The format of the logs, as accepted by
+            compile_log_format.
+        row_group_size (int): The number of rows of each row group.
+
+    Returns:
+        int: The number of rows written.
+    """
+    temp_path = f"{output_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'wb') as file:
+            writer = ColumnFileWriter(file, row_group_size)
+            for file_path in file_paths:
+                aggregate_log_file(file_path, [writer], log_format=log_format)
+            writer.flush()
+        os.replace(temp_path, output_path)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+    return writer.rows
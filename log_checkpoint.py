@@ -0,0 +1,313 @@
+"""
+Incremental analysis: the states of logs recording what was already
+read, checkpoint files holding them with their reports, and reading only
+the lines appended since.
+"""
+
+import os
+import json
+import zlib
+import struct
+import hashlib
+
+from log_files import (
+    FINGERPRINT_SIZE, READ_BLOCK_SIZE, detect_compression, exit_on_read_error, file_identity,
+    open_log, read_log_head,
+)
+from log_reports import (
+    LogReport, MalformedLines, ReportDecoder, ReportEncoder, make_report, normalize_specs,
+)
+from log_analysis import aggregate_lines, aggregate_log_file
+
+# Leading bytes and format version of checkpoint files
+CHECKPOINT_MAGIC = b'LOGCHECKPOINT'
+CHECKPOINT_VERSION = 2
+
+
+def find_log_state(states, identity, head):
+    """
+    Finds the checkpointed state of a log file, following renames.
+
+    A state matches when its fingerprint, the hash of the leading bytes
+    read so far, matches the same bytes of the file. That recognizes a
+    live log rotated to access.log.1, or compressed to access.log.2.gz,
+    while a truncated or recreated log starts over. States of the same
+    inode are tried first.
+
+    Args:
+        states (list): The log states saved in the checkpoint.
+        identity (tuple): The current identity of the file.
+        head (bytes): The leading bytes of the file.
+
+    Returns:
+        dict: The matching state, or None for a new log.
+    """
+    for state in sorted(states, key=lambda state: state['identity'][:2] != identity[:2]):
+        size = state['fingerprint_size']
+        if (size and len(head) >= size
+                and hashlib.sha1(head[:size]).hexdigest() == state['fingerprint']):
+            return state
+    return None
+
+
+def aggregate_appended_lines(file_path, offset, reports, log_format=None):
+    """
+    Adds the complete lines of a log file after an offset to the reports.
+
+    A last line without its newline is still being written: it is left
+    for the next run.
+
+    Args:
+        file_path (str): The path to the log file.
+        offset (int): The offset of the first line to read, counted in
+            decompressed bytes.
+        reports (list): The LogReport objects to update, optionally with
+            a MalformedLines object.
+        log_format (str): The format of the lines, as accepted by
+            compile_log_format.
+
+    Returns:
+        int: The offset just after the last line read.
+    """
+    with open_log(file_path, threaded=False) as stream:
+        stream.seek(offset)
+        remainder = b''
+        block = stream.read(READ_BLOCK_SIZE)
+        while block:
+            data = remainder + block
+            end = data.rfind(b'\n') + 1
+            aggregate_lines(data[:end].split(b'\n')[:-1], reports, log_format=log_format)
+            offset += end
+            remainder = data[end:]
+            block = stream.read(READ_BLOCK_SIZE)
+    return offset
+
+
+def dump_log_states(states):
+    """
+    Encodes log states as JSON.
+
+    Args:
+        states (list): The states, as returned by update_log_states.
+
+    Returns:
+        str: The JSON text.
+    """
+    return json.dumps(states)
+
+
+def load_log_states(text):
+    """
+    Decodes log states encoded by dump_log_states.
+
+    Args:
+        text (str or bytes): The JSON text.
+
+    Returns:
+        list: The states, as dicts with their 'identity' tuple, 'offset',
+        'fingerprint_size' and 'fingerprint'.
+
+    Raises:
+        ValueError: If the text does not hold log states.
+    """
+    try:
+        return [{
+            'identity': tuple(int(value) for value in state['identity']),
+            'offset': int(state['offset']),
+            'fingerprint_size': int(state['fingerprint_size']),
+            'fingerprint': str(state['fingerprint']),
+        } for state in json.loads(text)]
+    except (TypeError, KeyError) as error:
+        raise ValueError(f"invalid log states: {error}") from error
+
+
+def load_checkpoint(checkpoint_path, specs):
+    """
+    Loads a checkpoint file, or creates an empty checkpoint.
+
+    Args:
+        checkpoint_path (str): The path to the checkpoint file.
+        specs (tuple): The report specs, as accepted by make_report.
+
+    Returns:
+        dict: The checkpoint, with the 'specs', the undecoded 'reports'
+        and the 'logs' states.
+
+    Raises:
+        ValueError: If the checkpoint is unreadable or was saved for other
+            reports.
+    """
+    try:
+        with open(checkpoint_path, 'rb') as file:
+            header = file.read(len(CHECKPOINT_MAGIC) + 1)
+            data = file.read()
+    except FileNotFoundError:
+        return {
+            'specs': specs,
+            'reports': [make_report(spec) for spec in specs],
+            'logs': [],
+        }
+    except OSError as error:
+        raise ValueError(f"Could not read checkpoint '{checkpoint_path}': {error}") from error
+    if header != CHECKPOINT_MAGIC + bytes([CHECKPOINT_VERSION]):
+        raise ValueError(f"'{checkpoint_path}' is not a checkpoint file of version "
+                         f"{CHECKPOINT_VERSION}.")
+    try:
+        decoder = ReportDecoder(zlib.decompress(data), decoded=False)
+        saved_specs = normalize_specs(json.loads(decoder.raw(decoder.integer())))
+        states = load_log_states(decoder.raw(decoder.integer()))
+        reports = [decoder.report() for _ in range(decoder.integer())]
+    except (zlib.error, IndexError, struct.error, TypeError, ValueError) as error:
+        raise ValueError(f"Checkpoint '{checkpoint_path}' is damaged: {error}") from error
+    if saved_specs != specs:
+        raise ValueError(f"Checkpoint '{checkpoint_path}' was saved for other reports.")
+    return {'specs': specs, 'reports': reports, 'logs': states}
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    """
+    Writes a checkpoint file atomically.
+
+    The specs and log states are written as JSON and the undecoded reports
+    in the format of report files, so that loading a checkpoint never runs
+    code it holds.
+
+    Args:
+        checkpoint_path (str): The path to the checkpoint file.
+        checkpoint (dict): The checkpoint, as returned by load_checkpoint.
+    """
+    encoder = ReportEncoder()
+    encoder.string(json.dumps(checkpoint['specs']))
+    encoder.string(dump_log_states(checkpoint['logs']))
+    encoder.integer(len(checkpoint['reports']))
+    for report in checkpoint['reports']:
+        encoder.report(report)
+    temp_path = f"{checkpoint_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(CHECKPOINT_MAGIC + bytes([CHECKPOINT_VERSION]))
+        file.write(zlib.compress(encoder.buffer, 6))
+    os.replace(temp_path, checkpoint_path)
+
+
+def update_log_states(file_paths, states, reports, log_format=None):
+    """
+    Adds the lines appended to log files since their saved states to the
+    reports.
+
+    Logs whose identity is unchanged are not opened at all; other logs are
+    recognized by their fingerprint and read from their offset, and logs
+    seen for the first time (including truncated ones) from the start.
+
+    Args:
+        file_paths (list): The paths to the log files.
+        states (list): The saved states of the logs, as dicts with their
+            'identity', the 'offset' after their last complete line and
+            the 'fingerprint' of their first 'fingerprint_size' bytes.
+        reports (list): The objects the lines are added to, optionally
+            with a MalformedLines object.
+        log_format (str): The format of the logs, as accepted by
+            compile_log_format.
+
+    Returns:
+        tuple: The new states of the logs, in the order of file_paths,
+        and the saved states that none of them matched.
+    """
+    new_states = []
+    unmatched = list(states)
+    for file_path in file_paths:
+        with exit_on_read_error(file_path):
+            identity = file_identity(file_path)
+            state = next((state for state in states
+                          if state['identity'] == identity), None)
+            if state is None:
+                state = find_log_state(states, identity, read_log_head(file_path))
+                if state is not None:
+                    unmatched = [other for other in unmatched if other is not state]
+                offset = state['offset'] if state else 0
+                if detect_compression(file_path) is None and identity[2] < offset:
+                    offset = 0
+                offset = aggregate_appended_lines(file_path, offset, reports, log_format)
+                fingerprint_size = min(offset, FINGERPRINT_SIZE)
+                state = {
+                    'identity': identity,
+                    'offset': offset,
+                    'fingerprint_size': fingerprint_size,
+                    'fingerprint': hashlib.sha1(
+                        read_log_head(file_path)[:fingerprint_size]).hexdigest(),
+                }
+            else:
+                unmatched = [other for other in unmatched if other is not state]
+        new_states.append(state)
+    return new_states, unmatched
+
+
+def analyze_appended_logs(file_paths, checkpoint_path, specs=((('user_agent',), ()),),
+                          log_format=None, malformed=None, ip_table=None):
+    """
+    Updates the reports saved in a checkpoint with the lines appended to
+    the log files since the checkpoint was saved.
+
+    For every log, the checkpoint records its identity, the offset after
+    its last complete line and a fingerprint of its first bytes, from
+    which update_log_states reads the appended lines.
+
+    Args:
+        file_paths (list): The paths to the log files.
+        checkpoint_path (str): The path to the checkpoint file.
+        specs (list): The report specs, as accepted by make_report.
+        log_format (str): The format of the logs, as accepted by
+            compile_log_format.
+        malformed (MalformedLines): Updated with the appended lines that
+            could not be parsed, as in analyze_access_logs, or None to
+            skip them silently.
+        ip_table (str): The table the asn and country dimensions are looked
+            up in, as accepted by ip_table_identity.
+
+    Returns:
+        list: The updated LogReport objects, keyed by strings.
+
+    Raises:
+        ValueError: If the checkpoint is unreadable or was saved for other
+            reports.
+    """
+    specs = normalize_specs(specs)
+    checkpoint = load_checkpoint(checkpoint_path, specs)
+    for report in checkpoint['reports']:
+        report.use_ip_table(ip_table)
+    appended_malformed = []
+    if malformed is not None:
+        appended_malformed.append(MalformedLines(malformed.lenient, malformed.max_samples))
+    states, unmatched = update_log_states(file_paths, checkpoint['logs'],
+                                          checkpoint['reports'] + appended_malformed,
+                                          log_format)
+    # Logs left out of this run keep their states, so that they are not
+    # counted again from the start when they come back
+    checkpoint['logs'] = states + unmatched
+    save_checkpoint(checkpoint_path, checkpoint)
+    if malformed is not None:
+        malformed.update(appended_malformed[0].decode())
+    return [report.decode() for report in checkpoint['reports']]
+
+
+def parse_access_log(file_path, checkpoint_path=None):
+    """
+    Parses an Apache access log file and counts User-Agent occurrences.
+
+    Counts are updated as each line is read, so memory use is bounded by
+    the number of distinct User-Agents rather than the number of lines.
+
+    Args:
+        file_path (str): The path to the log file.
+        checkpoint_path (str): A checkpoint file; if given, only the lines
+            appended since the previous call are parsed and the returned
+            counts include those saved in the checkpoint.
+
+    Returns:
+        Counter: A Counter object with User-Agent strings as keys and their
+        counts as values.
+    """
+    if checkpoint_path is not None:
+        report, = analyze_appended_logs([file_path], checkpoint_path)
+        return report.counts
+    report, = aggregate_log_file(file_path, [LogReport()])
+    return report.decode().counts
@@ -0,0 +1,718 @@
+"""
+Columnar storage of parsed log lines: in-memory LogColumns for NumPy
+analytics and column files of dictionary-encoded row groups, analyzed by
+counting codes instead of parsing lines.
+"""
+
+import os
+import zlib
+import array
+import struct
+import calendar
+import datetime
+import functools
+import itertools
+from operator import itemgetter
+from collections import Counter, defaultdict
+
+from log_formats import (
+    LOG_FIELDS, parse_log_time, request_method, request_path, request_protocol, request_size,
+    request_status_code, request_zone,
+)
+from log_files import CHUNK_SIZE, array_to_bytes, bytes_to_array, exit_on_read_error
+from log_dimensions import dimension_extractor, ip_table_identity
+from log_reports import LogReport, MalformedLines, decode_value
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Leading bytes and format version of column files, default number of
+# rows of their row groups, header of each row group (rows, time range,
+# sizes of its column directory and data) and the integer types of the
+# codes of categorical columns by largest dictionary size
+COLUMN_FILE_MAGIC = b'LOGCOLUMNS'
+COLUMN_FILE_VERSION = 2
+ROW_GROUP_SIZE = 131072
+ROW_GROUP_HEADER = struct.Struct('<IqqII')
+CODE_TYPES = (('B', 2 ** 8), ('H', 2 ** 16), ('I', 2 ** 32))
+
+# Timestamp stored in columns for dates that could not be parsed
+MISSING_TIME = -2 ** 63
+
+# Categorical columns of LogColumns and how to get their values
+CATEGORICAL_COLUMNS = {
+    'ip': itemgetter(0),
+    'identd': itemgetter(1),
+    'user': itemgetter(2),
+    'zone': request_zone,
+    'method': request_method,
+    'path': request_path,
+    'protocol': request_protocol,
+    'referer': itemgetter(7),
+    'user_agent': itemgetter(8),
+}
+
+# Dimensions counted from the codes of a single column of column files
+COLUMN_DIMENSIONS = {
+    'ip': 'ip', 'subnet': 'ip', 'subnet16': 'ip', 'asn': 'ip', 'country': 'ip',
+    'user': 'user',
+    'day': 'time', 'hour': 'time',
+    'method': 'method',
+    'path': 'path', 'endpoint': 'path', 'route': 'path',
+    'protocol': 'protocol',
+    'status': 'status', 'status_class': 'status',
+    'referer': 'referer',
+    'user_agent': 'user_agent', 'browser': 'user_agent',
+    'browser_family': 'user_agent', 'os': 'user_agent', 'agent_type': 'user_agent',
+}
+
+
+def require_numpy():
+    """Raises ImportError if NumPy, needed for columnar analytics, is missing."""
+    if np is None:
+        raise ImportError("NumPy is required for columnar log analytics.")
+
+
+class LogColumns:
+    """
+    Parsed log lines stored column by column.
+
+    Timestamps, status codes and sizes are kept in typed arrays, and string
+    fields as integer codes into a dictionary of their distinct values, so
+    millions of rows take a few bytes each. The analytics methods work on
+    NumPy views of the arrays and never loop over rows in Python.
+    """
+
+    def __init__(self):
+        self.time = array.array('q')
+        self.status = array.array('H')
+        self.size = array.array('q')
+        self.codes = {name: array.array('I') for name in CATEGORICAL_COLUMNS}
+        self.dictionaries = {name: {} for name in CATEGORICAL_COLUMNS}
+
+    def __len__(self):
+        return len(self.time)
+
+    def add(self, fields):
+        """
+        Appends a parsed log line to the columns.
+
+        Args:
+            fields (tuple): The values of LOG_FIELDS for the line.
+        """
+        timestamp = parse_log_time(fields[3])
+        self.time.append(MISSING_TIME if timestamp is None else timestamp)
+        self.status.append(request_status_code(fields) or 0)
+        self.size.append(request_size(fields) or 0)
+        for name, extract in CATEGORICAL_COLUMNS.items():
+            dictionary = self.dictionaries[name]
+            value = extract(fields)
+            code = dictionary.get(value)
+            if code is None:
+                code = dictionary[value] = len(dictionary)
+            self.codes[name].append(code)
+
+    def update(self, other):
+        """
+        Appends the rows of other columns, translating their codes.
+
+        Args:
+            other (LogColumns): The columns to append.
+        """
+        require_numpy()
+        self.time.extend(other.time)
+        self.status.extend(other.status)
+        self.size.extend(other.size)
+        for name, dictionary in self.dictionaries.items():
+            translation = np.empty(len(other.dictionaries[name]), dtype=np.uint32)
+            for value, code in other.dictionaries[name].items():
+                translation[code] = dictionary.setdefault(value, len(dictionary))
+            other_codes = np.frombuffer(other.codes[name], dtype=np.uint32)
+            self.codes[name].frombytes(translation[other_codes].tobytes())
+
+    def column(self, name):
+        """
+        Returns a column as a NumPy array, without copying it.
+
+        Args:
+            name (str): 'time', 'status', 'size' or a categorical column,
+                whose codes are returned.
+
+        Returns:
+            numpy.ndarray: The values or codes of the column.
+        """
+        require_numpy()
+        if name in self.codes:
+            return np.frombuffer(self.codes[name], dtype=np.uint32)
+        dtypes = {'time': np.int64, 'status': np.uint16, 'size': np.int64}
+        return np.frombuffer(getattr(self, name), dtype=dtypes[name])
+
+    def values(self, name):
+        """
+        Returns the decoded distinct values of a categorical column.
+
+        Args:
+            name (str): The name of the categorical column.
+
+        Returns:
+            list: The values, indexed by their codes.
+        """
+        return [decode_value(value) for value in self.dictionaries[name]]
+
+    def select(self, mask):
+        """
+        Returns the rows selected by a boolean mask or an index array.
+
+        Args:
+            mask (numpy.ndarray): The rows to keep, e.g.
+                columns.column('status') >= 400.
+
+        Returns:
+            LogColumns: The selected rows, sharing the dictionaries.
+        """
+        selected = LogColumns()
+        for name in ('time', 'status', 'size'):
+            getattr(selected, name).frombytes(self.column(name)[mask].tobytes())
+        for name in self.codes:
+            selected.codes[name].frombytes(self.column(name)[mask].tobytes())
+            selected.dictionaries[name] = self.dictionaries[name]
+        return selected
+
+    def count_by(self, name, weights=None):
+        """
+        Counts the rows, or sums a column, for each value of a column.
+
+        Args:
+            name (str): A categorical column, or 'status'.
+            weights (str): The column to sum, e.g. 'size', instead of
+                counting rows.
+
+        Returns:
+            Counter: The counts or sums keyed by the decoded values.
+        """
+        if weights is None:
+            totals = np.bincount(self.column(name))
+        else:
+            totals = np.bincount(self.column(name), weights=self.column(weights))
+            totals = totals.round().astype(np.int64)
+        keys = self.values(name) if name in self.codes else range(len(totals))
+        return Counter({key: total.item() for key, total in zip(keys, totals) if total})
+
+    def histogram(self, name, bins):
+        """
+        Counts the rows falling into each bin of a numeric column.
+
+        Args:
+            name (str): 'time', 'status' or 'size'.
+            bins (int or sequence): The number of bins or their edges.
+
+        Returns:
+            tuple: The counts and the bin edges, as numpy.histogram.
+        """
+        values = self.column(name)
+        if name == 'time':
+            values = values[values != MISSING_TIME]
+        return np.histogram(values, bins=bins)
+
+    def hourly_counts(self):
+        """
+        Counts the requests of each hour.
+
+        Returns:
+            Counter: The counts keyed by the timestamp starting each hour.
+        """
+        times = self.column('time')
+        hours, counts = np.unique(times[times != MISSING_TIME] // 3600,
+                                  return_counts=True)
+        return Counter(dict(zip((hours * 3600).tolist(), counts.tolist())))
+
+
+class ColumnFileWriter:
+    """
+    Writes parsed log lines to a column file in row groups.
+
+    Lines are added to LogColumns until a row group is full, then every
+    column of the group is compressed on its own: timestamps, statuses
+    and sizes as arrays, with flags marking the sizes that were missing,
+    and categorical columns, including the UTC offsets of the dates, as
+    their codes, in the narrowest integer type, and their dictionary of
+    distinct values. Each
+    group records its time range, so readers skip groups outside theirs,
+    and the offsets of its columns, so readers decompress only those they
+    need. Memory use is bounded by the size of a row group.
+    """
+
+    def __init__(self, file, row_group_size=ROW_GROUP_SIZE):
+        """
+        Args:
+            file (file): The binary file written to, at its start.
+            row_group_size (int): The number of rows of each row group.
+        """
+        self.file = file
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self._columns = LogColumns()
+        self._missing_sizes = array.array('B')
+        file.write(COLUMN_FILE_MAGIC + bytes([COLUMN_FILE_VERSION]))
+
+    def add(self, fields):
+        """
+        Adds a parsed log line to the current row group.
+
+        Args:
+            fields (tuple): The values of LOG_FIELDS for the line.
+        """
+        self._columns.add(fields)
+        self._missing_sizes.append(request_size(fields) is None)
+        if len(self._columns) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the current row group, if it has rows."""
+        columns = self._columns
+        if not len(columns):
+            return
+        times = columns.time
+        min_time, max_time = min(times), max(times)
+        if min_time == MISSING_TIME:
+            min_time = min((timestamp for timestamp in times if timestamp != MISSING_TIME),
+                           default=MISSING_TIME)
+        chunks = [(name, array_to_bytes(getattr(columns, name)))
+                  for name in ('time', 'status', 'size')]
+        chunks.append(('size.missing', array_to_bytes(self._missing_sizes)))
+        for name, dictionary in columns.dictionaries.items():
+            typecode = next(typecode for typecode, limit in CODE_TYPES
+                            if len(dictionary) <= limit)
+            codes = array.array(typecode, columns.codes[name])
+            chunks.append((name, typecode.encode() + array_to_bytes(codes)))
+            lengths = array.array('I', map(len, dictionary))
+            chunks.append((f"{name}.values", struct.pack('<I', len(lengths))
+                           + array_to_bytes(lengths) + b''.join(dictionary)))
+        chunks = [(name.encode(), zlib.compress(data)) for name, data in chunks]
+        directory = b''.join(struct.pack('<B', len(name)) + name + struct.pack('<I', len(data))
+                             for name, data in chunks)
+        self.file.write(ROW_GROUP_HEADER.pack(len(columns), min_time, max_time,
+                                              len(directory), sum(len(data) for _, data in chunks)))
+        self.file.write(directory)
+        for _, data in chunks:
+            self.file.write(data)
+        self.rows += len(columns)
+        self._columns = LogColumns()
+        self._missing_sizes = array.array('B')
+
+
+def is_column_file(file_path):
+    """Returns whether a file is a column file written by ColumnFileWriter."""
+    if not os.path.isfile(file_path):
+        return False
+    with open(file_path, 'rb') as file:
+        return file.read(len(COLUMN_FILE_MAGIC)) == COLUMN_FILE_MAGIC
+
+
+def read_row_group_header(file, offset):
+    """
+    Reads the header and column directory of a row group.
+
+    Args:
+        file (file): The column file, opened for binary reading.
+        offset (int): The offset of the row group.
+
+    Returns:
+        tuple: The number of rows, the time range of the group, the size
+        of the whole group in bytes and a dict mapping the name of each
+        column chunk to its (offset, size), or None at the end of the file.
+
+    Raises:
+        EOFError: If the group is truncated.
+        ValueError: If the sizes of the column chunks do not add up to the
+            size of the group's data.
+    """
+    file.seek(offset)
+    header = file.read(ROW_GROUP_HEADER.size)
+    if not header:
+        return None
+    if len(header) < ROW_GROUP_HEADER.size:
+        raise EOFError("Truncated row group.")
+    rows, min_time, max_time, directory_size, data_size = ROW_GROUP_HEADER.unpack(header)
+    directory = file.read(directory_size)
+    if len(directory) < directory_size:
+        raise EOFError("Truncated row group.")
+    chunks = {}
+    position = offset + ROW_GROUP_HEADER.size + directory_size
+    index = 0
+    while index < len(directory):
+        length = directory[index]
+        name = directory[index + 1:index + 1 + length].decode()
+        size, = struct.unpack_from('<I', directory, index + 1 + length)
+        chunks[name] = (position, size)
+        position += size
+        index += 5 + length
+    if position - offset != ROW_GROUP_HEADER.size + directory_size + data_size:
+        raise ValueError(f"Damaged row group at offset {offset}: its column chunks do not "
+                         f"add up to {data_size} bytes.")
+    return rows, min_time, max_time, position - offset, chunks
+
+
+def column_file_groups(file_path):
+    """
+    Lists the row groups of a column file.
+
+    Args:
+        file_path (str): The path to the column file.
+
+    Returns:
+        list: The (offset, size, min_time, max_time) of each row group.
+
+    Raises:
+        ValueError: If the file is not a column file of this version.
+        EOFError: If the file is truncated.
+    """
+    groups = []
+    with open(file_path, 'rb') as file:
+        header = file.read(len(COLUMN_FILE_MAGIC) + 1)
+        if header != COLUMN_FILE_MAGIC + bytes([COLUMN_FILE_VERSION]):
+            raise ValueError(f"'{file_path}' is not a column file of version "
+                             f"{COLUMN_FILE_VERSION}.")
+        offset = len(header)
+        group = read_row_group_header(file, offset)
+        while group is not None:
+            _, min_time, max_time, size, _ = group
+            groups.append((offset, size, min_time, max_time))
+            offset += size
+            group = read_row_group_header(file, offset)
+    return groups
+
+
+def group_in_time_range(min_time, max_time, time_range):
+    """Returns whether a row group may hold rows within a time range."""
+    since, until = time_range
+    return (since is None or max_time >= since) and (until is None or min_time < until)
+
+
+def plan_column_tasks(file_path, chunk_size=CHUNK_SIZE, time_range=None):
+    """
+    Splits a column file into tasks of consecutive row groups, leaving out
+    the groups outside a time range.
+
+    Args:
+        file_path (str): The path to the column file.
+        chunk_size (int): The approximate size of each task in bytes.
+        time_range (tuple): The (since, until) timestamps of the rows to
+            analyze, or None to analyze all rows.
+
+    Returns:
+        list: (file_path, start, end) tuples of byte ranges of row groups.
+
+    Raises:
+        ValueError: If the file is not a column file of this version.
+        EOFError: If the file is truncated.
+    """
+    tasks = []
+    for offset, size, min_time, max_time in column_file_groups(file_path):
+        if time_range is not None and not group_in_time_range(min_time, max_time, time_range):
+            continue
+        if tasks and tasks[-1][2] == offset and offset - tasks[-1][1] < chunk_size:
+            tasks[-1] = (file_path, tasks[-1][1], offset + size)
+        else:
+            tasks.append((file_path, offset, offset + size))
+    return tasks
+
+
+def read_row_group(file, chunks, names):
+    """
+    Decompresses columns of a row group.
+
+    Args:
+        file (file): The column file, opened for binary reading.
+        chunks (dict): The column directory of the group, as returned by
+            read_row_group_header.
+        names (iterable): The names of the columns to read.
+
+    Returns:
+        dict: The arrays of 'time', 'status', 'size' and 'size.missing',
+        and the (codes, values) of categorical columns.
+    """
+    def read_chunk(name):
+        offset, size = chunks[name]
+        file.seek(offset)
+        return zlib.decompress(file.read(size))
+
+    columns = {}
+    for name in names:
+        if name in CATEGORICAL_COLUMNS:
+            data = read_chunk(name)
+            codes = bytes_to_array(data[:1].decode(), data[1:])
+            data = read_chunk(f"{name}.values")
+            count, = struct.unpack_from('<I', data)
+            lengths = bytes_to_array('I', data[4:4 + count * 4])
+            values = []
+            position = 4 + count * 4
+            for length in lengths:
+                values.append(data[position:position + length])
+                position += length
+            columns[name] = (codes, values)
+        else:
+            typecode = {'time': 'q', 'status': 'H', 'size': 'q', 'size.missing': 'B'}[name]
+            columns[name] = bytes_to_array(typecode, read_chunk(name))
+    return columns
+
+
+def filter_row_group(columns, time_range):
+    """
+    Keeps the rows of a row group dated within a time range.
+
+    Args:
+        columns (dict): The columns, as returned by read_row_group,
+            including 'time'.
+        time_range (tuple): The (since, until) timestamps.
+
+    Returns:
+        dict: The filtered columns.
+    """
+    since, until = time_range
+    since = MISSING_TIME + 1 if since is None else since
+    until = 2 ** 63 - 1 if until is None else until
+    mask = [since <= timestamp < until for timestamp in columns['time']]
+    filtered = {}
+    for name, column in columns.items():
+        if isinstance(column, tuple):
+            codes, values = column
+            filtered[name] = (array.array(codes.typecode, itertools.compress(codes, mask)),
+                              values)
+        else:
+            filtered[name] = array.array(column.typecode, itertools.compress(column, mask))
+    return filtered
+
+
+@functools.lru_cache(maxsize=1024)
+def format_log_hour(hour):
+    """Formats the hour starting at hour * 3600 like log dates, e.g. 24/Jul/2019:06."""
+    moment = datetime.datetime.fromtimestamp(hour * 3600, datetime.timezone.utc)
+    return b'%02d/%s/%04d:%02d' % (moment.day, calendar.month_abbr[moment.month].encode(),
+                                   moment.year, moment.hour)
+
+
+@functools.lru_cache(maxsize=64)
+def zone_offset(zone):
+    """Returns the seconds of a UTC offset such as +0200, or 0 if it is malformed."""
+    try:
+        offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+    except ValueError:
+        return 0
+    return -offset if zone[:1] == b'-' else offset
+
+
+def format_log_date(timestamp, zone=b'+0000'):
+    """Formats a Unix timestamp like the dates of logs, at a UTC offset."""
+    if timestamp == MISSING_TIME:
+        return b'-'
+    local = timestamp + zone_offset(zone)
+    return b'%s:%02d:%02d %s' % (format_log_hour(local // 3600),
+                                 local // 60 % 60, local % 60, zone)
+
+
+def column_fields(name, value):
+    """
+    Returns log fields holding a single value of a column, so that the
+    dimensions of that column can be extracted from them.
+
+    Args:
+        name (str): The name of the column.
+        value: The value, bytes for categorical columns, an integer for
+            'status' and a (timestamp, UTC offset) pair for 'time'.
+
+    Returns:
+        tuple: The values of LOG_FIELDS, '-' except for the given one.
+    """
+    fields = [b'-'] * len(LOG_FIELDS)
+    if name == 'time':
+        fields[3] = format_log_date(*value)
+    elif name == 'status':
+        fields[5] = b'%d' % value if value else b'-'
+    elif name == 'method':
+        fields[4] = value + b' - -'
+    elif name == 'path':
+        fields[4] = b'- ' + value + b' -'
+    elif name == 'protocol':
+        fields[4] = b'- - ' + value
+    else:
+        fields[LOG_FIELDS.index(name)] = value
+    return tuple(fields)
+
+
+def dimension_codes(name, columns, extracted, table=None):
+    """
+    Returns the codes of a dimension for each row of a row group and the
+    table mapping codes to dimension values.
+
+    Dimensions are extracted once per distinct value of their column, e.g.
+    User-Agents are classified once per file rather than per row.
+
+    Args:
+        name (str): A dimension of COLUMN_DIMENSIONS.
+        columns (dict): The columns, as returned by read_row_group.
+        extracted (dict): The dimension values already extracted from
+            column values, updated with the new ones.
+        table (tuple): The IP table of the asn and country dimensions, as
+            returned by ip_table_identity, or None.
+
+    Returns:
+        tuple: The codes, an iterable, and the table, indexable by code.
+    """
+    source = COLUMN_DIMENSIONS[name]
+    if source in CATEGORICAL_COLUMNS:
+        codes, values = columns[source]
+        if name == source:
+            return codes, values
+    elif source == 'time':
+        # Dates are grouped by the hour of their own UTC offset, as in logs
+        zone_codes, zones = columns['zone']
+        offsets = [zone_offset(zone) for zone in zones]
+        codes = [(MISSING_TIME if timestamp == MISSING_TIME
+                  else (timestamp + offsets[zone]) // 3600, zone)
+                 for timestamp, zone in zip(columns['time'], zone_codes)]
+        values = {(hour, zone): (hour if hour == MISSING_TIME
+                                 else hour * 3600 - offsets[zone], zones[zone])
+                  for hour, zone in set(codes)}
+    else:
+        codes = columns[source]
+        values = {value: value for value in set(codes)}
+    extract = dimension_extractor(name, table)
+    dimensions = {} if isinstance(values, dict) else [None] * len(values)
+    for code, value in (values.items() if isinstance(values, dict) else enumerate(values)):
+        dimension = extracted.get(value)
+        if dimension is None:
+            dimension = extracted[value] = extract(column_fields(source, value))
+        dimensions[code] = dimension
+    return codes, dimensions
+
+
+def add_column_groups(report, columns, extracted):
+    """
+    Adds the rows of a row group to a LogReport whose dimensions are all
+    in COLUMN_DIMENSIONS, counting codes rather than rows.
+
+    Args:
+        report (LogReport): The report, keyed by bytes.
+        columns (dict): The columns, as returned by read_row_group.
+        extracted (dict): The values already extracted for each dimension,
+            as dicts updated by dimension_codes.
+    """
+    table_identity = ip_table_identity(report.ip_table)
+    dimensions = [dimension_codes(name, columns, extracted[name], table_identity)
+                  for name in report.group_by]
+    if len(dimensions) == 1:
+        keys, table = dimensions[0]
+        key_of = table.__getitem__
+    else:
+        keys = list(zip(*(codes for codes, _ in dimensions)))
+        tables = [table for _, table in dimensions]
+        key_of = lambda codes: tuple(table[code] for table, code in zip(tables, codes))
+    for code, count in Counter(keys).items():
+        report.counts[key_of(code)] += count
+    if 'bytes' in report.metrics:
+        sizes = Counter()
+        for code, size in zip(keys, columns['size']):
+            sizes[code] += size
+        for code, size in sizes.items():
+            report.sizes[key_of(code)] += size
+    if 'ips' in report.metrics:
+        ip_codes, ip_values = columns['ip']
+        ips = defaultdict(set)
+        for code, ip in zip(keys, ip_codes):
+            ips[code].add(ip)
+        for code, codes in ips.items():
+            report.ips[key_of(code)].update(ip_values[ip] for ip in codes)
+
+
+def column_rows(columns):
+    """
+    Yields the rows of a row group as log fields, for the reports whose
+    dimensions cannot be counted by code.
+
+    Args:
+        columns (dict): All columns of the group, as returned by
+            read_row_group.
+
+    Yields:
+        tuple: The values of LOG_FIELDS of each row.
+    """
+    statuses = {status: b'%d' % status if status else b'-' for status in set(columns['status'])}
+    (ips, ip_values), (identds, identd_values), (users, user_values), \
+        (zones, zone_values), (methods, method_values), (paths, path_values), \
+        (protocols, protocol_values), (referers, referer_values), \
+        (agents, agent_values) = (columns[name] for name in CATEGORICAL_COLUMNS)
+    for (timestamp, status, size, missing_size, ip, identd, user, zone, method, path,
+         protocol, referer, agent) in zip(
+            columns['time'], columns['status'], columns['size'], columns['size.missing'],
+            ips, identds, users, zones, methods, paths, protocols, referers, agents):
+        request = b' '.join(filter(None, (method_values[method], path_values[path],
+                                          protocol_values[protocol])))
+        yield (ip_values[ip], identd_values[identd], user_values[user],
+               format_log_date(timestamp, zone_values[zone]), request, statuses[status],
+               b'-' if missing_size else b'%d' % size, referer_values[referer],
+               agent_values[agent])
+
+
+def aggregate_column_file(file_path, reports, time_range=None, start=None, end=None):
+    """
+    Adds the rows of a column file, or of a range of its row groups, to
+    the reports.
+
+    LogReport objects grouped by COLUMN_DIMENSIONS are counted from the
+    codes of the columns they need, which are the only ones decompressed;
+    other reports get every row rebuilt as log fields.
+
+    Args:
+        file_path (str): The path to the column file.
+        reports (list): The objects to update, e.g. LogReport objects.
+            Column files have no malformed lines, so MalformedLines
+            objects are left as they are.
+        time_range (tuple): The (since, until) timestamps of the rows to
+            add, or None to add all rows.
+        start (int): The offset of the first row group, or None for all
+            the row groups of the file.
+        end (int): The offset after the last row group.
+
+    Returns:
+        list: The updated reports.
+    """
+    coded = [report for report in reports if isinstance(report, LogReport)
+             and all(name in COLUMN_DIMENSIONS for name in report.group_by)]
+    others = [report for report in reports
+              if not isinstance(report, MalformedLines) and all(report is not other
+                                                                  for other in coded)]
+    names = {COLUMN_DIMENSIONS[name] for report in coded for name in report.group_by}
+    if 'time' in names:
+        names.add('zone')
+    for report in coded:
+        names.update(name for metric, name in (('bytes', 'size'), ('ips', 'ip'))
+                     if metric in report.metrics)
+    if others:
+        names.update(CATEGORICAL_COLUMNS, ('time', 'status', 'size', 'size.missing'))
+    if time_range is not None:
+        names.add('time')
+    extracted = defaultdict(dict)
+    with exit_on_read_error(file_path):
+        with open(file_path, 'rb') as file:
+            offset = len(COLUMN_FILE_MAGIC) + 1 if start is None else start
+            group = read_row_group_header(file, offset)
+            while group is not None and (end is None or offset < end):
+                _, min_time, max_time, size, chunks = group
+                if time_range is None or group_in_time_range(min_time, max_time, time_range):
+                    columns = read_row_group(file, chunks, names)
+                    if time_range is not None and not (
+                            (time_range[0] is None or min_time >= time_range[0])
+                            and (time_range[1] is None or max_time < time_range[1])):
+                        columns = filter_row_group(columns, time_range)
+                    for report in coded:
+                        add_column_groups(report, columns, extracted)
+                    if others:
+                        for fields in column_rows(columns):
+                            for report in others:
+                                report.add(fields)
+                offset += size
+                group = read_row_group_header(file, offset)
+    return reports
@@ -0,0 +1,431 @@
+"""
+Dimensions requests are grouped by: request paths and their templates,
+User-Agent classification, client subnets and the origins of an IP table.
+"""
+
+import os
+import re
+import socket
+import ipaddress
+import bisect
+import functools
+from operator import itemgetter
+
+from log_formats import request_method, request_path, request_protocol
+from log_files import file_identity
+
+# Number of distinct User-Agents whose classification is kept in memory
+AGENT_CACHE_SIZE = 4096
+
+# Number of distinct paths whose template is kept in memory
+PATH_CACHE_SIZE = 65536
+
+# Path segments replaced by placeholders in path templates, checked in order
+SEGMENT_TEMPLATES = (
+    (b'{id}', re.compile(rb'\d+')),
+    (b'{uuid}', re.compile(rb'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+                           rb'[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')),
+    (b'{hex}', re.compile(rb'[0-9a-fA-F]{16,}')),
+)
+
+# Number of distinct client IPs whose subnet and origin are kept in memory
+IP_CACHE_SIZE = 65536
+
+
+def request_endpoint(fields):
+    """Returns the path of the request of a parsed log line without its query."""
+    return request_path(fields).partition(b'?')[0]
+
+
+@functools.lru_cache(maxsize=PATH_CACHE_SIZE)
+def template_path(path):
+    """
+    Replaces the identifiers in the segments of a path by placeholders,
+    e.g. /user/123/avatar by /user/{id}/avatar.
+
+    Args:
+        path (bytes): The path, without query string.
+
+    Returns:
+        bytes: The path template.
+    """
+    segments = path.split(b'/')
+    for index, segment in enumerate(segments):
+        for placeholder, pattern in SEGMENT_TEMPLATES:
+            if pattern.fullmatch(segment):
+                segments[index] = placeholder
+                break
+    return b'/'.join(segments)
+
+
+def request_route(fields):
+    """Returns the path template of the request of a parsed log line."""
+    return template_path(request_endpoint(fields))
+
+
+def request_status_class(fields):
+    """Returns the class of the status of a parsed log line, e.g. 5xx."""
+    return fields[5][:1] + b'xx' if fields[5][:1].isdigit() else fields[5]
+
+
+def request_hour(fields):
+    """Returns the date and hour of a parsed log line, e.g. 24/Jul/2019:06."""
+    return fields[3][:14]
+
+
+def request_day(fields):
+    """Returns the date of a parsed log line, e.g. 24/Jul/2019."""
+    return fields[3][:11]
+
+
+# Bots, headless browsers and command-line clients, named by their first
+# match. Tokens are whole words, so "Cubot" phones and "JavaScript" are not bots
+bot_pattern = re.compile(
+    rb'\b((?!cubot\b)(?:\w+-)*\w*(?:bot|crawler|spider)(?:-\w+)*|slurp|headlesschrome|'
+    rb'phantomjs|python-requests|python-urllib|curl|wget|zgrab|go-http-client|'
+    rb'libwww-perl|java(?=/)|masscan|nmap)\b(?:/v?([\w.]+))?',
+    re.IGNORECASE,
+)
+
+# Browser families and the patterns of their versions, checked in order
+BROWSER_PATTERNS = (
+    (b'Edge', re.compile(rb'\bEdg(?:e|A|iOS)?/(\d+)')),
+    (b'Opera', re.compile(rb'\b(?:OPR|Opera)/(\d+)')),
+    (b'Yandex Browser', re.compile(rb'\bYaBrowser/(\d+)')),
+    (b'Sogou Explorer', re.compile(rb'\bMetaSr (\d+)')),
+    (b'Chrome', re.compile(rb'\b(?:Chrome|CriOS)/(\d+)')),
+    (b'Firefox', re.compile(rb'\b(?:Firefox|FxiOS)/(\d+)')),
+    (b'Internet Explorer', re.compile(rb'\bMSIE (\d+)|\bTrident/.*\brv:(\d+)')),
+    (b'Safari', re.compile(rb'\bVersion/(\d+)(?:[\w.]*) (?:Mobile/\w+ )?Safari/')),
+)
+
+# Operating systems and their patterns, checked in order
+OS_PATTERNS = (
+    (b'Windows Phone', re.compile(rb'Windows Phone')),
+    (b'Windows', re.compile(rb'Windows')),
+    (b'Android', re.compile(rb'Android')),
+    (b'iOS', re.compile(rb'iPhone|iPad|iPod')),
+    (b'macOS', re.compile(rb'Mac OS X|Macintosh')),
+    (b'Chrome OS', re.compile(rb'CrOS')),
+    (b'Linux', re.compile(rb'Linux|X11')),
+)
+
+# Marketing names of Windows NT versions
+WINDOWS_VERSIONS = {
+    b'10.0': b'10', b'6.3': b'8.1', b'6.2': b'8', b'6.1': b'7',
+    b'6.0': b'Vista', b'5.2': b'XP', b'5.1': b'XP',
+}
+windows_version_pattern = re.compile(rb'Windows NT (\d+\.\d+)')
+
+
+@functools.lru_cache(maxsize=AGENT_CACHE_SIZE)
+def classify_user_agent(agent):
+    """
+    Classifies a User-Agent into browser family, version, OS and type.
+
+    Versions are reduced to their major number, so that the builds of a
+    browser release are counted together. Agents repeat massively, so
+    results are cached by the raw agent: agent_cache_stats() reports how
+    often the cache was hit.
+
+    Args:
+        agent (bytes): The raw User-Agent.
+
+    Returns:
+        tuple: The (family, version, os, type) bytes of the agent, type
+        being b'bot', b'browser' or b'other'.
+    """
+    system = b'Other'
+    for name, pattern in OS_PATTERNS:
+        if pattern.search(agent):
+            system = name
+            break
+    if system == b'Windows':
+        match = windows_version_pattern.search(agent)
+        if match and match.group(1) in WINDOWS_VERSIONS:
+            system = b'Windows ' + WINDOWS_VERSIONS[match.group(1)]
+
+    match = bot_pattern.search(agent)
+    if match:
+        version = (match.group(2) or b'').split(b'.')[0]
+        return match.group(1), version, system, b'bot'
+    for family, pattern in BROWSER_PATTERNS:
+        match = pattern.search(agent)
+        if match:
+            return family, match.group(match.lastindex), system, b'browser'
+    return b'Other', b'', system, b'other'
+
+
+def agent_cache_stats():
+    """
+    Returns how often User-Agent classifications were served from cache.
+
+    The cache belongs to the current process: lines parsed by worker
+    processes are not counted.
+
+    Returns:
+        tuple: The numbers of hits and misses and the hit rate.
+    """
+    info = classify_user_agent.cache_info()
+    lookups = info.hits + info.misses
+    return info.hits, info.misses, info.hits / lookups if lookups else 0.0
+
+
+def request_browser(fields):
+    """Returns the browser family and major version of a parsed log line."""
+    family, version, _, _ = classify_user_agent(fields[8])
+    return family + b' ' + version if version else family
+
+
+def request_browser_family(fields):
+    """Returns the browser family of a parsed log line, e.g. Chrome."""
+    return classify_user_agent(fields[8])[0]
+
+
+def request_os(fields):
+    """Returns the operating system of a parsed log line."""
+    return classify_user_agent(fields[8])[2]
+
+
+def request_agent_type(fields):
+    """Returns whether a parsed log line comes from a bot or a browser."""
+    return classify_user_agent(fields[8])[3]
+
+
+@functools.lru_cache(maxsize=IP_CACHE_SIZE)
+def parse_ip(ip):
+    """
+    Converts an IP address to an integer.
+
+    IPv4-mapped IPv6 addresses are converted as IPv4 addresses.
+
+    Args:
+        ip (bytes): The address, e.g. b'88.147.0.17'.
+
+    Returns:
+        tuple: The IP version, 4 or 6, and the integer value of the
+        address, or None if it is not an IP address.
+    """
+    text = ip.decode('ascii', errors='replace')
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, text), 'big')
+    except OSError:
+        pass
+    try:
+        value = int.from_bytes(socket.inet_pton(socket.AF_INET6, text), 'big')
+    except OSError:
+        return None
+    if value >> 32 == 0xffff:
+        return 4, value & 0xffffffff
+    return 6, value
+
+
+@functools.lru_cache(maxsize=IP_CACHE_SIZE)
+def ip_subnet(ip, ipv4_prefix, ipv6_prefix):
+    """
+    Returns the subnet of an IP address in CIDR notation.
+
+    Args:
+        ip (bytes): The address.
+        ipv4_prefix (int): The prefix length of IPv4 subnets.
+        ipv6_prefix (int): The prefix length of IPv6 subnets.
+
+    Returns:
+        bytes: The subnet, e.g. b'88.147.0.0/24', or the address itself
+        if it is not an IP address.
+    """
+    parsed = parse_ip(ip)
+    if parsed is None:
+        return ip
+    version, value = parsed
+    family, bits, prefix = ((socket.AF_INET, 32, ipv4_prefix) if version == 4
+                            else (socket.AF_INET6, 128, ipv6_prefix))
+    network = value >> (bits - prefix) << (bits - prefix)
+    return f"{socket.inet_ntop(family, network.to_bytes(bits // 8, 'big'))}/{prefix}".encode()
+
+
+def table_address(text):
+    """Returns the integer of an address of a CIDR table, IPv6 ones after IPv4 ones."""
+    address = ipaddress.ip_address(text)
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return int(address) + (0 if address.version == 4 else 1 << 32)
+
+
+@functools.lru_cache(maxsize=2)
+def load_ip_table(table):
+    """
+    Loads a table of IP ranges and their autonomous system and country.
+
+    Each line holds a CIDR network, or the first and last addresses of a
+    range, followed by the AS number and optionally the country code,
+    separated by commas or tabs, e.g. '1.0.0.0/24,13335,AU' or the TSV
+    format of iptoasn.com. Lines that do not parse, such as headers and
+    comments, are skipped. Ranges must not overlap.
+
+    The ranges are kept in sorted lists searched by bisection.
+
+    Args:
+        table (tuple): The path and identity of the table, as returned by
+            ip_table_identity. The identity is part of the cache key, so
+            that a changed table is loaded again.
+
+    Returns:
+        tuple: The sorted first addresses of the ranges, their last
+        addresses, and their (asn, country) bytes.
+
+    Raises:
+        ValueError: If the table has no valid line.
+        OSError: If the table cannot be read.
+    """
+    file_path = table[0]
+    ranges = []
+    with open(file_path, encoding='utf-8', errors='replace') as file:
+        for line in file:
+            values = [value.strip() for value in re.split(r'[\t,]', line.strip())]
+            try:
+                if '/' in values[0]:
+                    network = ipaddress.ip_network(values[0], strict=False)
+                    first = table_address(network.network_address)
+                    last = table_address(network.broadcast_address)
+                    rest = values[1:]
+                else:
+                    first, last = table_address(values[0]), table_address(values[1])
+                    rest = values[2:]
+            except (ValueError, IndexError):
+                continue
+            if not rest or not rest[0]:
+                continue
+            asn = rest[0] if rest[0].upper().startswith('AS') else f"AS{rest[0]}"
+            country = rest[1] if len(rest) > 1 and rest[1] else '-'
+            ranges.append((first, last, (asn.encode(), country.encode())))
+    if not ranges:
+        raise ValueError(f"'{file_path}' has no IP range with an AS number.")
+    ranges.sort(key=itemgetter(0))
+    return ([first for first, _, _ in ranges], [last for _, last, _ in ranges],
+            [origin for _, _, origin in ranges])
+
+
+def ip_table_identity(file_path):
+    """Returns the path and identity of an IP table, or None if there is none."""
+    if not file_path:
+        return None
+    try:
+        return os.path.abspath(file_path), file_identity(file_path)
+    except OSError:
+        return file_path, None
+
+
+@functools.lru_cache(maxsize=IP_CACHE_SIZE)
+def ip_origin(ip, table):
+    """
+    Looks up the autonomous system and country of an IP address.
+
+    Args:
+        ip (bytes): The address.
+        table (tuple): The path and identity of the table, as returned by
+            ip_table_identity, or None.
+
+    Returns:
+        tuple: The AS number and country code, b'-' if unknown.
+    """
+    parsed = parse_ip(ip)
+    if not table or parsed is None:
+        return b'-', b'-'
+    firsts, lasts, origins = load_ip_table(table)
+    version, value = parsed
+    value += 0 if version == 4 else 1 << 32
+    position = bisect.bisect_right(firsts, value) - 1
+    if position >= 0 and value <= lasts[position]:
+        return origins[position]
+    return b'-', b'-'
+
+
+def request_subnet(fields):
+    """Returns the /24 subnet of an IPv4 client, or the /64 of an IPv6 one."""
+    return ip_subnet(fields[0], 24, 64)
+
+
+def request_subnet16(fields):
+    """Returns the /16 subnet of an IPv4 client, or the /48 of an IPv6 one."""
+    return ip_subnet(fields[0], 16, 48)
+
+
+def request_asn(fields, table=None):
+    """Returns the autonomous system of the client of a parsed log line."""
+    return ip_origin(fields[0], table)[0]
+
+
+def request_country(fields, table=None):
+    """Returns the country of the client of a parsed log line."""
+    return ip_origin(fields[0], table)[1]
+
+
+# Dimensions requests can be grouped by: their labels and how to get them
+DIMENSIONS = {
+    'ip': ('IP address', 'IP addresses', itemgetter(0)),
+    'user': ('User', 'Users', itemgetter(2)),
+    'day': ('Day', 'Days', request_day),
+    'hour': ('Hour', 'Hours', request_hour),
+    'request': ('Request', 'Requests', itemgetter(4)),
+    'method': ('Method', 'Methods', request_method),
+    'path': ('Path', 'Paths', request_path),
+    'protocol': ('Protocol', 'Protocols', request_protocol),
+    'endpoint': ('Endpoint', 'Endpoints', request_endpoint),
+    'route': ('Route', 'Routes', request_route),
+    'status': ('Status', 'Statuses', itemgetter(5)),
+    'status_class': ('Status class', 'Status classes', request_status_class),
+    'referer': ('Referer', 'Referers', itemgetter(7)),
+    'user_agent': ('User Agent', 'User Agents', itemgetter(8)),
+    'browser': ('Browser', 'Browsers', request_browser),
+    'browser_family': ('Browser family', 'Browser families', request_browser_family),
+    'os': ('Operating system', 'Operating systems', request_os),
+    'agent_type': ('Agent type', 'Agent types', request_agent_type),
+    'subnet': ('Subnet', 'Subnets', request_subnet),
+    'subnet16': ('/16 subnet', '/16 subnets', request_subnet16),
+    'asn': ('AS number', 'AS numbers', request_asn),
+    'country': ('Country', 'Countries', request_country),
+}
+
+# Dimensions looked up in the IP table of --ip-table, whose extractors take
+# the table as returned by ip_table_identity
+IP_TABLE_DIMENSIONS = ('asn', 'country')
+
+
+def dimension_extractor(name, table=None):
+    """
+    Returns the function extracting a dimension from a parsed log line.
+
+    Args:
+        name (str): The name of the dimension.
+        table (tuple): The IP table of the asn and country dimensions, as
+            returned by ip_table_identity, or None.
+
+    Returns:
+        callable: A function mapping the fields of a line to the value.
+    """
+    extract = DIMENSIONS[name][2]
+    if name in IP_TABLE_DIMENSIONS:
+        return functools.partial(extract, table=table)
+    return extract
+
+
+def make_key_function(group_by, ip_table=None):
+    """
+    Builds the function returning the group key of a parsed log line.
+
+    Args:
+        group_by (tuple): The names of the dimensions to group by.
+        ip_table (str): The path to the table the asn and country
+            dimensions are looked up in, as accepted by ip_table_identity,
+            or None to report every origin as unknown.
+
+    Returns:
+        callable: A function mapping the fields of a line to its key, a
+        single value for one dimension or a tuple for several.
+    """
+    table = ip_table_identity(ip_table)
+    extractors = [dimension_extractor(name, table) for name in group_by]
+    if len(extractors) == 1:
+        return extractors[0]
+    return lambda fields: tuple(extract(fields) for extract in extractors)
@@ -0,0 +1,719 @@
+"""
+Reading log files: compression detection, threaded decompression, byte
+ranges of large plain logs, binary search of time ranges in sorted logs
+and the sidecar time indexes of plain and gzip logs.
+"""
+
+import io
+import os
+import sys
+import glob
+import bz2
+import bisect
+import gzip
+import lzma
+import zlib
+import array
+import queue
+import struct
+import threading
+import contextlib
+
+from log_formats import compile_log_format, parse_log_line, parse_log_time
+
+# Size of the blocks read from log files and decompressors
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Default size of the byte ranges large plain logs are split into
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Maximum number of decompressed blocks waiting to be parsed
+MAX_PENDING_BLOCKS = 4
+
+# Magic bytes of the supported compression formats and their openers
+COMPRESSION_FORMATS = (
+    (b'\x1f\x8b', gzip.open),
+    (b'BZh', bz2.open),
+    (b'\xfd7zXZ\x00', lzma.open),
+)
+
+# Number of leading bytes recognizing a log file across renames
+FINGERPRINT_SIZE = 4096
+
+# Seconds by which the lines of a log may be out of time order, as
+# requests are logged when they end but dated when they start
+TIME_SLACK = 300
+
+# Leading bytes and format version of time index files, their header
+# (gzip flag, bytes scanned, sizes of the log head and of the entries),
+# their file name suffix and the seconds of log time between two of their
+# entries for plain logs
+TIME_INDEX_MAGIC = b'LOGTIDX'
+TIME_INDEX_VERSION = 2
+TIME_INDEX_HEADER = struct.Struct('<?qII')
+TIME_INDEX_SUFFIX = '.tidx'
+TIME_INDEX_INTERVAL = 60
+
+# Errors raised while reading damaged or truncated compressed logs
+DECOMPRESSION_ERRORS = (EOFError, zlib.error, lzma.LZMAError)
+
+
+def array_to_bytes(values):
+    """Returns the items of an array as little-endian bytes."""
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def bytes_to_array(typecode, data):
+    """Returns an array of the given type read from little-endian bytes."""
+    values = array.array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class FileRange(io.RawIOBase):
+    """
+    Reads a byte range of an open file as a stream of its own.
+    """
+
+    def __init__(self, file, start, end):
+        super().__init__()
+        file.seek(start)
+        self._file = file
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._remaining)
+        if size <= 0:
+            return 0
+        data = self._file.read(size)
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Reads a stream on a background thread and hands its blocks over
+    through a bounded queue.
+
+    The decompressors release the GIL while inflating data, so wrapping a
+    compressed stream in this reader lets decompression of the next block
+    overlap with parsing of the current one.
+    """
+
+    def __init__(self, stream, block_size=READ_BLOCK_SIZE):
+        super().__init__()
+        self._stream = stream
+        self._blocks = queue.Queue(MAX_PENDING_BLOCKS)
+        self._pending = memoryview(b'')
+        self._eof = False
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._produce, args=(block_size,), daemon=True)
+        self._thread.start()
+
+    def _produce(self, block_size):
+        """Reads blocks until the end of the stream or an error."""
+        try:
+            block = self._stream.read(block_size)
+            while block and self._put(block):
+                block = self._stream.read(block_size)
+            self._put(b'')
+        except (OSError, ValueError) + DECOMPRESSION_ERRORS as error:
+            self._put(error)
+
+    def _put(self, item):
+        """Queues an item, giving up if the reader is being closed."""
+        while not self._stopping.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._pending:
+            if self._eof:
+                return 0
+            item = self._blocks.get()
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._pending = memoryview(item)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stopping.set()
+            self._thread.join()
+            self._stream.close()
+        super().close()
+
+
+def compression_opener(magic):
+    """
+    Returns the function opening a compressed log from its first bytes.
+
+    Args:
+        magic (bytes): The first bytes of the log.
+
+    Returns:
+        callable: The opener of the compression format, or None if the log
+        is plain text.
+    """
+    for prefix, opener in COMPRESSION_FORMATS:
+        if magic.startswith(prefix):
+            return opener
+    return None
+
+
+def detect_compression(file_path):
+    """
+    Detects the compression format of a log file from its magic bytes.
+
+    Only regular files are sniffed: reading a pipe would consume its data.
+
+    Args:
+        file_path (str): The path to the log file.
+
+    Returns:
+        callable: The function opening the compressed file, or None if the
+        file is plain text or not a regular file.
+    """
+    if not os.path.isfile(file_path):
+        return None
+    with open(file_path, 'rb') as file:
+        return compression_opener(file.read(6))
+
+
+def open_log(file_path, threaded=True):
+    """
+    Opens a log file for binary reading, decompressing it if needed.
+
+    The compression format is detected from the first bytes of the file,
+    so rotated logs are handled regardless of their file extension. The
+    file is opened once and those bytes are peeked at, so logs piped
+    through /dev/stdin or a FIFO are read whole.
+
+    Args:
+        file_path (str): The path to the log file.
+        threaded (bool): Whether compressed logs are decompressed on a
+            background thread.
+
+    Returns:
+        io.BufferedIOBase: A binary stream of the decompressed log.
+    """
+    file = open(file_path, 'rb', buffering=READ_BLOCK_SIZE)
+    try:
+        opener = compression_opener(file.peek(6)[:6])
+        if opener is None:
+            return file
+        stream = opener(file)
+    except BaseException:
+        file.close()
+        raise
+    # The decompressors leave the file objects they are given open
+    close_stream = stream.close
+
+    def close():
+        try:
+            close_stream()
+        finally:
+            file.close()
+
+    stream.close = close
+    if threaded:
+        return io.BufferedReader(ThreadedReader(stream), READ_BLOCK_SIZE)
+    return stream
+
+
+@contextlib.contextmanager
+def exit_on_read_error(file_path):
+    """
+    Prints an error and exits if the log file cannot be read.
+
+    Args:
+        file_path (str): The path to the log file being read.
+    """
+    try:
+        yield
+    except FileNotFoundError:
+        print(f"Error: File '{file_path}' not found.")
+        sys.exit(1)
+    except (OSError,) + DECOMPRESSION_ERRORS as error:
+        print(f"Error: Could not read '{file_path}': {error}")
+        sys.exit(1)
+
+
+def iter_log_lines(stream):
+    """
+    Yields the lines of a binary log stream, reading it in large blocks.
+
+    Args:
+        stream (io.BufferedIOBase): The log stream, as returned by open_log.
+
+    Yields:
+        bytes: The undecoded log lines, without their line endings.
+    """
+    remainder = b''
+    block = stream.read(READ_BLOCK_SIZE)
+    while block:
+        lines = (remainder + block).split(b'\n')
+        remainder = lines.pop()
+        yield from lines
+        block = stream.read(READ_BLOCK_SIZE)
+    if remainder:
+        yield remainder
+
+
+def split_log_file(file_path, chunk_size=CHUNK_SIZE, start=0, end=None):
+    """
+    Splits a plain log file into byte ranges that start and end on line
+    boundaries.
+
+    Args:
+        file_path (str): The path to the log file.
+        chunk_size (int): The approximate size of each range in bytes.
+        start (int): The offset of the first line to cover.
+        end (int): The offset just after the last line to cover, or None
+            for the end of the file.
+
+    Returns:
+        list: (start, end) byte offsets covering the file between start
+        and end.
+    """
+    boundaries = [start]
+    with open(file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size if end is None else end
+        offset = start + chunk_size
+        while offset < size:
+            file.seek(offset - 1)
+            file.readline()
+            boundary = file.tell()
+            if boundary >= size:
+                break
+            boundaries.append(boundary)
+            offset = boundary + chunk_size
+    boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def first_line_time(file, offset, parse_line=parse_log_line):
+    """
+    Finds the first dated line starting at or after an offset of a file.
+
+    Args:
+        file (file): The log file, opened in binary mode.
+        offset (int): The offset to search from.
+        parse_line (callable): The line parser of the log format.
+
+    Returns:
+        tuple: The offset of the line and its timestamp, or the end of the
+        file and None if no line after the offset has a valid date.
+    """
+    if offset:
+        file.seek(offset - 1)
+        file.readline()
+    else:
+        file.seek(0)
+    while True:
+        start = file.tell()
+        line = file.readline()
+        if not line:
+            return start, None
+        fields = parse_line(line.rstrip(b'\r\n'))
+        timestamp = parse_log_time(fields[3]) if fields else None
+        if timestamp is not None:
+            return start, timestamp
+
+
+def find_time_offset(file, size, timestamp, parse_line=parse_log_line):
+    """
+    Binary-searches a time-sorted log for the first line dated at or
+    after a timestamp.
+
+    Args:
+        file (file): The log file, opened in binary mode.
+        size (int): The size of the file.
+        timestamp (int): The timestamp to search.
+        parse_line (callable): The line parser of the log format.
+
+    Returns:
+        int: The offset of the first line dated at or after the timestamp,
+        or the size of the file if there is none.
+    """
+    low, high = 0, size
+    while low < high:
+        middle = (low + high) // 2
+        _, line_time = first_line_time(file, middle, parse_line)
+        if line_time is not None and line_time < timestamp:
+            low = middle + 1
+        else:
+            high = middle
+    return first_line_time(file, low, parse_line)[0] if low < size else size
+
+
+def find_time_range(file_path, time_range, log_format=None):
+    """
+    Returns the byte range of a time-sorted plain log covering a time range.
+
+    The range is widened by TIME_SLACK seconds on both sides to include
+    lines slightly out of order; lines are still filtered one by one.
+    Logs without any date readable by parse_log_time are parsed whole.
+
+    Args:
+        file_path (str): The path to the log file.
+        time_range (tuple): The (since, until) timestamps, either of them
+            None if unbounded.
+        log_format (str): The format of the log, as accepted by
+            compile_log_format.
+
+    Returns:
+        tuple: The (start, end) byte offsets of the lines to parse.
+    """
+    since, until = time_range
+    parse_line = compile_log_format(log_format)
+    with open(file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if first_line_time(file, 0, parse_line)[1] is None:
+            return 0, size
+        start = 0 if since is None else find_time_offset(
+            file, size, since - TIME_SLACK, parse_line)
+        end = size if until is None else find_time_offset(
+            file, size, until + TIME_SLACK, parse_line)
+    return start, max(start, end)
+
+
+def iter_mapped_lines(mapped, start, end):
+    """
+    Yields the lines of a memory-mapped log between two byte offsets.
+
+    Args:
+        mapped (mmap.mmap): The memory-mapped log file.
+        start (int): The offset of the first line.
+        end (int): The offset just after the last line.
+
+    Yields:
+        bytes: The undecoded log lines, without their line endings.
+    """
+    while start < end:
+        stop = min(start + READ_BLOCK_SIZE, end)
+        if stop < end:
+            newline = mapped.rfind(b'\n', start, stop)
+            if newline < 0:
+                newline = mapped.find(b'\n', stop, end)
+            stop = newline + 1 if newline >= 0 else end
+        lines = mapped[start:stop].split(b'\n')
+        if not lines[-1]:
+            lines.pop()
+        yield from lines
+        start = stop
+
+
+def index_plain_log(file, index):
+    """
+    Extends the time index of a plain log from its last indexed line.
+
+    An entry is added for the first line of every TIME_INDEX_INTERVAL of
+    log time. Only the dates of lines starting a new minute are parsed.
+
+    Args:
+        file (file): The log file, opened in binary mode.
+        index (dict): The time index, as created by update_time_index.
+    """
+    times, offsets = index['times'], index['offsets']
+    bucket = times[-1] // TIME_INDEX_INTERVAL if times else None
+    base = index['scanned']
+    file.seek(base)
+    pending = b''
+    minute = None
+    while True:
+        block = file.read(READ_BLOCK_SIZE)
+        if not block:
+            break
+        block = pending + block
+        lines_end = block.rfind(b'\n') + 1
+        pending = block[lines_end:]
+        position = 0
+        while position < lines_end:
+            newline = block.index(b'\n', position)
+            bracket = block.find(b'[', position, newline)
+            if bracket >= 0 and block[bracket + 1:bracket + 18] != minute:
+                minute = block[bracket + 1:bracket + 18]
+                timestamp = parse_log_time(block[bracket + 1:bracket + 27])
+                if timestamp is not None and (bucket is None or
+                                              timestamp // TIME_INDEX_INTERVAL > bucket):
+                    bucket = timestamp // TIME_INDEX_INTERVAL
+                    times.append(timestamp)
+                    offsets.append(base + position)
+            position = newline + 1
+        base += lines_end
+    index['scanned'] = base
+
+
+def first_dated_line(data):
+    """Returns the timestamp of the first dated complete line of data, or None."""
+    for line in data.split(b'\n')[:-1]:
+        fields = parse_log_line(line)
+        timestamp = parse_log_time(fields[3]) if fields else None
+        if timestamp is not None:
+            return timestamp
+    return None
+
+
+def index_gzip_log(file, index):
+    """
+    Extends the time index of a gzip log from its last indexed member.
+
+    An entry is added for every member, i.e. every block that can be
+    decompressed on its own, holding the date of its first line.
+    Decompression stops at the first damaged or incomplete member.
+
+    Args:
+        file (file): The log file, opened in binary mode.
+        index (dict): The time index, as created by update_time_index.
+    """
+    offset = member_start = index['scanned']
+    file.seek(offset)
+    decompressor = zlib.decompressobj(31)
+    head, first_time = b'', None
+    data = b''
+    while True:
+        if not data:
+            data = file.read(READ_BLOCK_SIZE)
+            if not data:
+                break
+        try:
+            chunk = decompressor.decompress(data)
+        except zlib.error:
+            break
+        if first_time is None and len(head) < READ_BLOCK_SIZE:
+            head += chunk
+            first_time = first_dated_line(head)
+        if not decompressor.eof:
+            offset += len(data)
+            data = b''
+            continue
+        consumed = len(data) - len(decompressor.unused_data)
+        data = decompressor.unused_data
+        offset += consumed
+        if first_time is None:
+            first_time = first_dated_line(head + b'\n')
+        if first_time is not None:
+            index['times'].append(first_time)
+            index['offsets'].append(member_start)
+        index['scanned'] = member_start = offset
+        decompressor = zlib.decompressobj(31)
+        head, first_time = b'', None
+
+
+def time_index_path(file_path):
+    """Returns the path of the sidecar time index of a log file."""
+    return file_path + TIME_INDEX_SUFFIX
+
+
+def read_time_index(index_path):
+    """
+    Reads a time index file.
+
+    Args:
+        index_path (str): The path to the index file.
+
+    Returns:
+        dict: The index, as created by update_time_index, or None if the
+        file is missing, damaged or of another version.
+    """
+    try:
+        with open(index_path, 'rb') as file:
+            data = file.read()
+    except OSError:
+        return None
+    start = len(TIME_INDEX_MAGIC) + 1
+    end = start + TIME_INDEX_HEADER.size
+    if data[:start] != TIME_INDEX_MAGIC + bytes([TIME_INDEX_VERSION]) or len(data) < end:
+        return None
+    is_gzip, scanned, head_size, entries = TIME_INDEX_HEADER.unpack(data[start:end])
+    if len(data) != end + head_size + 16 * entries:
+        return None
+    head = data[end:end + head_size]
+    times_end = end + head_size + 8 * entries
+    return {
+        'gzip': is_gzip,
+        'head': head,
+        'scanned': scanned,
+        'times': bytes_to_array('q', data[end + head_size:times_end]),
+        'offsets': bytes_to_array('q', data[times_end:]),
+    }
+
+
+def write_time_index(index_path, index):
+    """
+    Writes a time index file, replacing it atomically.
+
+    Args:
+        index_path (str): The path to the index file.
+        index (dict): The index, as created by update_time_index.
+
+    Raises:
+        OSError: If the file cannot be written.
+    """
+    temp_path = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'wb') as file:
+            file.write(TIME_INDEX_MAGIC + bytes([TIME_INDEX_VERSION]))
+            file.write(TIME_INDEX_HEADER.pack(index['gzip'], index['scanned'],
+                                              len(index['head']), len(index['times'])))
+            file.write(index['head'])
+            file.write(array_to_bytes(index['times']))
+            file.write(array_to_bytes(index['offsets']))
+        os.replace(temp_path, index_path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+def update_time_index(file_path, opener):
+    """
+    Loads the time index of a log file, building or extending it first.
+
+    Indexes are kept in sidecar files next to the logs. Lines appended to
+    a log are indexed incrementally; an index whose log was truncated or
+    replaced is rebuilt. Failures to save an index are ignored.
+
+    Args:
+        file_path (str): The path to the log file.
+        opener (callable): The compression of the log, as returned by
+            detect_compression.
+
+    Returns:
+        dict: The index, with the 'times' and 'offsets' arrays of its
+        entries and the 'gzip' flag, or None if the log is neither plain
+        nor gzip-compressed.
+    """
+    if opener not in (None, gzip.open):
+        return None
+    index_path = time_index_path(file_path)
+    saved = read_time_index(index_path)
+    with open(file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        head = file.read(FINGERPRINT_SIZE)
+        if (saved is not None and saved['gzip'] == (opener is gzip.open)
+                and size >= saved['scanned'] and head.startswith(saved['head'])):
+            index = saved
+        else:
+            index = {
+                'gzip': opener is gzip.open,
+                'head': b'',
+                'scanned': 0,
+                'times': array.array('q'),
+                'offsets': array.array('q'),
+            }
+        extended = index['scanned'] < size
+        if extended:
+            (index_gzip_log if index['gzip'] else index_plain_log)(file, index)
+            index['head'] = head
+    if extended:
+        with contextlib.suppress(OSError):
+            write_time_index(index_path, index)
+    return index
+
+
+def index_time_range(index, time_range, size):
+    """
+    Returns the byte range of a time-sorted log covering a time range,
+    looked up in its time index.
+
+    The range is widened by TIME_SLACK seconds on both sides to include
+    lines slightly out of order.
+
+    Args:
+        index (dict): The time index of the log.
+        time_range (tuple): The (since, until) timestamps, either of them
+            None if unbounded.
+        size (int): The size of the log file.
+
+    Returns:
+        tuple: The (start, end) offsets of the lines, or of the gzip
+        members, to parse.
+    """
+    since, until = time_range
+    times, offsets = index['times'], index['offsets']
+    start, end = 0, size
+    if since is not None:
+        position = bisect.bisect_right(times, since - TIME_SLACK)
+        if position:
+            start = offsets[position - 1]
+    if until is not None:
+        position = bisect.bisect_right(times, until + TIME_SLACK)
+        if position < len(times):
+            end = offsets[position]
+    return start, max(start, end)
+
+
+def file_identity(file_path):
+    """
+    Returns what identifies the current content of a file.
+
+    Args:
+        file_path (str): The path to the file.
+
+    Returns:
+        tuple: The device, inode, size and modification time of the file.
+    """
+    stat = os.stat(file_path)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def expand_log_paths(patterns):
+    """
+    Expands glob patterns into the list of log files to analyze.
+
+    Patterns matching nothing are kept as-is, so that a missing file is
+    reported by the parser instead of being silently ignored. Time index
+    files matched by patterns are skipped.
+
+    Args:
+        patterns (list): File paths or glob patterns.
+
+    Returns:
+        list: The log file paths, without duplicates.
+    """
+    file_paths = []
+    for pattern in patterns:
+        matches = [file_path for file_path in sorted(glob.glob(pattern))
+                   if not file_path.endswith(TIME_INDEX_SUFFIX)]
+        file_paths.extend(matches or [pattern])
+    return list(dict.fromkeys(file_paths))
+
+
+def read_log_head(file_path):
+    """
+    Reads the first bytes of a log file, decompressed if needed.
+
+    Args:
+        file_path (str): The path to the log file.
+
+    Returns:
+        bytes: Up to FINGERPRINT_SIZE leading bytes of the log.
+    """
+    with open_log(file_path, threaded=False) as stream:
+        return stream.read(FINGERPRINT_SIZE)
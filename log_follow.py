@@ -0,0 +1,533 @@
+"""
+Live logs: following a log across rotations, sliding window counts and
+the detection of request rate spikes.
+"""
+
+import os
+import sys
+import math
+import time
+import heapq
+import ctypes
+import ctypes.util
+import select
+import datetime
+from collections import Counter, deque
+
+from log_formats import compile_log_format, parse_log_line, parse_log_time
+from log_files import READ_BLOCK_SIZE, exit_on_read_error, iter_log_lines, open_log
+from log_dimensions import DIMENSIONS, dimension_extractor, ip_table_identity, make_key_function
+from log_reports import LogReport, decode_value
+
+# Trailing windows, in seconds, of the counts printed in follow mode
+FOLLOW_WINDOWS = (60, 300, 900)
+
+# Width in seconds of the buckets the follow mode windows slide by
+BUCKET_SECONDS = 5
+
+# Longest wait in seconds for new lines before checking the log again
+POLL_INTERVAL = 1.0
+
+# Linux inotify events signalling that a file in a directory changed
+INOTIFY_EVENTS = 0x2 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200  # modify, close, move, create, delete
+
+# Dimensions watched by the anomaly detector, the half-lives in seconds of
+# its short-term rates and of the baselines they are compared with, the
+# factor and the rate in requests per minute a spike must exceed, and the
+# number of keys tracked per dimension before the least active are evicted
+ANOMALY_DIMENSIONS = ('user_agent', 'ip', 'status_class')
+ANOMALY_HALF_LIFE = 60
+ANOMALY_BASELINE_HALF_LIFE = 3600
+ANOMALY_FACTOR = 10.0
+ANOMALY_MIN_RATE = 60.0
+ANOMALY_MAX_KEYS = 10000
+
+
+class SlidingWindowCounter:
+    """
+    Counts keys over several trailing time windows.
+
+    Counts are kept in buckets of a few seconds shared by every window;
+    each window holds a ring of the buckets it covers and a running total.
+    Adding a key costs one increment per window, and a bucket leaving a
+    window is subtracted from its total once, so the cost per line stays
+    constant however long the windows are.
+    """
+
+    def __init__(self, windows=FOLLOW_WINDOWS, bucket_seconds=BUCKET_SECONDS):
+        self.windows = tuple(sorted(windows))
+        self.bucket_seconds = bucket_seconds
+        self.totals = {window: Counter() for window in self.windows}
+        self.requests = dict.fromkeys(self.windows, 0)
+        self._buckets = {window: deque() for window in self.windows}
+        self._current = None
+
+    def add(self, key, timestamp):
+        """
+        Counts a key seen at a given time.
+
+        Args:
+            key: The key to count, e.g. a User-Agent.
+            timestamp (float): The time the key was seen, in seconds.
+        """
+        index = int(timestamp // self.bucket_seconds)
+        if self._current is None or index > self._current[0]:
+            self.advance(timestamp)
+            self._current = [index, Counter(), 0]
+            for buckets in self._buckets.values():
+                buckets.append(self._current)
+        self._current[1][key] += 1
+        self._current[2] += 1
+        for window in self.windows:
+            self.totals[window][key] += 1
+            self.requests[window] += 1
+
+    def advance(self, timestamp):
+        """
+        Removes the buckets that are older than each window.
+
+        Args:
+            timestamp (float): The current time, in seconds.
+        """
+        index = int(timestamp // self.bucket_seconds)
+        for window, buckets in self._buckets.items():
+            oldest = index - max(1, window // self.bucket_seconds)
+            total = self.totals[window]
+            while buckets and buckets[0][0] <= oldest:
+                _, counts, requests = buckets.popleft()
+                self.requests[window] -= requests
+                for key, count in counts.items():
+                    remaining = total[key] - count
+                    if remaining:
+                        total[key] = remaining
+                    else:
+                        del total[key]
+
+    def top(self, window, count):
+        """
+        Returns the most frequent keys of a window.
+
+        Args:
+            window (int): One of the windows of the counter.
+            count (int): The number of keys to return.
+
+        Returns:
+            list: (key, count) pairs, most frequent first.
+        """
+        return self.totals[window].most_common(count)
+
+
+class RateAnomalyDetector:
+    """
+    Flags the keys whose request rate suddenly rises far above their usual
+    rate, e.g. a User-Agent or an IP address flooding the server.
+
+    Every key of each watched dimension has two exponentially decayed
+    counts: a short-term one, with a half-life of about a minute, and a
+    baseline with a half-life of about an hour. They are decayed when the
+    key is seen again, so adding a line costs a constant number of
+    operations per dimension. Rates are corrected for the time the
+    detector has been running, so that keys already busy when it starts
+    do not look like spikes. A key is flagged once when its short-term
+    rate exceeds both a minimum rate and a multiple of its baseline, and
+    again only after its rate has fallen below half of that threshold.
+    Each dimension tracks a bounded number of keys: when it holds twice
+    that number, the least active half is evicted.
+    """
+
+    def __init__(self, dimensions=ANOMALY_DIMENSIONS, factor=ANOMALY_FACTOR,
+                 min_rate=ANOMALY_MIN_RATE, half_life=ANOMALY_HALF_LIFE,
+                 baseline_half_life=ANOMALY_BASELINE_HALF_LIFE, max_keys=ANOMALY_MAX_KEYS,
+                 ip_table=None):
+        """
+        Args:
+            dimensions (tuple): The names of the dimensions watched.
+            factor (float): The factor by which the rate of a key must
+                exceed its baseline to be flagged.
+            min_rate (float): The lowest rate flagged, in requests per minute.
+            half_life (float): The half-life of the short-term rates, in seconds.
+            baseline_half_life (float): The half-life of the baselines, in seconds.
+            max_keys (int): The number of keys kept per dimension after an
+                eviction.
+            ip_table (str): The table the asn and country dimensions are
+                looked up in, as accepted by ip_table_identity.
+
+        Raises:
+            ValueError: If a dimension is unknown.
+        """
+        unknown = [name for name in dimensions if name not in DIMENSIONS]
+        if unknown:
+            raise ValueError(f"Unknown dimension: {', '.join(unknown)}")
+        self.dimensions = tuple(dimensions)
+        self.factor = factor
+        self.min_rate = min_rate / 60
+        self.max_keys = max_keys
+        self.alerts = []
+        self.evicted = 0
+        table = ip_table_identity(ip_table)
+        self._extractors = [dimension_extractor(name, table) for name in self.dimensions]
+        self._keys = [{} for _ in self.dimensions]
+        self._decay = math.log(2) / half_life
+        self._baseline_decay = math.log(2) / baseline_half_life
+        self._start = None
+        self._now = None
+        self._spans = (1.0, 1.0)
+
+    def add(self, fields, timestamp):
+        """
+        Counts a parsed log line and records the alerts it raises in
+        self.alerts, as (timestamp, dimension, key, rate, baseline) tuples
+        whose rates are in requests per minute.
+
+        Args:
+            fields (tuple): The values of LOG_FIELDS as bytes.
+            timestamp (float): The time of the line, in seconds.
+        """
+        if self._now is None or timestamp > self._now:
+            self._advance(timestamp)
+        span, baseline_span = self._spans
+        decay, baseline_decay = self._decay, self._baseline_decay
+        for name, extract, keys in zip(self.dimensions, self._extractors, self._keys):
+            key = extract(fields)
+            state = keys.get(key)
+            if state is None:
+                if len(keys) >= 2 * self.max_keys:
+                    self._evict(keys)
+                state = keys[key] = [1.0, 1.0, timestamp, False]
+            else:
+                elapsed = timestamp - state[2]
+                if elapsed > 0:
+                    state[0] = state[0] * math.exp(-decay * elapsed) + 1
+                    state[1] = state[1] * math.exp(-baseline_decay * elapsed) + 1
+                    state[2] = timestamp
+                else:
+                    state[0] += 1
+                    state[1] += 1
+            rate = state[0] / span
+            baseline = state[1] / baseline_span
+            threshold = max(baseline * self.factor, self.min_rate)
+            if rate >= threshold:
+                if not state[3]:
+                    state[3] = True
+                    self.alerts.append((timestamp, name, key, rate * 60, baseline * 60))
+            elif state[3] and rate < threshold / 2:
+                state[3] = False
+
+    def _advance(self, timestamp):
+        """
+        Moves the clock of the detector forward and updates the spans of
+        time its decayed counts are divided by to get rates.
+
+        A steady rate r since the detector started gives a decayed count
+        of r * (1 - exp(-decay * t)) / decay, so counts are divided by
+        that span rather than by the 1 / decay of a detector that has
+        always been running.
+        """
+        if self._start is None:
+            self._start = timestamp
+        self._now = timestamp
+        running = max(timestamp - self._start, 1)
+        self._spans = tuple(-math.expm1(-decay * running) / decay
+                            for decay in (self._decay, self._baseline_decay))
+
+    def _evict(self, keys):
+        """Keeps the max_keys keys of a dimension with the highest baselines."""
+        now, decay = self._now, self._baseline_decay
+        survivors = heapq.nlargest(
+            self.max_keys, keys.items(),
+            key=lambda item: item[1][1] * math.exp(decay * (item[1][2] - now)))
+        self.evicted += len(keys) - len(survivors)
+        keys.clear()
+        keys.update(survivors)
+
+    def tracked(self):
+        """Returns the number of keys currently tracked in each dimension."""
+        return dict(zip(self.dimensions, map(len, self._keys)))
+
+
+def format_alert(alert):
+    """
+    Formats an alert of a RateAnomalyDetector as a line of text.
+
+    Args:
+        alert (tuple): The (timestamp, dimension, key, rate, baseline) alert.
+
+    Returns:
+        str: The time of the alert in UTC, the key and its rates.
+    """
+    timestamp, dimension, key, rate, baseline = alert
+    moment = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return (f"[{moment:%Y-%m-%d %H:%M:%S}] Spike of {DIMENSIONS[dimension][0]} "
+            f"{decode_value(key)}: {rate:.0f} requests/min, baseline {baseline:.1f}")
+
+
+def log_start_time(file_path, parse_line=parse_log_line):
+    """
+    Returns when a log starts, to order rotated logs by age.
+
+    Args:
+        file_path (str): The path to the log file, optionally compressed.
+        parse_line (callable): The line parser of the log format.
+
+    Returns:
+        float: The timestamp of the first dated line of the log, or the
+        modification time of the file if no line has a valid date.
+    """
+    with open_log(file_path, threaded=False) as stream:
+        for line in iter_log_lines(stream):
+            fields = parse_line(line)
+            timestamp = parse_log_time(fields[3]) if fields else None
+            if timestamp is not None:
+                return timestamp
+    return os.path.getmtime(file_path)
+
+
+def detect_log_anomalies(file_paths, detector, log_format=None):
+    """
+    Replays logs oldest first through an anomaly detector, e.g. to tune
+    its options on a past incident.
+
+    Glob patterns list rotated logs by name, access.log before
+    access.log.1, so regular files are ordered by the time of their first
+    dated line. Pipes cannot be read twice and are replayed last, in the
+    order given.
+
+    Args:
+        file_paths (list): The paths to the log files.
+        detector (RateAnomalyDetector): The detector.
+        log_format (str): The format of the logs, as accepted by
+            compile_log_format.
+
+    Yields:
+        tuple: The alerts of the detector, in the order they are raised.
+    """
+    parse_line = compile_log_format(log_format)
+    start_times = {}
+    for file_path in file_paths:
+        if os.path.isfile(file_path):
+            with exit_on_read_error(file_path):
+                start_times[file_path] = log_start_time(file_path, parse_line)
+    file_paths = (sorted(start_times, key=start_times.get)
+                  + [file_path for file_path in file_paths if file_path not in start_times])
+    for file_path in file_paths:
+        with exit_on_read_error(file_path):
+            with open_log(file_path) as stream:
+                for line in iter_log_lines(stream):
+                    fields = parse_line(line)
+                    if not fields:
+                        continue
+                    timestamp = parse_log_time(fields[3])
+                    if timestamp is None:
+                        continue
+                    detector.add(fields, timestamp)
+                    if detector.alerts:
+                        yield from detector.alerts
+                        detector.alerts.clear()
+
+
+class InotifyWatcher:
+    """
+    Waits for changes in the directory of a log file with Linux inotify.
+
+    Watching the directory rather than the file also reports the log being
+    rotated or recreated.
+    """
+
+    def __init__(self, file_path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        directory = os.path.dirname(os.path.abspath(file_path))
+        if libc.inotify_add_watch(self._fd, os.fsencode(directory), INOTIFY_EVENTS) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, f"Cannot watch '{directory}'")
+
+    def wait(self, timeout):
+        """
+        Waits until a file of the directory changes or the timeout expires.
+
+        Args:
+            timeout (float): The longest wait, in seconds.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if readable:
+            try:
+                while os.read(self._fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        """Stops watching the directory."""
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """Waits for changes of a log file by sleeping, where inotify is missing."""
+
+    def wait(self, timeout):
+        """
+        Sleeps until the log file should be checked again.
+
+        Args:
+            timeout (float): The longest wait, in seconds.
+        """
+        time.sleep(min(timeout, POLL_INTERVAL))
+
+    def close(self):
+        """Does nothing, as polling holds no resources."""
+
+
+def make_watcher(file_path):
+    """
+    Returns an inotify watcher for a log file, or a polling watcher if
+    inotify is not available.
+
+    Args:
+        file_path (str): The path to the log file.
+
+    Returns:
+        InotifyWatcher or PollingWatcher: The watcher.
+    """
+    try:
+        return InotifyWatcher(file_path)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher()
+
+
+def log_replaced(file, file_path):
+    """
+    Tells whether the log at a path is no longer the open file, because it
+    was rotated or truncated.
+
+    Args:
+        file (io.BufferedReader): The open log file, read to its end.
+        file_path (str): The path to the log file.
+
+    Returns:
+        bool: True if the log should be reopened from its start.
+    """
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return False
+    current = os.fstat(file.fileno())
+    return ((stat.st_dev, stat.st_ino) != (current.st_dev, current.st_ino)
+            or stat.st_size < file.tell())
+
+
+def follow_log(file_path, from_start=False, timeout=POLL_INTERVAL):
+    """
+    Yields the lines appended to a live log file, following rotations.
+
+    The old file is read to its end before switching to the new one, and a
+    truncated log is read again from its start.
+
+    Args:
+        file_path (str): The path to the log file.
+        from_start (bool): Whether the lines already in the log are read.
+        timeout (float): The longest wait for new lines, in seconds.
+
+    Yields:
+        list: The complete undecoded lines read in one go, or an empty
+        list when none arrived during the timeout.
+    """
+    watcher = make_watcher(file_path)
+    file = None
+    remainder = b''
+    try:
+        while True:
+            if file is None:
+                try:
+                    file = open(file_path, 'rb')
+                except FileNotFoundError:
+                    watcher.wait(timeout)
+                    yield []
+                    continue
+                if not from_start:
+                    file.seek(0, os.SEEK_END)
+                    from_start = True
+                remainder = b''
+            block = file.read(READ_BLOCK_SIZE)
+            if block:
+                data = remainder + block
+                end = data.rfind(b'\n') + 1
+                remainder = data[end:]
+                yield data[:end].split(b'\n')[:-1]
+            elif log_replaced(file, file_path):
+                file.close()
+                file = None
+            else:
+                watcher.wait(timeout)
+                yield []
+    finally:
+        watcher.close()
+        if file is not None:
+            file.close()
+
+
+def print_window_counts(counter, label, top):
+    """
+    Prints the most frequent keys of every window of a counter.
+
+    Args:
+        counter (SlidingWindowCounter): The counter.
+        label (str): The human-readable name of the keys, in plural.
+        top (int): The number of keys printed per window.
+    """
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Top {label}")
+    for window in counter.windows:
+        span = f"{window // 60} min" if window % 60 == 0 else f"{window} s"
+        print(f"  Last {span} ({counter.requests[window]} requests):")
+        for key, count in counter.top(window, top):
+            text = ' | '.join(key) if isinstance(key, tuple) else key
+            print(f"    {count}: {text}")
+    sys.stdout.flush()
+
+
+def follow_access_log(file_path, group_by=('user_agent',), windows=FOLLOW_WINDOWS,
+                      interval=10.0, top=10, from_start=False, log_format=None,
+                      detector=None, ip_table=None):
+    """
+    Watches a live log and periodically prints its top keys over trailing
+    windows, without ever reading its history again. With a detector, the
+    spikes it flags are printed as soon as their lines are read.
+
+    Args:
+        file_path (str): The path to the log file.
+        group_by (tuple): The names of the dimensions to count.
+        windows (tuple): The trailing windows, in seconds.
+        interval (float): The time between two printouts, in seconds.
+        top (int): The number of keys printed per window.
+        from_start (bool): Whether the lines already in the log are read.
+        log_format (str): The format of the log, as accepted by
+            compile_log_format.
+        detector (RateAnomalyDetector): The anomaly detector fed with the
+            lines, dated by their log time or else by the current time.
+        ip_table (str): The table the asn and country dimensions are looked
+            up in, as accepted by ip_table_identity.
+    """
+    parse_line = compile_log_format(log_format)
+    report = LogReport(group_by)
+    key_of = make_key_function(report.group_by, ip_table)
+    counter = SlidingWindowCounter(windows)
+    next_print = time.monotonic() + interval
+    for lines in follow_log(file_path, from_start, min(interval, POLL_INTERVAL)):
+        now = time.time()
+        for line in lines:
+            fields = parse_line(line)
+            if fields:
+                counter.add(decode_value(key_of(fields)), now)
+                if detector is not None:
+                    detector.add(fields, parse_log_time(fields[3]) or now)
+        if detector is not None and detector.alerts:
+            for alert in detector.alerts:
+                print(format_alert(alert))
+            detector.alerts.clear()
+            sys.stdout.flush()
+        if time.monotonic() >= next_print:
+            counter.advance(time.time())
+            print_window_counts(counter, report.plural_label, top)
+            next_print = time.monotonic() + interval
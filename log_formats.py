@@ -0,0 +1,500 @@
+"""
+Log formats: the Combined Log Format fast path, the registry of named
+formats, parsers compiled from Apache LogFormat and nginx log_format
+strings, JSON lines, and the raw values and dates of parsed lines.
+"""
+
+import re
+import json
+import math
+import calendar
+import datetime
+import functools
+
+# Regular expression pattern for Apache Combined Log Format
+log_pattern = re.compile(r'''
+    (?P<ip>\S+)                    # IP address
+    \s+
+    (?P<identd>\S+)                # identd
+    \s+
+    (?P<user>\S+)                  # userid
+    \s+
+    \[(?P<date>.*?)\]              # date
+    \s+
+    "(?P<request>.*?)"             # request
+    \s+
+    (?P<status>\d{3})              # status code
+    \s+
+    (?P<size>\S+)                  # size
+    \s+
+    "(?P<referer>.*?)"             # referer
+    \s+
+    "(?P<user_agent>.*?)"          # user agent
+    ''', re.VERBOSE)
+
+# The same pattern for undecoded log lines
+log_pattern_bytes = re.compile(log_pattern.pattern.encode(), re.VERBOSE)
+
+# Tolerant pattern for lines log_pattern rejects: any status and size,
+# escaped quotes, missing referer and User-Agent (Common Log Format)
+lenient_log_pattern = re.compile(rb'''
+    \s*(?P<ip>\S+)
+    \s+(?P<identd>\S+)
+    \s+(?P<user>\S+)
+    \s+\[(?P<date>[^\]]*)\]
+    \s+"(?P<request>(?:[^"\\]|\\.)*)"
+    \s+(?P<status>\S+)
+    (?:\s+(?P<size>\S+))?
+    (?:\s+"(?P<referer>(?:[^"\\]|\\.)*)")?
+    (?:\s+"(?P<user_agent>(?:[^"\\]|\\.)*)")?
+    ''', re.VERBOSE)
+
+# Names of the fields of a Combined Log Format line, in order
+LOG_FIELDS = ('ip', 'identd', 'user', 'date', 'request', 'status', 'size',
+              'referer', 'user_agent')
+
+
+def split_log_line(line):
+    """
+    Splits a Combined Log Format line into its fields without the regex.
+
+    The line is cut at its quotes and only the few unquoted parts are
+    checked, which is several times faster than log_pattern_bytes. Lines
+    of any other shape are left to the regex: whenever a tuple is
+    returned, it is exactly what log_pattern_bytes would have captured.
+
+    Args:
+        line (bytes): The undecoded log line.
+
+    Returns:
+        tuple: The values of LOG_FIELDS as bytes, or None if the line does
+        not have the usual shape.
+    """
+    parts = line.split(b'"', 6)
+    if len(parts) != 7:
+        return None
+    head, request, middle, referer, gap, user_agent = parts[:6]
+    if not gap.isspace() or not middle[:1].isspace() or not middle[-1:].isspace():
+        return None
+    status_size = middle.split()
+    if len(status_size) != 2 or len(status_size[0]) != 3 or not status_size[0].isdigit():
+        return None
+    prefix, _, date = head.partition(b'[')
+    ids = prefix.split()
+    if (len(ids) != 3 or head[:1].isspace() or not prefix[-1:].isspace()
+            or not head[-1:].isspace()):
+        return None
+    date = date.rstrip()
+    if not date.endswith(b']'):
+        return None
+    return (ids[0], ids[1], ids[2], date[:-1], request, status_size[0],
+            status_size[1], referer, user_agent)
+
+
+def parse_log_line(line):
+    """
+    Extracts the fields of a log line, trying the fast splitter first.
+
+    Args:
+        line (bytes): The undecoded log line.
+
+    Returns:
+        tuple: The values of LOG_FIELDS as bytes, or None if the line is
+        malformed.
+    """
+    fields = split_log_line(line)
+    if fields is None:
+        match = log_pattern_bytes.match(line)
+        if match:
+            fields = match.group(*LOG_FIELDS)
+    return fields
+
+
+# Named log formats: Apache LogFormat or nginx log_format strings, or
+# 'json' for JSON lines
+LOG_FORMATS = {
+    'combined': '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i"',
+    'common': '%h %l %u %t "%r" %>s %b',
+    'nginx': '$remote_addr - $remote_user [$time_local] "$request" $status '
+             '$body_bytes_sent "$http_referer" "$http_user_agent"',
+    'json': 'json',
+}
+
+# Directives of Apache LogFormat and variables of nginx log_format strings
+format_directive_pattern = re.compile(
+    r'%%|%[<>]?(?:\{(?P<argument>[^}]*)\})?(?P<directive>[a-zA-Z])'
+    r'|\$(?:\{(?P<braced>\w+)\}|(?P<variable>\w+))'
+)
+
+# Log fields of Apache directives, with their argument if they take one
+APACHE_DIRECTIVES = {
+    'h': 'ip', 'a': 'ip', 'l': 'identd', 'u': 'user', 't': 'date',
+    'r': 'request', 's': 'status', 'b': 'size', 'B': 'size',
+    'i:referer': 'referer', 'i:user-agent': 'user_agent',
+}
+
+# Log fields of nginx variables; ISO 8601 dates are converted to log dates
+# by regex_line_parser
+NGINX_VARIABLES = {
+    'remote_addr': 'ip', 'remote_user': 'user', 'time_local': 'date',
+    'time_iso8601': 'iso_date', 'request': 'request', 'status': 'status',
+    'body_bytes_sent': 'size', 'bytes_sent': 'size', 'http_referer': 'referer',
+    'http_user_agent': 'user_agent',
+}
+
+# Patterns of the log fields outside quotes; any other value is \S+
+FIELD_PATTERNS = {
+    'date': rb'(?P<date>[^\]\s]+ [+-]\d{4})',
+    'status': rb'(?P<status>\d{3}|-)',
+}
+
+# Pattern of a value between quotes, where quotes are escaped
+QUOTED_VALUE = rb'(?:[^"\\]|\\.)*'
+
+# Keys of JSON log records holding each log field, in order of preference
+JSON_KEYS = {
+    'ip': ('remote_addr', 'ip', 'client_ip'),
+    'identd': ('identd',),
+    'user': ('remote_user', 'user'),
+    'date': ('time_local', 'time_iso8601', 'date', 'time'),
+    'request': ('request',),
+    'status': ('status',),
+    'size': ('body_bytes_sent', 'bytes_sent', 'size'),
+    'referer': ('http_referer', 'referer'),
+    'user_agent': ('http_user_agent', 'user_agent'),
+}
+
+# ISO 8601 dates of JSON log records, e.g. 2019-07-24T06:51:05+00:00,
+# with optional fractions of seconds and a UTC offset defaulting to UTC
+ISO_DATE = re.compile(r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:[.,]\d+)?'
+                      r'(?:(Z)|([+-]\d{2}):?(\d{2}))?')
+
+
+def format_pattern(log_format):
+    """
+    Compiles an Apache LogFormat or nginx log_format string into a regex.
+
+    Directives of the log fields become named groups; other directives
+    match any value. Spaces match any run of whitespace.
+
+    Args:
+        log_format (str): The format string.
+
+    Returns:
+        re.Pattern: The pattern of the log lines, on bytes.
+    """
+    parts = []
+    captured = set()
+    position = 0
+    quoted = False
+    for match in format_directive_pattern.finditer(log_format):
+        literal = log_format[position:match.start()]
+        quoted ^= literal.count('"') % 2 == 1
+        parts.append(re.escape(literal.encode()).replace(b'\\ ', rb'\s+'))
+        position = match.end()
+        if match.group() == '%%':
+            parts.append(b'%')
+            continue
+        if match.group('directive'):
+            directive = match.group('directive')
+            if match.group('argument') is not None:
+                directive += ':' + match.group('argument').lower()
+            name = APACHE_DIRECTIVES.get(directive)
+        else:
+            name = NGINX_VARIABLES.get(match.group('braced') or match.group('variable'))
+        if quoted:
+            value = QUOTED_VALUE
+            if name and name not in captured:
+                value = b'(?P<%s>%s)' % (name.encode(), value)
+        elif name and name not in captured:
+            value = FIELD_PATTERNS.get(name, b'(?P<%s>\\S+)' % name.encode())
+        else:
+            value = rb'\S+'
+        if match.group('directive') == 't' and match.group('argument') is None:
+            # Apache writes the default time format between brackets
+            value = rb'\[' + (rb'[^\]]*' if value == rb'\S+' else value) + rb'\]'
+        if name:
+            captured.add(name)
+        parts.append(value)
+    parts.append(re.escape(log_format[position:].encode()).replace(b'\\ ', rb'\s+'))
+    return re.compile(b''.join(parts))
+
+
+def regex_line_parser(pattern):
+    """
+    Builds a line parser returning the fields captured by a pattern.
+
+    An ISO 8601 date captured by an iso_date group, when the pattern has
+    no date group, becomes the date field, converted by log_date.
+
+    Args:
+        pattern (re.Pattern): A pattern with groups named after LOG_FIELDS.
+
+    Returns:
+        callable: A function mapping a line to the values of LOG_FIELDS,
+        b'-' for the fields the pattern lacks, or to None if the line does
+        not match.
+    """
+    indexes = [pattern.groupindex.get(name, 0) for name in LOG_FIELDS]
+    match = pattern.match
+
+    def parse_line(line):
+        found = match(line)
+        if found is None:
+            return None
+        values = (b'-',) + found.groups(b'-')
+        return tuple([values[index] for index in indexes])
+
+    if 'date' in pattern.groupindex or 'iso_date' not in pattern.groupindex:
+        return parse_line
+    date_index = LOG_FIELDS.index('date')
+    indexes[date_index] = pattern.groupindex['iso_date']
+
+    def parse_iso_line(line):
+        fields = parse_line(line)
+        if fields is None:
+            return None
+        date = log_date(fields[date_index].decode('latin-1')).encode('latin-1')
+        return fields[:date_index] + (date,) + fields[date_index + 1:]
+
+    return parse_iso_line
+
+
+def log_date(text):
+    """
+    Converts an ISO 8601 date to a log date such as 24/Jul/2019:06:51:05
+    +0000, leaving other dates unchanged.
+
+    Args:
+        text (str): The date of a JSON log record or of an nginx
+            $time_iso8601 variable.
+
+    Returns:
+        str: The log date.
+    """
+    match = ISO_DATE.fullmatch(text)
+    if match is None:
+        return text
+    year, month, day, hour, minute, second, _, zone_hours, zone_minutes = match.groups()
+    if not 1 <= int(month) <= 12:
+        return text
+    zone = zone_hours + zone_minutes if zone_hours else '+0000'
+    return (f"{day}/{calendar.month_abbr[int(month)]}/{year}:{hour}:{minute}:{second} "
+            f"{zone}")
+
+
+def parse_json_line(line):
+    """
+    Extracts the fields of a JSON log record.
+
+    Only the keys of JSON_KEYS are looked up and encoded; the other keys
+    of the record are ignored. ISO 8601 dates are converted to log dates,
+    so that records can be filtered and grouped by time.
+
+    Args:
+        line (bytes): The undecoded JSON object.
+
+    Returns:
+        tuple: The values of LOG_FIELDS as bytes, b'-' for missing keys,
+        or None if the line is not a JSON object.
+    """
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(record, dict):
+        return None
+    values = []
+    for name, keys in JSON_KEYS.items():
+        value = next((record[key] for key in keys if record.get(key) is not None), None)
+        if value is None:
+            values.append(b'-')
+            continue
+        value = str(value)
+        if name == 'date':
+            value = log_date(value)
+        values.append(value.encode('utf-8', errors='surrogateescape'))
+    return tuple(values)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_log_format(log_format=None):
+    """
+    Returns the fastest line parser of a log format.
+
+    Formats laid out like the Combined Log Format, including the nginx
+    combined format whose identd is always '-', use parse_log_line, JSON
+    lines use parse_json_line and other formats a compiled regex.
+
+    Args:
+        log_format (str): A name of LOG_FORMATS, an Apache LogFormat or
+            nginx log_format string, or None for the Combined Log Format.
+
+    Returns:
+        callable: A function mapping an undecoded line to the values of
+        LOG_FIELDS, or to None if the line is malformed.
+
+    Raises:
+        ValueError: If the format has none of the log fields.
+    """
+    log_format = LOG_FORMATS.get(log_format or 'combined', log_format)
+    if log_format == 'json':
+        return parse_json_line
+    pattern = format_pattern(log_format)
+    if pattern.pattern in (format_pattern(LOG_FORMATS['combined']).pattern,
+                           format_pattern(LOG_FORMATS['nginx']).pattern):
+        return parse_log_line
+    if not pattern.groupindex:
+        raise ValueError(f"Log format has no known field: {log_format}")
+    return regex_line_parser(pattern)
+
+
+def parse_lenient_line(line):
+    """
+    Parses a line rejected by parse_log_line with a tolerant pattern.
+
+    Missing fields are set to b'-', like the fields Apache leaves empty.
+
+    Args:
+        line (bytes): The undecoded log line.
+
+    Returns:
+        tuple: The values of LOG_FIELDS as bytes, or None if the line has
+        no recognizable client, date and request.
+    """
+    match = lenient_log_pattern.match(line)
+    if not match:
+        return None
+    return tuple(b'-' if value is None else value for value in match.group(*LOG_FIELDS))
+
+
+def request_method(fields):
+    """Returns the method of the request of a parsed log line."""
+    return fields[4].partition(b' ')[0]
+
+
+def request_path(fields):
+    """Returns the path of the request of a parsed log line."""
+    parts = fields[4].split(b' ', 2)
+    return parts[1] if len(parts) > 1 else b''
+
+
+def request_protocol(fields):
+    """Returns the protocol of the request of a parsed log line, e.g. HTTP/1.1."""
+    parts = fields[4].split(b' ', 2)
+    return parts[2] if len(parts) > 2 else b''
+
+
+def request_zone(fields):
+    """Returns the UTC offset of the date of a parsed log line, e.g. +0200."""
+    return fields[3][21:26]
+
+
+def request_status_code(fields):
+    """Returns the status of a parsed log line as a number, None if invalid."""
+    status = int(fields[5]) if fields[5].isdigit() else None
+    return status if status is not None and status <= MAX_STATUS else None
+
+
+def request_size(fields):
+    """Returns the response size of a parsed log line, None if invalid."""
+    size = int(fields[6]) if fields[6].isdigit() else None
+    return size if size is not None and size <= MAX_SIZE else None
+
+# Month abbreviations of log dates and their numbers
+MONTHS = {month.encode(): number
+          for number, month in enumerate(calendar.month_abbr) if month}
+
+# Largest status code and response size stored in columns and log stores;
+# larger values, which only JSON logs can hold, are stored as missing
+MAX_STATUS = 999
+MAX_SIZE = 2 ** 63 - 1
+
+
+@functools.lru_cache(maxsize=1024)
+def hour_timestamp(hour, zone):
+    """
+    Converts the hour of a log date to the Unix timestamp of its start.
+
+    Consecutive lines share their hour, so results are cached and the
+    calendar arithmetic is done once per hour of logs.
+
+    Args:
+        hour (bytes): The date and hour, e.g. 24/Jul/2019:06.
+        zone (bytes): The UTC offset, e.g. +0000.
+
+    Returns:
+        int: The number of seconds since the epoch.
+
+    Raises:
+        KeyError: If the month is unknown.
+        ValueError: If a number is malformed.
+    """
+    offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+    if zone[:1] == b'-':
+        offset = -offset
+    moment = (int(hour[7:11]), MONTHS[hour[3:6]], int(hour[0:2]), int(hour[12:14]), 0, 0)
+    return calendar.timegm(moment) - offset
+
+
+def parse_log_time(date):
+    """
+    Converts a log date such as 24/Jul/2019:06:51:05 +0000 to a Unix
+    timestamp, reading its fixed-position fields directly.
+
+    Args:
+        date (bytes): The date field of a log line.
+
+    Returns:
+        int: The number of seconds since the epoch, or None if the date is
+        malformed.
+    """
+    try:
+        return (hour_timestamp(date[:14], date[21:26])
+                + int(date[15:17]) * 60 + int(date[18:20]))
+    except (KeyError, ValueError):
+        return None
+
+
+def parse_time_option(text):
+    """
+    Converts a --since or --until value to a Unix timestamp.
+
+    Args:
+        text (str): A Unix timestamp, an ISO 8601 date and time, UTC if it
+            has no offset, or a log date such as 24/Jul/2019:06:51:05 +0000.
+
+    Returns:
+        int: The number of seconds since the epoch.
+
+    Raises:
+        ValueError: If the value is not a supported time.
+    """
+    if text.isdigit():
+        return int(text)
+    timestamp = parse_log_time(text.encode())
+    if timestamp is not None and len(text) == 26:
+        return timestamp
+    moment = datetime.datetime.fromisoformat(text)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return math.floor(moment.timestamp())
+
+
+def in_time_range(fields, time_range):
+    """
+    Returns whether a parsed log line is dated within a time range.
+
+    Args:
+        fields (tuple): The fields of the line.
+        time_range (tuple): The (since, until) timestamps, since being
+            included and until excluded, either of them None if unbounded.
+
+    Returns:
+        bool: True if the date of the line is within the range.
+    """
+    timestamp = parse_log_time(fields[3])
+    if timestamp is None:
+        return False
+    since, until = time_range
+    return (since is None or timestamp >= since) and (until is None or timestamp < until)
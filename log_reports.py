@@ -0,0 +1,644 @@
+"""
+Reports of parsed log lines, exact or approximate, the path tree and the
+malformed lines, and the compact binary format of report files.
+"""
+
+import math
+import zlib
+import struct
+from collections import Counter, defaultdict
+
+from log_formats import parse_lenient_line
+from log_sketches import DISTINCT_ERROR, TOP_ERROR, HyperLogLog, SpaceSaving
+from log_dimensions import DIMENSIONS, make_key_function
+
+# Leading bytes and format version of saved report files
+REPORT_FILE_MAGIC = b'LOGREPORTS'
+REPORT_FILE_VERSION = 1
+
+# Number of malformed lines kept as samples and their maximum length
+MALFORMED_SAMPLES = 5
+MALFORMED_SAMPLE_LENGTH = 300
+
+# Metrics computed for each group in addition to the number of requests
+METRICS = ('bytes', 'ips')
+
+
+def decode_value(value):
+    """Decodes a value of a group key, or each value of a tuple key."""
+    if isinstance(value, tuple):
+        return tuple(decode_value(item) for item in value)
+    return value.decode('utf-8', errors='replace')
+
+
+def encode_key(key):
+    """Returns a group key as a single bytes value, joining tuple keys."""
+    return b'\x00'.join(key) if isinstance(key, tuple) else key
+
+
+class GroupedReport:
+    """
+    Base class of the reports grouping parsed log lines by dimensions.
+
+    The asn and country dimensions are looked up in the IP table given to
+    the report, whose identity is read again when the report is unpickled
+    in another process.
+    """
+
+    def __init__(self, group_by, ip_table=None):
+        unknown = [name for name in group_by if name not in DIMENSIONS]
+        if unknown:
+            raise ValueError(f"Unknown dimension or metric: {', '.join(unknown)}")
+        self.group_by = tuple(group_by)
+        self.use_ip_table(ip_table)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_key']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.use_ip_table(self.ip_table)
+
+    def use_ip_table(self, ip_table):
+        """
+        Sets the table the asn and country dimensions of added lines are
+        looked up in.
+
+        Args:
+            ip_table (str): The path to the table, as accepted by
+                ip_table_identity, or None to report every origin as
+                unknown.
+        """
+        self.ip_table = ip_table
+        self._key = make_key_function(self.group_by, ip_table)
+
+    @property
+    def label(self):
+        """The human-readable name of a group of the report."""
+        return ', '.join(DIMENSIONS[name][0] for name in self.group_by)
+
+    @property
+    def plural_label(self):
+        """The human-readable name of the groups of the report."""
+        if len(self.group_by) == 1:
+            return DIMENSIONS[self.group_by[0]][1]
+        return f"({self.label}) groups"
+
+
+class LogReport(GroupedReport):
+    """
+    Aggregates parsed log lines by one or more dimensions.
+
+    Every report counts the requests of each group. The 'bytes' metric
+    adds the total response size of each group and the 'ips' metric the
+    set of distinct client IPs. Reports of different parts of the logs are
+    combined with update().
+    """
+
+    def __init__(self, group_by=('user_agent',), metrics=(), ip_table=None):
+        unknown = [name for name in metrics if name not in METRICS]
+        if unknown:
+            raise ValueError(f"Unknown dimension or metric: {', '.join(unknown)}")
+        super().__init__(group_by, ip_table)
+        self.metrics = tuple(metrics)
+        self.counts = Counter()
+        self.sizes = Counter()
+        self.ips = defaultdict(set)
+        self._count_sizes = 'bytes' in self.metrics
+        self._collect_ips = 'ips' in self.metrics
+
+    @property
+    def spec(self):
+        """The spec creating an empty copy of the report with make_report."""
+        return (self.group_by, self.metrics)
+
+    def add(self, fields):
+        """
+        Adds a parsed log line to the report.
+
+        Args:
+            fields (tuple): The values of LOG_FIELDS for the line.
+        """
+        key = self._key(fields)
+        self.counts[key] += 1
+        if self._count_sizes and fields[6].isdigit():
+            self.sizes[key] += int(fields[6])
+        if self._collect_ips:
+            self.ips[key].add(fields[0])
+
+    def update(self, other):
+        """
+        Merges another report with the same dimensions into this one.
+
+        Args:
+            other (LogReport): The report to merge.
+        """
+        self.counts.update(other.counts)
+        self.sizes.update(other.sizes)
+        for key, ips in other.ips.items():
+            self.ips[key].update(ips)
+
+    def decode(self):
+        """
+        Decodes the undecoded keys and IPs of the report.
+
+        Keys that only differ by invalid UTF-8 sequences decode to the same
+        string, and their groups are merged.
+
+        Returns:
+            LogReport: A new report keyed by strings.
+        """
+        decoded = LogReport(self.group_by, self.metrics)
+        for key, count in self.counts.items():
+            text_key = decode_value(key)
+            decoded.counts[text_key] += count
+            if key in self.sizes:
+                decoded.sizes[text_key] += self.sizes[key]
+            if key in self.ips:
+                decoded.ips[text_key].update(decode_value(ip) for ip in self.ips[key])
+        return decoded
+
+
+class ApproximateReport(GroupedReport):
+    """
+    Estimates the top groups and the number of distinct groups of parsed
+    log lines in fixed memory.
+
+    The top groups are tracked by a SpaceSaving summary whose counts are
+    off by at most about top_error times the number of requests, and the
+    distinct groups are counted by a HyperLogLog sketch with a relative
+    standard error of distinct_error. Hashing is skipped for keys already
+    tracked, which covers most lines of typical logs.
+    """
+
+    def __init__(self, group_by=('user_agent',), top_error=TOP_ERROR,
+                 distinct_error=DISTINCT_ERROR, ip_table=None):
+        super().__init__(group_by, ip_table)
+        self.top_error = top_error
+        self.distinct_error = distinct_error
+        self.requests = 0
+        self.heavy_hitters = SpaceSaving(math.ceil(1 / top_error))
+        self.distinct = HyperLogLog(distinct_error)
+
+    @property
+    def spec(self):
+        """The spec creating an empty copy of the report with make_report."""
+        return (self.group_by, (), (self.top_error, self.distinct_error))
+
+    def add(self, fields):
+        """
+        Adds a parsed log line to the report.
+
+        Args:
+            fields (tuple): The values of LOG_FIELDS for the line.
+        """
+        key = self._key(fields)
+        self.requests += 1
+        counts = self.heavy_hitters.counts
+        if key in counts:
+            counts[key] += 1
+        else:
+            self.distinct.add(encode_key(key))
+            self.heavy_hitters.add(key)
+
+    def update(self, other):
+        """
+        Merges another report with the same dimensions and error bounds.
+
+        Args:
+            other (ApproximateReport): The report to merge.
+        """
+        self.requests += other.requests
+        self.heavy_hitters.update(other.heavy_hitters)
+        self.distinct.update(other.distinct)
+
+    def decode(self):
+        """
+        Decodes the undecoded keys of the report.
+
+        Returns:
+            ApproximateReport: A new report keyed by strings.
+        """
+        decoded = ApproximateReport(self.group_by, self.top_error, self.distinct_error)
+        decoded.requests = self.requests
+        decoded.distinct = self.distinct
+        heavy_hitters = decoded.heavy_hitters
+        heavy_hitters.floor = self.heavy_hitters.floor
+        for key, count in self.heavy_hitters.counts.items():
+            text_key = decode_value(key)
+            heavy_hitters.counts[text_key] = heavy_hitters.counts.get(text_key, 0) + count
+            heavy_hitters.errors[text_key] = (heavy_hitters.errors.get(text_key, 0)
+                                              + self.heavy_hitters.errors[key])
+        return decoded
+
+
+class PathTrie:
+    """
+    Counts requests by path in a tree of path segments.
+
+    Every node keeps the number of requests of its own path and the total
+    of its whole subtree, so the requests under any prefix are looked up
+    without visiting the paths below it. Memory grows with the number of
+    distinct segments rather than of distinct paths.
+    """
+
+    __slots__ = ('count', 'total', 'children')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.children = {}
+
+    @staticmethod
+    def segments(path):
+        """Returns the non-empty segments of a path."""
+        return [segment for segment in path.split('/') if segment]
+
+    def add(self, path, count=1):
+        """
+        Adds requests of a path.
+
+        Args:
+            path (str): The path, e.g. /api/items.
+            count (int): The number of requests.
+        """
+        node = self
+        node.total += count
+        for segment in self.segments(path):
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = PathTrie()
+            node = child
+            node.total += count
+        node.count += count
+
+    def find(self, prefix):
+        """
+        Returns the node of a path prefix.
+
+        Args:
+            prefix (str): The prefix, e.g. /api.
+
+        Returns:
+            PathTrie: The node, or None if no request path has the prefix.
+        """
+        node = self
+        for segment in self.segments(prefix):
+            node = node.children.get(segment)
+            if node is None:
+                return None
+        return node
+
+    def rollup(self, prefix='/', depth=2, top=0):
+        """
+        Yields the totals of the prefixes of a subtree, depth first.
+
+        Args:
+            prefix (str): The path of this node.
+            depth (int): The number of segment levels below this node.
+            top (int): The number of children kept per node, the largest
+                first, or 0 for all of them.
+
+        Yields:
+            tuple: The level, prefix and total of every node.
+        """
+        stack = [(0, prefix, self)]
+        while stack:
+            level, path, node = stack.pop()
+            yield level, path, node.total
+            if level == depth:
+                continue
+            children = sorted(node.children.items(), key=lambda item: item[1].total,
+                              reverse=True)
+            if top:
+                children = children[:top]
+            base = path.rstrip('/')
+            stack.extend((level + 1, f"{base}/{segment}", child)
+                         for segment, child in reversed(children))
+
+
+class MalformedLines:
+    """
+    Counts the lines that could not be parsed and keeps the first ones
+    as samples.
+
+    With lenient parsing, lines rejected by parse_log_line are given to
+    parse_lenient_line, and only the lines it rejects too are malformed.
+    """
+
+    def __init__(self, lenient=False, max_samples=MALFORMED_SAMPLES):
+        self.lenient = lenient
+        self.max_samples = max_samples
+        self.count = 0
+        self.recovered = 0
+        self.samples = []
+
+    def add(self, line):
+        """
+        Accounts for a line rejected by parse_log_line. Blank lines are
+        ignored.
+
+        Args:
+            line (bytes): The undecoded log line.
+
+        Returns:
+            tuple: The fields recovered by the lenient parser, or None if
+            the line is malformed or blank.
+        """
+        if line.isspace() or not line:
+            return None
+        if self.lenient:
+            fields = parse_lenient_line(line)
+            if fields is not None:
+                self.recovered += 1
+                return fields
+        self.count += 1
+        if len(self.samples) < self.max_samples:
+            self.samples.append(bytes(line[:MALFORMED_SAMPLE_LENGTH]))
+        return None
+
+    def update(self, other):
+        """
+        Merges the malformed lines of a later part of the logs.
+
+        Args:
+            other (MalformedLines): The malformed lines to merge.
+        """
+        self.count += other.count
+        self.recovered += other.recovered
+        self.samples.extend(other.samples[:self.max_samples - len(self.samples)])
+
+    def decode(self):
+        """
+        Decodes the samples.
+
+        Returns:
+            MalformedLines: A copy with string samples.
+        """
+        decoded = MalformedLines(self.lenient, self.max_samples)
+        decoded.count = self.count
+        decoded.recovered = self.recovered
+        decoded.samples = [decode_value(sample) for sample in self.samples]
+        return decoded
+
+
+def make_report(spec, ip_table=None):
+    """
+    Creates the empty report described by a spec.
+
+    Args:
+        spec (tuple): (group_by, metrics) for a LogReport, or (group_by,
+            metrics, (top_error, distinct_error)) for an ApproximateReport.
+        ip_table (str): The table the asn and country dimensions are looked
+            up in, as accepted by ip_table_identity.
+
+    Returns:
+        LogReport or ApproximateReport: The report.
+    """
+    if len(spec) > 2 and spec[2]:
+        return ApproximateReport(spec[0], *spec[2], ip_table=ip_table)
+    return LogReport(spec[0], spec[1], ip_table)
+
+
+def normalize_specs(specs):
+    """Returns report specs as nested tuples, usable in cache keys."""
+    return tuple(tuple(tuple(part) for part in spec) for spec in specs)
+
+
+class ReportEncoder:
+    """
+    Writes reports in the compact binary format of report files.
+
+    Integers are written as variable-length integers, strings as UTF-8
+    prefixed by their length and group keys as one string per dimension.
+    The undecoded keys of checkpointed reports are written as they are.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def integer(self, value):
+        """Writes a non-negative integer in 7-bit groups."""
+        while value >= 0x80:
+            self.buffer.append(value & 0x7f | 0x80)
+            value >>= 7
+        self.buffer.append(value)
+
+    def number(self, value):
+        """Writes a float."""
+        self.buffer += struct.pack('<d', value)
+
+    def string(self, text):
+        """Writes a string, or undecoded bytes."""
+        data = text if isinstance(text, bytes) else text.encode('utf-8', errors='surrogateescape')
+        self.integer(len(data))
+        self.buffer += data
+
+    def strings(self, texts):
+        """Writes a sequence of strings, prefixed by their number."""
+        self.integer(len(texts))
+        for text in texts:
+            self.string(text)
+
+    def key(self, key):
+        """Writes a group key, a string or a tuple of strings."""
+        for part in key if isinstance(key, tuple) else (key,):
+            self.string(part)
+
+    def report(self, report):
+        """
+        Writes a report.
+
+        Args:
+            report (LogReport or ApproximateReport): The report, keyed by
+                strings or by undecoded bytes.
+        """
+        approximate = isinstance(report, ApproximateReport)
+        self.integer(int(approximate))
+        self.strings(report.group_by)
+        if approximate:
+            self.number(report.top_error)
+            self.number(report.distinct_error)
+            self.integer(report.requests)
+            self.integer(report.heavy_hitters.floor)
+            self.integer(len(report.heavy_hitters.counts))
+            for key, count in report.heavy_hitters.counts.items():
+                self.key(key)
+                self.integer(count)
+                self.integer(report.heavy_hitters.errors[key])
+            self.buffer += report.distinct.registers
+            return
+        self.strings(report.metrics)
+        self.integer(len(report.counts))
+        for key, count in report.counts.items():
+            self.key(key)
+            self.integer(count)
+            if 'bytes' in report.metrics:
+                self.integer(report.sizes[key])
+            if 'ips' in report.metrics:
+                self.strings(sorted(report.ips.get(key, ())))
+
+
+class ReportDecoder:
+    """
+    Reads reports written by ReportEncoder.
+    """
+
+    def __init__(self, data, decoded=True):
+        """
+        Args:
+            data (bytes): The encoded reports.
+            decoded (bool): Whether strings are decoded, or read as the
+                undecoded bytes of checkpointed reports.
+        """
+        self.data = data
+        self.position = 0
+        self.decoded = decoded
+
+    def integer(self):
+        """Reads a non-negative integer."""
+        value = shift = 0
+        while True:
+            byte = self.data[self.position]
+            self.position += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def number(self):
+        """Reads a float."""
+        value, = struct.unpack_from('<d', self.data, self.position)
+        self.position += 8
+        return value
+
+    def raw(self, size):
+        """Reads a number of bytes."""
+        data = self.data[self.position:self.position + size]
+        if len(data) != size:
+            raise IndexError("truncated report data")
+        self.position += size
+        return data
+
+    def string(self):
+        """Reads a string, or undecoded bytes."""
+        data = self.raw(self.integer())
+        return data.decode('utf-8', errors='surrogateescape') if self.decoded else bytes(data)
+
+    def strings(self):
+        """Reads a sequence of strings."""
+        return tuple(self.string() for _ in range(self.integer()))
+
+    def names(self):
+        """Reads a sequence of dimension or metric names, always decoded."""
+        count = self.integer()
+        return tuple(self.raw(self.integer()).decode('utf-8') for _ in range(count))
+
+    def key(self, dimensions):
+        """Reads a group key of a number of dimensions."""
+        if dimensions == 1:
+            return self.string()
+        return tuple(self.string() for _ in range(dimensions))
+
+    def report(self):
+        """
+        Reads a report.
+
+        Returns:
+            LogReport or ApproximateReport: The report.
+        """
+        approximate = self.integer()
+        group_by = self.names()
+        dimensions = len(group_by)
+        if approximate:
+            report = ApproximateReport(group_by, self.number(), self.number())
+            report.requests = self.integer()
+            heavy_hitters = report.heavy_hitters
+            heavy_hitters.floor = self.integer()
+            for _ in range(self.integer()):
+                key = self.key(dimensions)
+                heavy_hitters.counts[key] = self.integer()
+                heavy_hitters.errors[key] = self.integer()
+            report.distinct.registers = bytearray(self.raw(len(report.distinct.registers)))
+            return report
+        report = LogReport(group_by, self.names())
+        for _ in range(self.integer()):
+            key = self.key(dimensions)
+            report.counts[key] = self.integer()
+            if 'bytes' in report.metrics:
+                report.sizes[key] = self.integer()
+            if 'ips' in report.metrics:
+                report.ips[key] = set(self.strings())
+        return report
+
+
+def save_reports(file_path, reports):
+    """
+    Saves decoded reports to a compressed binary report file.
+
+    Args:
+        file_path (str): The path to the report file.
+        reports (list): The decoded reports.
+    """
+    encoder = ReportEncoder()
+    encoder.integer(len(reports))
+    for report in reports:
+        encoder.report(report)
+    with open(file_path, 'wb') as file:
+        file.write(REPORT_FILE_MAGIC + bytes([REPORT_FILE_VERSION]))
+        file.write(zlib.compress(encoder.buffer, 6))
+
+
+def load_reports(file_path):
+    """
+    Loads the reports of a report file written by save_reports.
+
+    Args:
+        file_path (str): The path to the report file.
+
+    Returns:
+        list: The decoded reports.
+
+    Raises:
+        ValueError: If the file is not a valid report file.
+    """
+    with open(file_path, 'rb') as file:
+        header = file.read(len(REPORT_FILE_MAGIC) + 1)
+        if header != REPORT_FILE_MAGIC + bytes([REPORT_FILE_VERSION]):
+            raise ValueError(f"'{file_path}' is not a report file of version "
+                             f"{REPORT_FILE_VERSION}.")
+        data = file.read()
+    try:
+        decoder = ReportDecoder(zlib.decompress(data))
+        return [decoder.report() for _ in range(decoder.integer())]
+    except (zlib.error, IndexError, struct.error, ValueError) as error:
+        raise ValueError(f"'{file_path}' is damaged: {error}") from error
+
+
+def merge_reports(report_lists):
+    """
+    Merges lists of reports built with the same specs, report by report.
+
+    Merging is associative, so partial reports can be combined in any
+    grouping, e.g. per server and then per data center.
+
+    Args:
+        report_lists (iterable): Lists of decoded reports.
+
+    Returns:
+        list: The merged reports.
+
+    Raises:
+        ValueError: If the lists were not built with the same specs.
+    """
+    merged = None
+    for reports in report_lists:
+        if merged is None:
+            merged = [make_report(report.spec) for report in reports]
+        if [report.spec for report in reports] != [report.spec for report in merged]:
+            raise ValueError("Reports built with different options cannot be merged.")
+        for report, partial in zip(merged, reports):
+            report.update(partial)
+    return merged or []
@@ -0,0 +1,142 @@
+"""
+Fixed-memory sketches of approximate reports: SpaceSaving for the top
+keys and HyperLogLog for the number of distinct keys.
+"""
+
+import math
+import heapq
+import hashlib
+from operator import itemgetter
+
+# Default error bounds of approximate reports: top counts, as a fraction
+# of all requests, and distinct count, as a relative standard error
+TOP_ERROR = 0.001
+DISTINCT_ERROR = 0.01
+
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct values in a fixed number of bytes.
+
+    Values are hashed with BLAKE2, which unlike hash() is the same in every
+    process, so sketches built by different workers can be merged.
+    """
+
+    def __init__(self, error=DISTINCT_ERROR):
+        self.precision = min(18, max(4, math.ceil(math.log2((1.04 / error) ** 2))))
+        self.registers = bytearray(1 << self.precision)
+
+    @property
+    def error(self):
+        """The relative standard error of the estimate."""
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add(self, value):
+        """
+        Adds a value to the sketch.
+
+        Args:
+            value (bytes): The value.
+        """
+        hashed = int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'big')
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        """
+        Merges a sketch of the same precision into this one.
+
+        Args:
+            other (HyperLogLog): The sketch to merge.
+        """
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self):
+        """
+        Returns the estimated number of distinct values added.
+
+        Returns:
+            int: The estimate.
+        """
+        size = len(self.registers)
+        estimate = (0.7213 / (1 + 1.079 / size) * size * size
+                    / sum(2.0 ** -rank for rank in self.registers))
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            estimate = size * math.log(size / zeros)
+        return round(estimate)
+
+
+class SpaceSaving:
+    """
+    Tracks the most frequent keys of a stream in bounded memory.
+
+    At most twice the capacity keys are counted; when that is exceeded,
+    only the capacity most frequent ones are kept and the floor becomes
+    the largest count dropped. A key (re)entering starts at the floor plus
+    one, with the floor as its error, so its true count always lies
+    between its count minus its error and its count.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.floor = 0
+
+    def add(self, key):
+        """
+        Counts one occurrence of a key.
+
+        Args:
+            key: The key.
+        """
+        if key in self.counts:
+            self.counts[key] += 1
+            return
+        self.counts[key] = self.floor + 1
+        self.errors[key] = self.floor
+        if len(self.counts) > 2 * self.capacity:
+            self._prune()
+
+    def _prune(self):
+        """Keeps only the capacity most frequent keys."""
+        ranked = sorted(self.counts.items(), key=itemgetter(1), reverse=True)
+        self.floor = max(self.floor, ranked[self.capacity][1])
+        self.counts = dict(ranked[:self.capacity])
+        self.errors = {key: self.errors[key] for key in self.counts}
+
+    def update(self, other):
+        """
+        Merges another summary into this one.
+
+        A key missing from a summary may have been counted up to its floor
+        there, so the floor is added to its count and error.
+
+        Args:
+            other (SpaceSaving): The summary to merge.
+        """
+        counts, errors = {}, {}
+        for key in self.counts.keys() | other.counts.keys():
+            counts[key] = self.counts.get(key, self.floor) + other.counts.get(key, other.floor)
+            errors[key] = self.errors.get(key, self.floor) + other.errors.get(key, other.floor)
+        self.counts, self.errors = counts, errors
+        self.floor += other.floor
+        if len(self.counts) > 2 * self.capacity:
+            self._prune()
+
+    def top(self, count):
+        """
+        Returns the most frequent keys.
+
+        Args:
+            count (int): The number of keys to return.
+
+        Returns:
+            list: (key, count, error) tuples, most frequent first.
+        """
+        return [(key, value, self.errors[key]) for key, value
+                in heapq.nlargest(count, self.counts.items(), key=itemgetter(1))]
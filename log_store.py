@@ -0,0 +1,251 @@
+"""
+SQLite log stores: ingesting parsed requests, only the lines appended
+since the previous ingest, and answering reports with SQL.
+"""
+
+import sqlite3
+
+from log_formats import parse_log_time, request_size, request_status_code
+from log_reports import LogReport
+from log_checkpoint import dump_log_states, load_log_states, update_log_states
+
+# Version of the schema of log stores and number of rows inserted into
+# them per executemany() call
+STORE_VERSION = 2
+STORE_BATCH_SIZE = 50000
+
+# Tables of log stores: the parsed requests, with their time as a Unix
+# timestamp, and the schema version and ingested log states, as JSON
+STORE_TABLES = (
+    'CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value)',
+    'CREATE TABLE IF NOT EXISTS requests (time INTEGER, ip TEXT, user TEXT, method TEXT, '
+    'path TEXT, protocol TEXT, status INTEGER, size INTEGER, referer TEXT, user_agent TEXT)',
+)
+STORE_INSERT = 'INSERT INTO requests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+STORE_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS requests_time ON requests (time)',
+    'CREATE INDEX IF NOT EXISTS requests_status ON requests (status, time)',
+    'CREATE INDEX IF NOT EXISTS requests_user_agent ON requests (user_agent, time)',
+)
+
+# SQL expressions of the dimensions log stores can be grouped by; days
+# and hours are in UTC
+STORE_DIMENSIONS = {
+    'ip': 'ip',
+    'user': 'user',
+    'day': "strftime('%Y-%m-%d', time, 'unixepoch')",
+    'hour': "strftime('%Y-%m-%d %H', time, 'unixepoch')",
+    'method': 'method',
+    'path': 'path',
+    'protocol': 'protocol',
+    'endpoint': "CASE WHEN instr(path, '?') THEN substr(path, 1, instr(path, '?') - 1) "
+                "ELSE path END",
+    'status': 'status',
+    'status_class': "(status / 100) || 'xx'",
+    'referer': 'referer',
+    'user_agent': 'user_agent',
+}
+
+
+def open_log_store(database_path):
+    """
+    Opens a SQLite log store, creating its tables if needed.
+
+    The database is switched to write-ahead logging, so that queries can
+    run while logs are ingested, and only synced at checkpoints.
+
+    Args:
+        database_path (str): The path to the database file.
+
+    Returns:
+        sqlite3.Connection: The connection to the store.
+
+    Raises:
+        ValueError: If the file is not a log store of this version.
+    """
+    connection = sqlite3.connect(database_path)
+    try:
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with connection:
+            for statement in STORE_TABLES:
+                connection.execute(statement)
+            row = connection.execute(
+                "SELECT value FROM metadata WHERE name = 'version'").fetchone()
+            if row is None:
+                connection.execute("INSERT INTO metadata VALUES ('version', ?)",
+                                   (STORE_VERSION,))
+            elif row[0] != STORE_VERSION:
+                raise ValueError(f"'{database_path}' is a log store of version {row[0]}, "
+                                 f"expected {STORE_VERSION}.")
+    except sqlite3.DatabaseError as error:
+        connection.close()
+        raise ValueError(f"'{database_path}' is not a log store: {error}") from error
+    except ValueError:
+        connection.close()
+        raise
+    return connection
+
+
+class LogStoreWriter:
+    """
+    Inserts parsed log lines into the requests table of a log store.
+
+    Rows are buffered and inserted with one executemany() call per batch,
+    inside the transaction of the caller.
+    """
+
+    def __init__(self, connection, batch_size=STORE_BATCH_SIZE):
+        self.connection = connection
+        self.batch_size = batch_size
+        self.rows = 0
+        self._batch = []
+
+    def add(self, fields):
+        """
+        Adds a parsed log line to the current batch.
+
+        Args:
+            fields (tuple): The values of LOG_FIELDS for the line.
+        """
+        method, path, protocol = (fields[4].split(b' ', 2) + [b'', b''])[:3]
+        self._batch.append((
+            parse_log_time(fields[3]),
+            str(fields[0], 'utf-8', 'replace'),
+            str(fields[2], 'utf-8', 'replace'),
+            str(method, 'utf-8', 'replace'),
+            str(path, 'utf-8', 'replace'),
+            str(protocol, 'utf-8', 'replace'),
+            request_status_code(fields),
+            request_size(fields),
+            str(fields[7], 'utf-8', 'replace'),
+            str(fields[8], 'utf-8', 'replace'),
+        ))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Inserts the rows of the current batch."""
+        if self._batch:
+            self.connection.executemany(STORE_INSERT, self._batch)
+            self.rows += len(self._batch)
+            self._batch.clear()
+
+
+def ingest_access_logs(file_paths, database_path, log_format=None):
+    """
+    Loads the lines of log files into a log store.
+
+    The store records the state of every log like a checkpoint, so that
+    ingesting a log again only loads the lines appended since, even after
+    it was rotated. All rows are inserted in a single transaction, with
+    the new log states, and the indexes are created after the first load
+    rather than updated row by row.
+
+    Args:
+        file_paths (list): The paths to the log files.
+        database_path (str): The path to the database file.
+        log_format (str): The format of the logs, as accepted by
+            compile_log_format.
+
+    Returns:
+        int: The number of requests inserted.
+
+    Raises:
+        ValueError: If the file is not a log store of this version, or its
+            log states are damaged.
+    """
+    connection = open_log_store(database_path)
+    try:
+        with connection:
+            row = connection.execute(
+                "SELECT value FROM metadata WHERE name = 'logs'").fetchone()
+            writer = LogStoreWriter(connection)
+            states, unmatched = update_log_states(
+                file_paths, load_log_states(row[0]) if row else [], [writer], log_format)
+            writer.flush()
+            for statement in STORE_INDEXES:
+                connection.execute(statement)
+            connection.execute("INSERT OR REPLACE INTO metadata VALUES ('logs', ?)",
+                               (dump_log_states(states + unmatched),))
+    finally:
+        connection.close()
+    return writer.rows
+
+
+def query_log_store(database_path, group_by=('user_agent',), metrics=(), time_range=None,
+                    where=None):
+    """
+    Builds a report from the requests of a log store with a SQL GROUP BY,
+    which the indexes of the store serve when filtering by time.
+
+    Args:
+        database_path (str): The path to the database file.
+        group_by (tuple): The names of the dimensions, among STORE_DIMENSIONS.
+        metrics (tuple): The metrics of the report; only 'bytes' is stored.
+        time_range (tuple): The (since, until) timestamps of the requests
+            counted, either of which may be None, or None for all requests.
+        where (str): An extra SQL condition on the columns of the requests
+            table, e.g. "status >= 500".
+
+    Returns:
+        LogReport: The decoded report.
+
+    Raises:
+        ValueError: If a dimension or metric cannot be queried, or the file
+            is not a log store of this version.
+        sqlite3.Error: If the condition is not valid SQL.
+    """
+    unknown = [name for name in group_by if name not in STORE_DIMENSIONS]
+    unknown += [name for name in metrics if name != 'bytes']
+    if unknown:
+        raise ValueError(f"Cannot query the log store by: {', '.join(unknown)}")
+    report = LogReport(group_by, metrics)
+    expressions = ', '.join(STORE_DIMENSIONS[name] for name in group_by)
+    conditions, parameters = [], []
+    if time_range is not None:
+        for operator, value in zip(('>=', '<'), time_range):
+            if value is not None:
+                conditions.append(f"time {operator} ?")
+                parameters.append(value)
+    if where:
+        conditions.append(f"({where})")
+    sql = (f"SELECT {expressions}, COUNT(*), TOTAL(size) FROM requests"
+           + (f" WHERE {' AND '.join(conditions)}" if conditions else "")
+           + f" GROUP BY {expressions}")
+    dimensions = len(group_by)
+    connection = open_log_store(database_path)
+    try:
+        for row in connection.execute(sql, parameters):
+            values = tuple('-' if value is None else str(value) for value in row[:dimensions])
+            key = values if dimensions > 1 else values[0]
+            report.counts[key] += row[dimensions]
+            if metrics:
+                report.sizes[key] += int(row[dimensions + 1])
+    finally:
+        connection.close()
+    return report
+
+
+def execute_store_query(database_path, sql):
+    """
+    Runs a SQL statement on a log store.
+
+    Args:
+        database_path (str): The path to the database file.
+        sql (str): The statement, e.g. a SELECT on the requests table.
+
+    Returns:
+        tuple: The column names and the list of rows of the result.
+
+    Raises:
+        ValueError: If the file is not a log store of this version.
+        sqlite3.Error: If the statement is not valid SQL.
+    """
+    connection = open_log_store(database_path)
+    try:
+        cursor = connection.execute(sql)
+        columns = [column[0] for column in cursor.description or ()]
+        return columns, cursor.fetchall()
+    finally:
+        connection.close()
@@ -1,68 +1,950 @@
 """
-This script analyzes an Apache access log file and counts the occurrences
+This script analyzes Apache access log files and counts the occurrences
 of each User-Agent in the log entries.
 
+Requests can also be grouped by other dimensions (status, IP, path,
+hour, ...) with extra metrics, all computed in a single pass over the
+logs. Logs compressed with gzip, bzip2 or xz are detected by their magic
+bytes and decompressed on the fly, several logs (or glob patterns) are
+analyzed in parallel processes, and large plain logs are split into
+line-aligned byte ranges parsed separately. Lines are parsed as bytes;
+only the extracted values are decoded.
+
+With --cache-dir, parsed results are reused while a log file is
+unchanged. With --checkpoint, only the lines appended since the previous
+run are parsed. With --follow, a live log is watched and the top
+User-Agents of the last minutes are printed periodically. With
+--approximate, the top groups and the number of distinct groups are
+estimated in fixed memory, however many distinct keys the logs hold.
+With --since and --until, only the requests of a time range are counted;
+in plain logs, which are sorted by time, the matching byte range is
+found by binary search so that the rest of the log is not read. With
+--time-index, a sidecar index mapping times to offsets is maintained next
+to each plain or gzip log, so time ranges are found without searching and
+gzip logs made of several members are split into ranges of members.
+Logs in other formats are read with --format: Common Log Format, the
+nginx combined format, JSON lines or any Apache LogFormat or nginx
+log_format string, compiled once into a line parser.
+Lines that cannot be parsed are counted and a few of them are shown;
+with --lenient, a tolerant parser recovers what it can from them.
+User-Agents can also be classified into browser family and version,
+operating system and bots, each distinct agent being classified once.
+Request paths can be stripped of their query string and templated, e.g.
+/user/123 to /user/{id}, and --path-tree rolls their counts up along path
+segments, e.g. all requests under /api.
+Client addresses can be grouped by subnet and, with --ip-table, by the
+autonomous system and country of a local CIDR table.
+With --detect, the User-Agents, IP addresses and status classes whose
+request rate spikes far above their exponentially decayed baseline are
+flagged, live with --follow, at a constant cost per line and in bounded
+memory.
+The ingest command loads parsed requests into a SQLite database, only
+adding the lines appended since the previous ingest, and the query
+command answers reports and SQL statements from it using its indexes.
+The export command writes parsed requests to a compressed column file,
+in row groups holding each column separately with dictionary-encoded
+strings; such files are analyzed like logs, counting codes instead of
+parsing lines.
+With --save, the reports are written to a compact binary file; the merge
+command combines such files, e.g. the partial reports of several web
+servers, without their raw logs. With NumPy
+installed, load_log_columns() of log_analysis loads logs into compact
+column arrays for vectorized filtering and group-bys.
+
+This script holds the command line and the output of reports; the parsing
+and analysis live in the log_* modules next to it.
+
 Usage:
-    python script.py <access_log_file>
+    python script.py [options] <access_log_file> [<access_log_file> ...]
+    python script.py --follow [options] <access_log_file>
+    python script.py --detect [--follow] [options] <access_log_file> [...]
+    python script.py merge [-o <output_file>] <report_file> [...]
+    python script.py ingest <database> <access_log_file> [...]
+    python script.py query [options] <database>
+    python script.py export <column_file> <access_log_file> [...]
 """
 
+import os
 import sys
-import re
-from collections import Counter
-
-# Regular expression pattern for Apache Combined Log Format
-log_pattern = re.compile(r'''
-    (?P<ip>\S+)                    # IP address
-    \s+
-    (?P<identd>\S+)                # identd
-    \s+
-    (?P<user>\S+)                  # userid
-    \s+
-    \[(?P<date>.*?)\]              # date
-    \s+
-    "(?P<request>.*?)"             # request
-    \s+
-    (?P<status>\d{3})              # status code
-    \s+
-    (?P<size>\S+)                  # size
-    \s+
-    "(?P<referer>.*?)"             # referer
-    \s+
-    "(?P<user_agent>.*?)"          # user agent
-    ''', re.VERBOSE)
-
-def parse_access_log(file_path):
-    """
-    Parses an Apache access log file and counts User-Agent occurrences.
-
-    Args:
-        file_path (str): The path to the log file.
+import csv
+import json
+import heapq
+import sqlite3
+import argparse
+import contextlib
+from operator import itemgetter
+
+from log_formats import LOG_FORMATS, compile_log_format, parse_time_option
+from log_files import CHUNK_SIZE, exit_on_read_error, expand_log_paths
+from log_sketches import DISTINCT_ERROR, TOP_ERROR
+from log_dimensions import DIMENSIONS, agent_cache_stats, ip_table_identity, load_ip_table
+from log_reports import (
+    MALFORMED_SAMPLES, METRICS, ApproximateReport, MalformedLines, PathTrie, load_reports,
+    make_report, merge_reports, save_reports,
+)
+from log_columns import ROW_GROUP_SIZE
+from log_analysis import analyze_access_logs, export_log_columns, is_private_path
+from log_checkpoint import analyze_appended_logs
+from log_store import STORE_DIMENSIONS, execute_store_query, ingest_access_logs, query_log_store
+from log_follow import (
+    ANOMALY_BASELINE_HALF_LIFE, ANOMALY_DIMENSIONS, ANOMALY_FACTOR, ANOMALY_HALF_LIFE,
+    ANOMALY_MAX_KEYS, ANOMALY_MIN_RATE, FOLLOW_WINDOWS, RateAnomalyDetector, detect_log_anomalies,
+    follow_access_log, format_alert,
+)
+
+# Formats reports can be written in and the buffer size of the output
+OUTPUT_FORMATS = ('text', 'csv', 'json', 'ndjson')
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+
+def write_query_rows(out, columns, rows, output_format='text'):
+    """
+    Writes the result of a SQL query in one of OUTPUT_FORMATS.
+
+    Args:
+        out (file): The text stream written to.
+        columns (list): The column names.
+        rows (list): The rows, as tuples.
+        output_format (str): One of OUTPUT_FORMATS.
+    """
+    if output_format in ('json', 'ndjson'):
+        objects = (dict(zip(columns, row)) for row in rows)
+        if output_format == 'json':
+            out.write(json.dumps(list(objects), ensure_ascii=False) + '\n')
+        else:
+            out.writelines(json.dumps(item, ensure_ascii=False) + '\n' for item in objects)
+    elif output_format == 'csv':
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(columns)
+        writer.writerows(rows)
+    else:
+        out.write(' | '.join(columns) + '\n')
+        out.writelines(' | '.join('-' if value is None else str(value) for value in row)
+                       + '\n' for row in rows)
+
+
+def print_malformed_lines(malformed):
+    """
+    Prints the number of malformed and recovered lines and the samples
+    to stderr, if there are any.
+
+    Args:
+        malformed (MalformedLines): The decoded malformed lines.
+    """
+    if malformed.recovered:
+        print(f"Recovered {malformed.recovered} lines with the lenient parser.",
+              file=sys.stderr)
+    if malformed.count:
+        print(f"Skipped {malformed.count} malformed lines"
+              + (", such as:" if malformed.samples else "."), file=sys.stderr)
+        for sample in malformed.samples:
+            print(f"  {sample}", file=sys.stderr)
+
+
+def top_groups(report, top=10, sort=False):
+    """
+    Returns the groups of an exact report to output, with their counts.
+
+    Args:
+        report (LogReport): The decoded report.
+        top (int): The number of groups returned when sorting, or 0 for
+            all of them.
+        sort (bool): Whether groups are sorted by decreasing count; the
+            top groups are selected with a heap instead of a full sort.
+
+    Returns:
+        iterable: The (key, count) pairs, in insertion order unless sorted.
+    """
+    if not sort:
+        return report.counts.items()
+    if top:
+        return heapq.nlargest(top, report.counts.items(), key=itemgetter(1))
+    return sorted(report.counts.items(), key=itemgetter(1), reverse=True)
+
+
+def key_parts(key):
+    """Returns the values of a group key as a tuple."""
+    return key if isinstance(key, tuple) else (key,)
+
+
+def report_table(report, top=10, sort=False):
+    """
+    Returns the groups of a report as rows of a table.
+
+    Args:
+        report (LogReport or ApproximateReport): The decoded report.
+        top (int): The number of groups of approximate reports and of
+            sorted exact reports, or 0 for all of them.
+        sort (bool): Whether the groups of exact reports are sorted.
+
+    Returns:
+        tuple: The column names and an iterable of rows, each a list of
+        the dimension values followed by the metrics.
+    """
+    if isinstance(report, ApproximateReport):
+        hitters = report.heavy_hitters
+        columns = list(report.group_by) + ['requests', 'error']
+        rows = ([*key_parts(key), count, error]
+                for key, count, error in hitters.top(top or len(hitters.counts)))
+        return columns, rows
+    columns = list(report.group_by) + ['requests'] + list(report.metrics)
+
+    def exact_rows():
+        for key, count in top_groups(report, top, sort):
+            row = [*key_parts(key), count]
+            if 'bytes' in report.metrics:
+                row.append(report.sizes[key])
+            if 'ips' in report.metrics:
+                row.append(len(report.ips.get(key, ())))
+            yield row
+
+    return columns, exact_rows()
+
+
+def write_approximate_report(out, report, top):
+    """
+    Writes the estimated number of groups and top groups of a report.
+
+    Args:
+        out (file): The text stream written to.
+        report (ApproximateReport): The decoded report.
+        top (int): The number of top groups printed.
+    """
+    out.write(f"Estimated number of different {report.plural_label}: "
+              f"{report.distinct.estimate()} (±{report.distinct.error:.1%})\n")
+    out.write(f"Top {top} {report.plural_label} by approximate number of requests "
+              f"(of {report.requests}):\n")
+    for key, count, error in report.heavy_hitters.top(top):
+        text = ' | '.join(key) if isinstance(key, tuple) else key
+        out.write(f"{text}: {count}"
+                  + (f" (overestimated by at most {error})" if error else "") + "\n")
+
+
+def write_text_report(out, report, top=10, sort=False):
+    """
+    Writes the groups of a report with their request counts and metrics.
+
+    Args:
+        out (file): The text stream written to.
+        report (LogReport or ApproximateReport): The decoded report.
+        top (int): The number of top groups written for approximate and
+            sorted reports, or 0 for all of them.
+        sort (bool): Whether the groups of exact reports are sorted by
+            decreasing count.
+    """
+    if isinstance(report, ApproximateReport):
+        write_approximate_report(out, report, top)
+        return
+    out.write(f"Total number of different {report.plural_label}: {len(report.counts)}\n")
+    if sort and top:
+        out.write(f"Top {top} {report.plural_label} by number of requests:\n")
+    else:
+        out.write(f"Number of requests from each {report.label}:\n")
+    lines = []
+    for key, count in top_groups(report, top, sort):
+        line = f"{' | '.join(key) if isinstance(key, tuple) else key}: {count}"
+        if 'bytes' in report.metrics:
+            line += f", bytes={report.sizes[key]}"
+        if 'ips' in report.metrics:
+            line += f", ips={len(report.ips.get(key, ()))}"
+        lines.append(line)
+        if len(lines) >= 4096:
+            out.write('\n'.join(lines) + '\n')
+            lines.clear()
+    if lines:
+        out.write('\n'.join(lines) + '\n')
+
+
+def report_summary(report):
+    """Returns the number of groups of a report, estimated if approximate."""
+    if isinstance(report, ApproximateReport):
+        return {'estimated_groups': report.distinct.estimate(), 'requests': report.requests}
+    return {'groups': len(report.counts)}
+
+
+def write_reports(out, reports, output_format='text', top=10, sort=False, path_tree=None):
+    """
+    Writes reports in a human-readable or machine-readable format.
+
+    Text and CSV reports are separated by blank lines. JSON output is a
+    list with one object per report, NDJSON output one object per group
+    tagged with the dimensions of its report. A path tree is written last,
+    as a table of the level, prefix and requests of each prefix, or as an
+    indented tree in text output.
+
+    Args:
+        out (file): The text stream written to, ideally buffered.
+        reports (list): The decoded reports.
+        output_format (str): One of OUTPUT_FORMATS.
+        top (int): The number of top groups written for approximate and
+            sorted reports, or 0 for all of them.
+        sort (bool): Whether the groups of exact reports are sorted by
+            decreasing count.
+        path_tree (tuple): The report, prefix, depth and top of a path
+            tree, as taken by write_path_tree, or None.
+    """
+    tree_columns = ('level', 'prefix', 'requests')
+    if output_format == 'json':
+        documents = []
+        for report in reports:
+            columns, rows = report_table(report, top, sort)
+            documents.append(dict(group_by=list(report.group_by), **report_summary(report),
+                                  rows=[dict(zip(columns, row)) for row in rows]))
+        if path_tree is not None:
+            documents.append(dict(path_tree=list(path_tree[0].group_by),
+                                  rows=[dict(zip(tree_columns, row))
+                                        for row in path_tree_rows(*path_tree)]))
+        out.write(json.dumps(documents, ensure_ascii=False) + '\n')
+        return
+    for index, report in enumerate(reports):
+        if output_format == 'ndjson':
+            # Rows are formatted into a template of their object: encoding
+            # them with json.dumps one by one would cost more than parsing
+            columns, rows = report_table(report, top, sort)
+            quote = json.encoder.encode_basestring
+            dimensions = len(report.group_by)
+            template = ', '.join([f'{{"report": {quote(",".join(report.group_by))}']
+                                 + [f'{quote(column)}: %s' for column in columns]) + '}\n'
+            out.writelines(template % (*map(quote, row[:dimensions]), *row[dimensions:])
+                           for row in rows)
+            continue
+        if index:
+            out.write('\n')
+        if output_format == 'csv':
+            columns, rows = report_table(report, top, sort)
+            writer = csv.writer(out, lineterminator='\n')
+            writer.writerow(columns)
+            writer.writerows(rows)
+        else:
+            write_text_report(out, report, top, sort)
+    if path_tree is None:
+        return
+    if output_format == 'ndjson':
+        out.writelines(json.dumps(dict(report='path_tree', **dict(zip(tree_columns, row))),
+                                  ensure_ascii=False) + '\n'
+                       for row in path_tree_rows(*path_tree))
+        return
+    if reports:
+        out.write('\n')
+    if output_format == 'csv':
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(tree_columns)
+        writer.writerows(path_tree_rows(*path_tree))
+    else:
+        write_path_tree(out, *path_tree)
+
+
+def path_tree_rows(report, prefix='/', depth=2, top=0):
+    """
+    Returns the requests under each path prefix of a report, depth first.
+
+    Args:
+        report (LogReport): A decoded report grouped by route, endpoint or
+            path.
+        prefix (str): The prefix at the root of the tree.
+        depth (int): The number of segment levels returned below the root.
+        top (int): The number of children returned per prefix, the
+            largest first, or 0 for all of them.
 
     Returns:
-        Counter: A Counter object with User-Agent strings as keys and their
-        counts as values.
+        list: The (level, prefix, requests) of every prefix.
+    """
+    tree = PathTrie()
+    for path, count in report.counts.items():
+        tree.add(path, count)
+    node = tree.find(prefix)
+    if node is None:
+        return [(0, prefix, 0)]
+    return list(node.rollup(prefix, depth, top))
+
+
+def write_path_tree(out, report, prefix='/', depth=2, top=0):
+    """
+    Writes the requests under each path prefix as an indented tree.
+
+    Args:
+        out (file): The text stream written to.
+        report (LogReport): A decoded report grouped by route, endpoint or
+            path.
+        prefix (str): The prefix at the root of the tree.
+        depth (int): The number of segment levels written below the root.
+        top (int): The number of children written per prefix, the
+            largest first, or 0 for all of them.
     """
-    user_agents = []
+    out.write(f"Number of requests under each {report.label} prefix:\n")
+    out.writelines(f"{'  ' * level}{path}: {total}\n"
+                   for level, path, total in path_tree_rows(report, prefix, depth, top))
+
+
+@contextlib.contextmanager
+def open_output(file_path=None):
+    """
+    Opens the buffered text stream reports are written to.
+
+    Args:
+        file_path (str): The path of the output file, or None or '-' for
+            the standard output.
+
+    Yields:
+        file: The text stream, flushed when the context exits.
+    """
+    if file_path in (None, '-'):
+        sys.stdout.flush()
+        out = open(sys.stdout.fileno(), 'w', buffering=OUTPUT_BUFFER_SIZE,
+                   encoding=sys.stdout.encoding, errors=sys.stdout.errors, closefd=False)
+    else:
+        out = open(file_path, 'w', buffering=OUTPUT_BUFFER_SIZE, encoding='utf-8')
+    with out:
+        yield out
+
+
+def merge_main(arguments):
+    """
+    Merges report files and prints, and optionally saves, the result.
+
+    Args:
+        arguments (list): The command-line arguments after 'merge'.
+    """
+    parser = argparse.ArgumentParser(
+        prog="task1_3.py merge",
+        description="Merge report files saved with --save, e.g. on several servers."
+    )
+    parser.add_argument("report_files", nargs="+",
+                        help="Report files or glob patterns.")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Save the merged reports to this report file.")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of groups printed per approximate or --sort "
+                             "report, 0 for all (default: %(default)s).")
+    parser.add_argument("--sort", action="store_true",
+                        help="Print the groups of exact reports by decreasing count.")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="text",
+                        help="Format of the printed reports (default: %(default)s).")
+    args = parser.parse_args(arguments)
+
+    report_lists = []
+    for file_path in expand_log_paths(args.report_files):
+        with exit_on_read_error(file_path):
+            try:
+                report_lists.append(load_reports(file_path))
+            except ValueError as error:
+                print(f"Error: {error}")
+                sys.exit(1)
     try:
-        with open(file_path, 'r', encoding='utf-8', errors='replace') as file:
-            for line in file:
-                match = log_pattern.match(line)
-                if match:
-                    user_agents.append(match.group('user_agent'))
-    except FileNotFoundError:
-        print(f"Error: File '{file_path}' not found.")
+        reports = merge_reports(report_lists)
+    except ValueError as error:
+        print(f"Error: {error}")
         sys.exit(1)
-    return Counter(user_agents)
+    if args.output:
+        save_reports(args.output, reports)
+    with open_output() as out:
+        write_reports(out, reports, args.output_format, args.top, args.sort)
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python script.py <access_log_file>")
+
+def ingest_main(arguments):
+    """
+    Loads access logs into a log store and prints the number of requests
+    inserted.
+
+    Args:
+        arguments (list): The command-line arguments after 'ingest'.
+    """
+    parser = argparse.ArgumentParser(
+        prog="task1_3.py ingest",
+        description="Load access logs into a SQLite log store for 'task1_3.py query'. "
+                    "Logs ingested before only load their appended lines."
+    )
+    parser.add_argument("database", help="SQLite database file, created if needed.")
+    parser.add_argument("log_files", nargs="+",
+                        help="Access log files or glob patterns, optionally compressed.")
+    parser.add_argument("--format", default=None, dest="log_format",
+                        help=f"Log format: one of {', '.join(LOG_FORMATS)} or an Apache "
+                             "LogFormat or nginx log_format string (default: combined).")
+    args = parser.parse_args(arguments)
+    try:
+        compile_log_format(args.log_format)
+    except ValueError as error:
+        parser.error(str(error))
+
+    try:
+        rows = ingest_access_logs(expand_log_paths(args.log_files), args.database,
+                                  args.log_format)
+    except (ValueError, sqlite3.Error) as error:
+        print(f"Error: {error}")
         sys.exit(1)
+    print(f"Ingested {rows} requests into '{args.database}'.")
 
-    log_file_path = sys.argv[1]
-    user_agent_counts = parse_access_log(log_file_path)
 
-    print(f"Total number of different User Agents: {len(user_agent_counts)}")
-    print("Number of requests from each User Agent:")
-    for agent, count in user_agent_counts.items():
-        print(f"{agent}: {count}")
+def query_main(arguments):
+    """
+    Prints a report, or the result of a SQL statement, from a log store.
+
+    Args:
+        arguments (list): The command-line arguments after 'query'.
+    """
+    parser = argparse.ArgumentParser(
+        prog="task1_3.py query",
+        description="Report on the requests of a log store filled by 'task1_3.py ingest'."
+    )
+    parser.add_argument("database", help="SQLite database file.")
+    parser.add_argument("-g", "--group-by", default="user_agent", metavar="DIMENSIONS",
+                        help="Comma-separated dimensions of the report, among "
+                             f"{', '.join(STORE_DIMENSIONS)} (default: %(default)s).")
+    parser.add_argument("-m", "--metrics", default="", metavar="METRICS",
+                        help="Comma-separated metrics of the report: bytes.")
+    parser.add_argument("--since", default=None, metavar="TIME",
+                        help="Only count requests at or after this time, as accepted "
+                             "by the main command.")
+    parser.add_argument("--until", default=None, metavar="TIME",
+                        help="Only count requests before this time.")
+    parser.add_argument("--where", default=None, metavar="CONDITION",
+                        help="SQL condition on the columns of the requests table "
+                             "(time, ip, user, method, path, protocol, status, size, "
+                             "referer, user_agent), e.g. \"status >= 500\".")
+    parser.add_argument("--sql", default=None, metavar="STATEMENT",
+                        help="Print the result of this SQL statement instead of a report.")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of groups printed with --sort, 0 for all "
+                             "(default: %(default)s).")
+    parser.add_argument("--sort", action="store_true",
+                        help="Print the groups by decreasing count.")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="text",
+                        help="Format of the output (default: %(default)s).")
+    parser.add_argument("-o", "--output", default=None, metavar="FILE",
+                        help="Write the output to this file instead of the standard "
+                             "output.")
+    args = parser.parse_args(arguments)
+    if not os.path.isfile(args.database):
+        parser.error(f"no log store at '{args.database}'")
+    time_range = time_range_option(parser, args.since, args.until)
+
+    try:
+        if args.sql:
+            columns, rows = execute_store_query(args.database, args.sql)
+        else:
+            report = query_log_store(args.database, tuple(args.group_by.split(',')),
+                                     tuple(name for name in args.metrics.split(',') if name),
+                                     time_range, args.where)
+    except (ValueError, sqlite3.Error) as error:
+        print(f"Error: {error}")
+        sys.exit(1)
+    try:
+        with open_output(args.output) as out:
+            if args.sql:
+                write_query_rows(out, columns, rows, args.output_format)
+            else:
+                write_reports(out, [report], args.output_format, args.top, args.sort)
+    except OSError as error:
+        if args.output is None:
+            raise
+        print(f"Error: Could not write '{args.output}': {error}")
+        sys.exit(1)
+
+
+def export_main(arguments):
+    """
+    Exports access logs to a column file and prints the number of rows.
+
+    Args:
+        arguments (list): The command-line arguments after 'export'.
+    """
+    parser = argparse.ArgumentParser(
+        prog="task1_3.py export",
+        description="Export parsed access logs to a compressed column file, which "
+                    "task1_3.py reads in place of the logs much faster than it parses them."
+    )
+    parser.add_argument("output", help="Column file to write.")
+    parser.add_argument("log_files", nargs="+",
+                        help="Access log files or glob patterns, optionally compressed.")
+    parser.add_argument("--format", default=None, dest="log_format",
+                        help=f"Log format: one of {', '.join(LOG_FORMATS)} or an Apache "
+                             "LogFormat or nginx log_format string (default: combined).")
+    parser.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE, metavar="ROWS",
+                        help="Rows per row group, which bounds memory use "
+                             "(default: %(default)s).")
+    args = parser.parse_args(arguments)
+    if args.row_group_size <= 0:
+        parser.error("--row-group-size must be positive")
+    try:
+        compile_log_format(args.log_format)
+    except ValueError as error:
+        parser.error(str(error))
+
+    try:
+        rows = export_log_columns(expand_log_paths(args.log_files), args.output,
+                                  args.log_format, args.row_group_size)
+    except OSError as error:
+        print(f"Error: Could not write '{args.output}': {error}")
+        sys.exit(1)
+    print(f"Exported {rows} requests to '{args.output}'.")
+
+
+def time_range_option(parser, since, until):
+    """
+    Parses the --since and --until options of a command.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser reporting invalid times.
+        since (str): The --since option, or None.
+        until (str): The --until option, or None.
+
+    Returns:
+        tuple: The time range (start, end), either bound being None when
+        open, or None when neither option is given.
+    """
+    time_range = None
+    if since or until:
+        try:
+            time_range = tuple(parse_time_option(text) if text else None
+                               for text in (since, until))
+        except ValueError as error:
+            parser.error(f"invalid --since or --until time: {error}")
+    return time_range
+
+
+def analysis_parser():
+    """
+    Builds the parser of the main command, which analyzes access logs.
+
+    Returns:
+        argparse.ArgumentParser: The parser of the main command.
+    """
+    parser = argparse.ArgumentParser(
+        description="Count the requests of each User-Agent in Apache access logs."
+    )
+    parser.add_argument("log_files", nargs="+",
+                        help="Access log files or glob patterns, optionally compressed.")
+    parser.add_argument("-g", "--group-by", action="append", metavar="DIMENSIONS",
+                        help="Comma-separated dimensions of one report, among "
+                             f"{', '.join(DIMENSIONS)}. Repeat for several reports "
+                             "(default: user_agent).")
+    parser.add_argument("-m", "--metrics", default="", metavar="METRICS",
+                        help="Comma-separated metrics added to every report, among "
+                             f"{', '.join(METRICS)}.")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of worker processes (default: number of CPUs).")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE // (1024 * 1024),
+                        help="Size in MiB of the ranges large plain logs are split "
+                             "into for parallel parsing (default: %(default)s).")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directory where parsed results are cached and reused "
+                             "while the log files are unchanged. It must belong to you "
+                             "and not be writable by others.")
+    parser.add_argument("--checkpoint", default=None, metavar="FILE",
+                        help="Checkpoint file: only parse lines appended since the "
+                             "previous run and add them to the counts saved there.")
+    parser.add_argument("-f", "--follow", action="store_true",
+                        help="Watch a live log and periodically print the top keys "
+                             "of the first report over trailing windows.")
+    parser.add_argument("--windows", default=','.join(map(str, FOLLOW_WINDOWS)),
+                        help="Comma-separated trailing windows in seconds for "
+                             "--follow (default: %(default)s).")
+    parser.add_argument("--interval", type=float, default=10.0,
+                        help="Seconds between two printouts of --follow "
+                             "(default: %(default)s).")
+    parser.add_argument("--detect", action="store_true",
+                        help="Print the keys whose request rate spikes far above its "
+                             "decayed baseline: live with --follow, otherwise by "
+                             "replaying the logs in order instead of reporting.")
+    parser.add_argument("--detect-by", default=','.join(ANOMALY_DIMENSIONS),
+                        metavar="DIMENSIONS",
+                        help="Comma-separated dimensions watched by --detect "
+                             "(default: %(default)s).")
+    parser.add_argument("--spike-factor", type=float, default=ANOMALY_FACTOR,
+                        help="Factor by which a rate must exceed its baseline to be "
+                             "flagged by --detect (default: %(default)s).")
+    parser.add_argument("--spike-min-rate", type=float, default=ANOMALY_MIN_RATE,
+                        metavar="RATE",
+                        help="Lowest rate flagged by --detect, in requests per minute "
+                             "(default: %(default)s).")
+    parser.add_argument("--half-life", type=float, default=ANOMALY_HALF_LIFE,
+                        help="Half-life in seconds of the rates of --detect "
+                             "(default: %(default)s).")
+    parser.add_argument("--baseline-half-life", type=float,
+                        default=ANOMALY_BASELINE_HALF_LIFE,
+                        help="Half-life in seconds of the baselines of --detect "
+                             "(default: %(default)s).")
+    parser.add_argument("--detect-keys", type=int, default=ANOMALY_MAX_KEYS, metavar="N",
+                        help="Keys tracked per dimension by --detect before the least "
+                             "active are evicted (default: %(default)s).")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of keys printed per window by --follow or per "
+                             "--approximate or --sort report, 0 for all of them "
+                             "(default: %(default)s).")
+    parser.add_argument("--sort", action="store_true",
+                        help="Print the groups of exact reports by decreasing count, "
+                             "keeping the --top ones.")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="text",
+                        help="Format of the reports: human-readable text, CSV, a JSON "
+                             "document or JSON lines (default: %(default)s).")
+    parser.add_argument("-o", "--output", default=None, metavar="FILE",
+                        help="Write the reports to this file instead of the standard "
+                             "output.")
+    parser.add_argument("--approximate", action="store_true",
+                        help="Estimate the top groups and the number of distinct "
+                             "groups in fixed memory instead of counting all groups.")
+    parser.add_argument("--top-error", type=float, default=TOP_ERROR,
+                        help="Largest error of --approximate top counts, as a fraction "
+                             "of all requests (default: %(default)s).")
+    parser.add_argument("--distinct-error", type=float, default=DISTINCT_ERROR,
+                        help="Relative standard error of --approximate distinct "
+                             "counts (default: %(default)s).")
+    parser.add_argument("--save", default=None, metavar="FILE",
+                        help="Also save the reports to a binary report file, which "
+                             "'task1_3.py merge' can combine with others.")
+    parser.add_argument("--since", default=None, metavar="TIME",
+                        help="Only count requests at or after this time: a Unix "
+                             "timestamp, an ISO 8601 time (UTC unless it has an "
+                             "offset) or a log date.")
+    parser.add_argument("--until", default=None, metavar="TIME",
+                        help="Only count requests before this time, in the same "
+                             "formats as --since.")
+    parser.add_argument("--unsorted", action="store_true",
+                        help="Do not assume plain logs are sorted by time: filter "
+                             "every line for --since/--until instead of binary "
+                             "searching the matching byte range.")
+    parser.add_argument("--time-index", action="store_true",
+                        help="Maintain a sidecar index (<log>.tidx) mapping times to "
+                             "offsets for each plain or gzip log and use it to seek "
+                             "to --since/--until and split multi-member gzip logs.")
+    parser.add_argument("--format", default=None, dest="log_format",
+                        help=f"Log format: one of {', '.join(LOG_FORMATS)} or an Apache "
+                             "LogFormat or nginx log_format string (default: combined).")
+    parser.add_argument("--lenient", action="store_true",
+                        help="Parse lines rejected by the Combined Log Format parser "
+                             "with a tolerant one instead of skipping them.")
+    parser.add_argument("--malformed-samples", type=int, default=MALFORMED_SAMPLES,
+                        metavar="N",
+                        help="Number of malformed lines printed to stderr "
+                             "(default: %(default)s).")
+    parser.add_argument("--path-tree", type=int, default=None, metavar="DEPTH",
+                        help="Also print the requests under each route prefix, down "
+                             "to this number of path segments, keeping the --top "
+                             "largest prefixes per level when --sort is given.")
+    parser.add_argument("--path-prefix", default="/",
+                        help="Prefix at the root of --path-tree (default: %(default)s).")
+    parser.add_argument("--ip-table", default=None, metavar="FILE",
+                        help="CIDR table (network or first and last address, AS "
+                             "number, country) used by the asn and country dimensions.")
+    parser.add_argument("--agent-stats", action="store_true",
+                        help="Print the hit rate of the User-Agent classification "
+                             "cache to stderr (only counts lines parsed in the main "
+                             "process, e.g. with -j 1).")
+    return parser
+
+
+def report_specs(parser, args):
+    """
+    Builds the specs of the reports requested on the command line.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser reporting invalid options.
+        args (argparse.Namespace): The parsed options of the main command.
+
+    Returns:
+        list: The report specs, ending with the route report of --path-tree
+        when it is given.
+    """
+    if not 0 < args.top_error < 1 or not 0 < args.distinct_error < 1:
+        parser.error("--top-error and --distinct-error must be between 0 and 1")
+    metrics = tuple(name for name in args.metrics.split(',') if name)
+    if args.approximate and metrics:
+        parser.error("--metrics cannot be used with --approximate")
+    approximation = (args.top_error, args.distinct_error) if args.approximate else ()
+    specs = [(tuple(dimensions.split(',')), metrics, approximation)
+             for dimensions in args.group_by or ['user_agent']]
+    try:
+        for spec in specs:
+            make_report(spec)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.path_tree is not None:
+        if args.path_tree < 0:
+            parser.error("--path-tree must be a non-negative number of segments")
+        specs.append((('route',), ()))
+    return specs
+
+
+def check_analysis_options(parser, args):
+    """
+    Rejects invalid or conflicting options of the main command.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser reporting invalid options.
+        args (argparse.Namespace): The parsed options of the main command.
+    """
+    if args.chunk_size <= 0:
+        parser.error("--chunk-size must be a positive number of MiB")
+    if args.checkpoint and (args.jobs is not None or args.cache_dir or args.time_index):
+        # Appended lines are read in this process from the checkpointed offsets
+        parser.error("--jobs, --cache-dir and --time-index cannot be used with --checkpoint")
+    if (args.since or args.until) and (args.follow or args.checkpoint):
+        parser.error("--since and --until cannot be used with --follow or --checkpoint")
+    try:
+        compile_log_format(args.log_format)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.cache_dir and os.path.exists(args.cache_dir) and not is_private_path(args.cache_dir):
+        parser.error(f"--cache-dir '{args.cache_dir}' must belong to you and not be "
+                     "writable by others")
+    if args.ip_table:
+        try:
+            load_ip_table(ip_table_identity(args.ip_table))
+        except (OSError, ValueError) as error:
+            parser.error(f"invalid --ip-table: {error}")
+
+
+def make_detector(parser, args):
+    """
+    Builds the rate spike detector of --detect.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser reporting invalid options.
+        args (argparse.Namespace): The parsed options of the main command.
+
+    Returns:
+        RateAnomalyDetector: The detector configured by the options.
+    """
+    if args.checkpoint or args.since or args.until:
+        parser.error("--detect cannot be used with --checkpoint, --since or --until")
+    if args.spike_factor <= 1 or args.spike_min_rate < 0:
+        parser.error("--spike-factor must exceed 1 and --spike-min-rate must not "
+                     "be negative")
+    if args.half_life <= 0 or args.baseline_half_life <= args.half_life:
+        parser.error("--half-life must be positive and shorter than "
+                     "--baseline-half-life")
+    if args.detect_keys <= 0:
+        parser.error("--detect-keys must be positive")
+    detector = None
+    try:
+        detector = RateAnomalyDetector(
+            tuple(args.detect_by.split(',')), args.spike_factor, args.spike_min_rate,
+            args.half_life, args.baseline_half_life, args.detect_keys, args.ip_table)
+    except ValueError as error:
+        parser.error(str(error))
+    return detector
+
+
+def follow_main(parser, args, file_paths, specs, detector):
+    """
+    Follows a live log, printing window counts and the alerts of --detect,
+    until interrupted.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser reporting invalid options.
+        args (argparse.Namespace): The parsed options of the main command.
+        file_paths (list): The expanded log paths, which must hold one log.
+        specs (list): The report specs; the first one is followed.
+        detector (RateAnomalyDetector): The detector of --detect, or None.
+    """
+    if len(file_paths) != 1:
+        parser.error("--follow watches exactly one log file")
+    try:
+        windows = tuple(int(window) for window in args.windows.split(','))
+    except ValueError:
+        parser.error("--windows must be comma-separated numbers of seconds")
+    try:
+        follow_access_log(file_paths[0], specs[0][0], windows, args.interval, args.top,
+                          log_format=args.log_format, detector=detector,
+                          ip_table=args.ip_table)
+    except KeyboardInterrupt:
+        pass
+
+
+def detect_main(file_paths, detector, log_format=None):
+    """
+    Replays logs in order and prints the alerts of a rate spike detector.
+
+    Args:
+        file_paths (list): The log paths, in chronological order.
+        detector (RateAnomalyDetector): The detector fed with the requests.
+        log_format (str): The format of the logs, None for combined.
+    """
+    try:
+        for alert in detect_log_anomalies(file_paths, detector, log_format):
+            print(format_alert(alert))
+    except KeyboardInterrupt:
+        pass
+
+
+def analyze_main(args, file_paths, specs, time_range):
+    """
+    Analyzes logs, or only their lines appended since the checkpoint, and
+    prints and optionally saves the reports.
+
+    Args:
+        args (argparse.Namespace): The parsed options of the main command.
+        file_paths (list): The expanded log paths.
+        specs (list): The report specs, ending with the route report of
+            --path-tree when it is given.
+        time_range (tuple): The (start, end) range of --since and --until,
+            or None.
+    """
+    malformed = MalformedLines(args.lenient, args.malformed_samples)
+    if args.checkpoint:
+        try:
+            reports = analyze_appended_logs(file_paths, args.checkpoint, specs,
+                                            args.log_format, malformed, args.ip_table)
+        except ValueError as error:
+            print(f"Error: {error}")
+            sys.exit(1)
+    else:
+        reports = analyze_access_logs(file_paths, specs, args.jobs,
+                                      args.chunk_size * 1024 * 1024, args.cache_dir,
+                                      time_range, not args.unsorted, args.time_index,
+                                      malformed, args.log_format, args.ip_table)
+    print_malformed_lines(malformed)
+    path_tree = None
+    if args.path_tree is not None:
+        path_tree = (reports.pop(), args.path_prefix, args.path_tree,
+                     args.top if args.sort else 0)
+    if args.save:
+        save_reports(args.save, reports)
+    try:
+        with open_output(args.output) as out:
+            write_reports(out, reports, args.output_format, args.top, args.sort, path_tree)
+    except OSError as error:
+        if args.output is None:
+            raise
+        print(f"Error: Could not write '{args.output}': {error}")
+        sys.exit(1)
+    if args.agent_stats:
+        hits, misses, hit_rate = agent_cache_stats()
+        print(f"User-Agent cache: {hits} hits, {misses} misses "
+              f"({hit_rate:.1%} hit rate)", file=sys.stderr)
+
+
+# Subcommands, run with the arguments that follow their name
+COMMANDS = {
+    'merge': merge_main,
+    'ingest': ingest_main,
+    'query': query_main,
+    'export': export_main,
+}
+
+
+def main():
+    """
+    Main function to analyze the given access logs and print the reports.
+    """
+    if sys.argv[1:2] and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+    parser = analysis_parser()
+    args = parser.parse_args()
+    specs = report_specs(parser, args)
+    check_analysis_options(parser, args)
+    time_range = time_range_option(parser, args.since, args.until)
+    detector = make_detector(parser, args) if args.detect else None
+
+    file_paths = expand_log_paths(args.log_files)
+    if args.follow:
+        follow_main(parser, args, file_paths, specs, detector)
+    elif detector is not None:
+        detect_main(file_paths, detector, args.log_format)
+    else:
+        analyze_main(args, file_paths, specs, time_range)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1106 @@
+"""
+Regression tests of task1_3.py, run with pytest.
+
+Each group of tests checks the behaviour added by one change to the
+script. Logs are written to temporary directories, except the bundled
+access.log.5.
+"""
+
+import bz2
+import csv
+import gzip
+import io
+import json
+import lzma
+import os
+import pickle
+import random
+import sqlite3
+import time
+from collections import Counter
+
+import pytest
+
+import log_analysis
+import log_checkpoint
+import log_columns
+import log_dimensions
+import log_files
+import log_follow
+import log_formats
+import log_reports
+import log_sketches
+import log_store
+import task1_3
+
+LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'access.log.5')
+
+# Lines the fast splitter must either parse exactly like the regex or
+# leave to it
+LINES = [
+    b'160.13.239.73 - - [24/Jul/2019:06:51:05 +0000] "GET / HTTP/1.1" 301 194 "-" '
+    b'"Mozilla/5.0 (X11; Linux x86_64)"',
+    b'10.0.0.1 ident frank [10/Oct/2000:13:55:36 -0700] "GET /a.gif?x=1 HTTP/1.0" 200 '
+    b'2326 "http://example.com/start" "curl/7.68.0"',
+    b'::1 - - [01/Jan/2020:00:00:00 +0530] "POST /api/v1/users HTTP/2.0" 404 - "-" "-"',
+    b'1.2.3.4 - - [24/Jul/2019:06:51:05 +0000] "-" 400 0 "-" "-"',
+    b'1.2.3.4 - - [24/Jul/2019:06:51:05 +0000] "GET /q?s=\\"x\\" HTTP/1.1" 200 5 "-" "a"',
+    b'1.2.3.4 - - [24/Jul/2019:06:51:05 +0000] "GET / HTTP/1.1" 200 5 "-" "a" extra',
+    b'1.2.3.4 - - [24/Jul/2019:06:51:05 +0000] "GET / HTTP/1.1" 20 5 "-" "a"',
+    b'1.2.3.4 -  - [24/Jul/2019:06:51:05 +0000] "GET / HTTP/1.1" 200 5 "-" "a"',
+    b'1.2.3.4 - - 24/Jul/2019:06:51:05 +0000 "GET / HTTP/1.1" 200 5 "-" "a"',
+    b'not a log line',
+    b'',
+]
+
+
+def write_log(file_path, lines):
+    """Writes log lines to a file, each followed by a newline."""
+    with open(file_path, 'wb') as file:
+        file.writelines(line + b'\n' for line in lines)
+
+
+def log_line(ip, date, path='/', status=200, size=b'100', identd=b'-', agent=b'agent'):
+    """Returns a Combined Log Format line with the given fields."""
+    return (b'%s %s - [%s] "GET %s HTTP/1.1" %d %s "-" "%s"'
+            % (ip, identd, date, path.encode(), status, size, agent))
+
+
+def sample_lines():
+    """Returns the sample lines followed by the lines of the bundled log."""
+    with open(LOG_PATH, 'rb') as file:
+        return LINES + file.read().splitlines()
+
+
+# user-005: fast-path parser
+
+def test_splitter_matches_regex():
+    for line in sample_lines():
+        match = log_formats.log_pattern_bytes.match(line)
+        fields = log_formats.split_log_line(line)
+        if fields is not None:
+            assert match is not None, line
+            assert fields == match.group(*log_formats.LOG_FIELDS), line
+        assert log_formats.parse_log_line(line) == (
+            match.group(*log_formats.LOG_FIELDS) if match else None), line
+
+
+def test_combined_format_uses_splitter():
+    assert log_formats.compile_log_format('combined') is log_formats.parse_log_line
+    assert log_formats.compile_log_format('nginx') is log_formats.parse_log_line
+
+
+# user-002: compressed logs
+
+@pytest.mark.parametrize('compress', [gzip.compress, bz2.compress, lzma.compress])
+def test_compressed_logs_are_read_whatever_their_name(tmp_path, compress):
+    data = b''.join(line + b'\n' for line in LINES)
+    log_path = str(tmp_path / 'access.log.1')
+    with open(log_path, 'wb') as file:
+        file.write(compress(data))
+    assert log_files.detect_compression(log_path) is not None
+    with log_files.open_log(log_path) as stream:
+        assert stream.read() == data
+    with log_files.open_log(log_path, threaded=False) as stream:
+        assert stream.read() == data
+
+
+def test_compressed_and_plain_logs_give_the_same_reports(tmp_path):
+    lines = sample_lines()
+    write_log(tmp_path / 'plain.log', lines)
+    with gzip.open(tmp_path / 'packed.log', 'wb') as file:
+        file.writelines(line + b'\n' for line in lines)
+    specs = [(('user_agent',), ())]
+    plain = log_analysis.analyze_access_logs([str(tmp_path / 'plain.log')], specs, jobs=1)
+    packed = log_analysis.analyze_access_logs([str(tmp_path / 'packed.log')], specs, jobs=1)
+    assert packed[0].counts == plain[0].counts
+
+
+@pytest.mark.parametrize('compress', [lambda data: data, gzip.compress])
+def test_open_log_reads_pipes_whole(compress):
+    data = b''.join(line + b'\n' for line in LINES)
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, compress(data))
+    os.close(write_fd)
+    try:
+        pipe_path = f'/dev/fd/{read_fd}'
+        assert log_files.detect_compression(pipe_path) is None
+        with log_files.open_log(pipe_path) as stream:
+            assert stream.read() == data
+    finally:
+        os.close(read_fd)
+
+
+def test_damaged_compressed_log_exits(tmp_path, capsys):
+    log_path = str(tmp_path / 'access.log.gz')
+    with open(log_path, 'wb') as file:
+        file.write(gzip.compress(b''.join(line + b'\n' for line in LINES))[:40])
+    with pytest.raises(SystemExit):
+        log_analysis.analyze_access_logs([log_path], jobs=1)
+    assert "Could not read" in capsys.readouterr().out
+
+
+# user-003: parallel analysis of many logs
+
+def test_parallel_analysis_matches_a_single_process(tmp_path):
+    lines = sample_lines()
+    file_paths = []
+    for index in range(4):
+        file_path = str(tmp_path / f'access.log.{index}')
+        write_log(file_path, lines[index::4])
+        file_paths.append(file_path)
+    specs = [(('user_agent',), ()), (('status', 'method'), ('bytes', 'ips'))]
+    serial = log_analysis.analyze_access_logs(file_paths, specs, jobs=1)
+    parallel = log_analysis.analyze_access_logs(file_paths, specs, jobs=3)
+    whole = log_analysis.analyze_access_logs([LOG_PATH], specs, jobs=1)
+    for serial_report, parallel_report in zip(serial, parallel):
+        assert parallel_report.counts == serial_report.counts
+        assert parallel_report.sizes == serial_report.sizes
+        assert parallel_report.ips == serial_report.ips
+    valid = sum(log_formats.parse_log_line(line) is not None for line in LINES)
+    assert sum(serial[0].counts.values()) == sum(whole[0].counts.values()) + valid
+
+
+def test_expand_log_paths(tmp_path):
+    for name in ('access.log', 'access.log.1', 'access.log.tidx'):
+        write_log(tmp_path / name, LINES[:1])
+    pattern = str(tmp_path / 'access.log*')
+    missing = str(tmp_path / 'missing.log')
+    assert log_files.expand_log_paths([pattern, str(tmp_path / 'access.log'), missing]) == [
+        str(tmp_path / 'access.log'), str(tmp_path / 'access.log.1'), missing]
+
+
+# user-004: byte ranges of large plain logs
+
+def test_split_log_file_cuts_at_line_boundaries(tmp_path):
+    log_path = str(tmp_path / 'access.log')
+    write_log(log_path, sample_lines())
+    with open(log_path, 'rb') as file:
+        data = file.read()
+    for chunk_size in (1, 1000, 65536, len(data), 10 * len(data)):
+        ranges = log_files.split_log_file(log_path, chunk_size)
+        assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            assert end == start and data[end - 1:end] == b'\n'
+    middle = data.index(b'\n', len(data) // 2) + 1
+    assert log_files.split_log_file(log_path, 1000, middle)[0][0] == middle
+
+
+def test_large_plain_logs_are_split_into_tasks(tmp_path):
+    log_path = str(tmp_path / 'access.log')
+    write_log(log_path, sample_lines())
+    gzip_path = str(tmp_path / 'access.log.gz')
+    with open(log_path, 'rb') as file, gzip.open(gzip_path, 'wb') as packed:
+        packed.write(file.read())
+    tasks = log_analysis.plan_log_tasks([log_path, gzip_path], chunk_size=20000)
+    assert len(tasks) > 10
+    assert tasks[-1] == (gzip_path, None, None)
+    specs = [(('ip',), ('bytes',))]
+    ranged = log_analysis.analyze_access_logs([log_path], specs, jobs=4, chunk_size=20000)
+    whole = log_analysis.analyze_access_logs([log_path], specs, jobs=1)
+    assert ranged[0].counts == whole[0].counts
+    assert ranged[0].sizes == whole[0].sizes
+
+
+# user-008: columnar loader
+
+def test_log_columns_count_like_reports():
+    pytest.importorskip('numpy')
+    columns = log_analysis.load_log_columns([LOG_PATH], jobs=1)
+    reports = log_analysis.analyze_access_logs(
+        [LOG_PATH], [(('user_agent',), ()), (('status',), ('bytes',))], jobs=1)
+    assert len(columns) == sum(reports[0].counts.values())
+    assert columns.count_by('user_agent') == reports[0].counts
+    statuses = columns.count_by('status')
+    assert {str(status): count for status, count in statuses.items()} == reports[1].counts
+    sizes = columns.count_by('status', weights='size')
+    assert {str(status): size for status, size in sizes.items()} == reports[1].sizes
+    errors = columns.select(columns.column('status') >= 400)
+    assert len(errors) == sum(count for status, count in statuses.items() if status >= 400)
+    assert sum(columns.hourly_counts().values()) == len(columns)
+
+
+def test_log_columns_update_translates_codes():
+    pytest.importorskip('numpy')
+    date = b'24/Jul/2019:06:51:05 +0000'
+    first, second = log_columns.LogColumns(), log_columns.LogColumns()
+    for agent in (b'a', b'b', b'a'):
+        first.add(log_formats.parse_log_line(log_line(b'1.1.1.1', date, agent=agent)))
+    for agent in (b'c', b'a'):
+        second.add(log_formats.parse_log_line(log_line(b'1.1.1.1', date, agent=agent)))
+    first.update(second)
+    assert first.count_by('user_agent') == {'a': 3, 'b': 1, 'c': 1}
+
+
+def test_log_columns_store_out_of_range_numbers_as_missing():
+    line = json.dumps({'remote_addr': '1.2.3.4', 'time_local': '24/Jul/2019:06:51:05 +0000',
+                       'request': 'GET / HTTP/1.1', 'status': 700000,
+                       'body_bytes_sent': 2 ** 64}).encode()
+    fields = log_formats.parse_json_line(line)
+    assert log_formats.request_status_code(fields) is None
+    assert log_formats.request_size(fields) is None
+    columns = log_columns.LogColumns()
+    columns.add(fields)
+    assert (columns.status[0], columns.size[0]) == (0, 0)
+
+
+# user-009: cache of unchanged files
+
+def test_cache_is_reused_until_the_log_changes(tmp_path):
+    log_path = str(tmp_path / 'access.log')
+    cache_dir = str(tmp_path / 'cache')
+    date = b'24/Jul/2019:06:51:05 +0000'
+    write_log(log_path, [log_line(b'1.1.1.1', date)] * 3)
+    task = (log_path, None, None)
+    calls = []
+
+    def compute():
+        calls.append(None)
+        return len(calls)
+
+    assert log_analysis.cached_result(task, ('a',), cache_dir, compute) == 1
+    assert log_analysis.cached_result(task, ('a',), cache_dir, compute) == 1
+    assert log_analysis.cached_result(task, ('b',), cache_dir, compute) == 2
+    assert len(os.listdir(cache_dir)) == 2
+    with open(log_path, 'ab') as file:
+        file.write(log_line(b'2.2.2.2', date) + b'\n')
+    assert log_analysis.cached_result(task, ('a',), cache_dir, compute) == 3
+    assert log_analysis.cached_result(task, ('a',), cache_dir, compute) == 3
+    # Entries of the previous version of the log are removed
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_cached_reports_follow_the_log(tmp_path):
+    log_path = str(tmp_path / 'access.log')
+    cache_dir = str(tmp_path / 'cache')
+    date = b'24/Jul/2019:06:51:05 +0000'
+    write_log(log_path, [log_line(b'1.1.1.1', date)])
+    specs = [(('ip',), ())]
+    for _ in range(2):
+        reports = log_analysis.analyze_access_logs([log_path], specs, jobs=1, cache_dir=cache_dir)
+        assert reports[0].counts == {'1.1.1.1': 1}
+    write_log(log_path, [log_line(b'2.2.2.2', date)])
+    reports = log_analysis.analyze_access_logs([log_path], specs, jobs=1, cache_dir=cache_dir)
+    assert reports[0].counts == {'2.2.2.2': 1}
+
+
+def test_cache_directories_writable_by_others_are_not_used(tmp_path):
+    log_path = str(tmp_path / 'access.log')
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    cache_dir.chmod(0o777)
+    write_log(log_path, LINES[:1])
+    calls = []
+
+    def compute():
+        calls.append(None)
+        return len(calls)
+
+    for expected in (1, 2):
+        assert log_analysis.cached_result((log_path, None, None), (), str(cache_dir),
+                                          compute) == expected
+    assert not os.listdir(cache_dir)
+
+
+# user-010: incremental mode
+
+def test_checkpoint_counts_rotated_logs_once(tmp_path):
+    log_path = str(tmp_path / 'access.log')
+    rotated_path = log_path + '.1'
+    checkpoint_path = str(tmp_path / 'checkpoint')
+    specs = [(('status',), ())]
+    date = b'24/Jul/2019:06:51:05 +0000'
+
+    def total(file_paths):
+        reports = log_checkpoint.analyze_appended_logs(file_paths, checkpoint_path, specs)
+        return sum(reports[0].counts.values())
+
+    write_log(log_path, [log_line(b'1.1.1.%d' % i, date) for i in range(100)])
+    assert total([log_path]) == 100
+    with open(log_path, 'ab') as file:
+        file.write(log_line(b'2.2.2.2', date) + b'\n')
+    os.rename(log_path, rotated_path)
+    write_log(log_path, [log_line(b'3.3.3.%d' % i, date) for i in range(50)])
+    assert total([log_path, rotated_path]) == 151
+    # A log left out of a run is not counted again when it comes back
+    with open(log_path, 'ab') as file:
+        file.write(log_line(b'4.4.4.4', date) + b'\n')
+    assert total([log_path]) == 152
+    assert total([log_path, rotated_path]) == 152
+
+
+def test_checkpoint_keeps_undecoded_reports(tmp_path):
+    log_path = str(tmp_path / 'access.log')
+    checkpoint_path = str(tmp_path / 'checkpoint')
+    specs = [(('user_agent', 'status'), ('bytes', 'ips')), (('ip',), (), (0.01, 0.05))]
+    lines = sample_lines() + [log_line(b'1.1.1.1', b'24/Jul/2019:06:51:05 +0000',
+                                       agent=b'caf\xe9 \xff')]
+    write_log(log_path, lines[:100])
+    log_checkpoint.analyze_appended_logs([log_path], checkpoint_path, specs)
+    write_log(log_path, lines)
+    reports = log_checkpoint.analyze_appended_logs([log_path], checkpoint_path, specs)
+    whole = log_analysis.analyze_access_logs([log_path], specs, jobs=1)
+    assert reports[0].counts == whole[0].counts
+    assert reports[0].sizes == whole[0].sizes
+    assert reports[0].ips == whole[0].ips
+    assert reports[1].heavy_hitters.counts == whole[1].heavy_hitters.counts
+    checkpoint = log_checkpoint.load_checkpoint(checkpoint_path,
+                                                log_reports.normalize_specs(specs))
+    assert b'caf\xe9 \xff' in {key[0] for key in checkpoint['reports'][0].counts}
+    assert checkpoint['logs'][0]['identity'] == log_files.file_identity(log_path)
+
+
+def test_checkpoint_rejects_pickles_and_other_specs(tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint')
+    with open(checkpoint_path, 'wb') as file:
+        pickle.dump({'version': 1}, file)
+    with pytest.raises(ValueError, match='not a checkpoint'):
+        log_checkpoint.load_checkpoint(checkpoint_path, ())
+    os.remove(checkpoint_path)
+    write_log(tmp_path / 'access.log', LINES)
+    log_checkpoint.analyze_appended_logs([str(tmp_path / 'access.log')], checkpoint_path)
+    with pytest.raises(ValueError, match='other reports'):
+        log_checkpoint.analyze_appended_logs([str(tmp_path / 'access.log')], checkpoint_path,
+                                             [(('ip',), ())])
+
+
+# user-011: follow mode
+
+def test_sliding_windows_match_a_recount():
+    generator = random.Random(11)
+    counter = log_follow.SlidingWindowCounter((10, 60), bucket_seconds=5)
+    seen = []
+    now = 1000.0
+    for _ in range(2000):
+        now += generator.random() * 0.5
+        key = generator.choice('abcde')
+        counter.add(key, now)
+        seen.append((now, key))
+    counter.advance(now)
+    for window in counter.windows:
+        # Buckets leave a window whole, so it spans up to one bucket more
+        start = (int(now // 5) - window // 5 + 1) * 5
+        expected = Counter(key for timestamp, key in seen if timestamp >= start)
+        assert counter.totals[window] == expected
+        assert counter.requests[window] == sum(expected.values())
+    counter.advance(now + 100)
+    assert counter.requests == {10: 0, 60: 0}
+    assert not counter.totals[60]
+
+
+def test_follow_log_reads_appended_lines_across_rotation(tmp_path):
+    log_path = str(tmp_path / 'access.log')
+    write_log(log_path, [b'old'])
+    lines = log_follow.follow_log(log_path, timeout=0.01)
+    try:
+        assert next(lines) == []
+        with open(log_path, 'ab') as file:
+            file.write(b'first\nsecond\npart')
+        assert next(lines) == [b'first', b'second']
+        with open(log_path, 'ab') as file:
+            file.write(b'ial\n')
+        assert next(lines) == [b'partial']
+        with open(log_path, 'ab') as file:
+            file.write(b'last of the old log\n')
+        os.rename(log_path, log_path + '.1')
+        write_log(log_path, [b'new'])
+        received = []
+        for _ in range(10):
+            received.extend(next(lines))
+        assert received == [b'last of the old log', b'new']
+        write_log(log_path, [])
+        assert next(lines) == []
+        write_log(log_path, [b'after truncation'])
+        received = []
+        for _ in range(10):
+            received.extend(next(lines))
+        assert received == [b'after truncation']
+    finally:
+        lines.close()
+
+
+# user-012: approximate top-K and distinct counts
+
+@pytest.mark.parametrize('distinct', [0, 50, 5000, 50000])
+def test_hyperloglog_estimates_within_its_error(distinct):
+    sketch = log_sketches.HyperLogLog(0.02)
+    for value in range(distinct):
+        sketch.add(b'%d' % value)
+    assert abs(sketch.estimate() - distinct) <= 4 * sketch.error * distinct + 1
+
+
+def test_hyperloglog_merges_like_a_union():
+    first, second, union = (log_sketches.HyperLogLog(0.02) for _ in range(3))
+    for value in range(20000):
+        (first if value % 3 else second).add(b'%d' % value)
+        union.add(b'%d' % value)
+    for value in range(5000):
+        second.add(b'%d' % value)
+    first.update(second)
+    assert first.registers == union.registers
+
+
+def zipf_stream(count, keys, seed):
+    """Returns a seeded stream of keys drawn with Zipf-like frequencies."""
+    generator = random.Random(seed)
+    weights = [1 / rank for rank in range(1, keys + 1)]
+    return generator.choices([b'key%d' % rank for rank in range(keys)], weights, k=count)
+
+
+def check_space_saving(summary, stream):
+    """Checks the count bounds of a SpaceSaving summary of a stream."""
+    truth = Counter(stream)
+    for key, count in summary.counts.items():
+        assert count - summary.errors[key] <= truth[key] <= count
+    for key, count in truth.items():
+        if count > summary.floor:
+            assert key in summary.counts
+    assert summary.floor <= len(stream) / summary.capacity
+
+
+def test_space_saving_bounds_hold_and_survive_merges():
+    streams = [zipf_stream(20000, 3000, seed) for seed in range(3)]
+    summaries = []
+    for stream in streams:
+        summary = log_sketches.SpaceSaving(100)
+        for key in stream:
+            summary.add(key)
+        check_space_saving(summary, stream)
+        summaries.append(summary)
+    merged = summaries[0]
+    for summary in summaries[1:]:
+        merged.update(summary)
+    check_space_saving(merged, [key for stream in streams for key in stream])
+
+
+def test_approximate_report_is_close_to_the_exact_one(tmp_path):
+    log_path = str(tmp_path / 'access.log')
+    date = b'24/Jul/2019:06:51:05 +0000'
+    agents = zipf_stream(30000, 5000, 12)
+    write_log(log_path, [log_line(b'1.1.1.1', date, agent=agent) for agent in agents])
+    exact, approximate = log_analysis.analyze_access_logs(
+        [log_path], [(('user_agent',), ()), (('user_agent',), (), (0.001, 0.02))], jobs=1)
+    assert approximate.requests == len(agents)
+    assert abs(approximate.distinct.estimate() - len(exact.counts)) <= 0.08 * len(exact.counts)
+    for key, count, error in approximate.heavy_hitters.top(20):
+        assert count - error <= exact.counts[key] <= count
+        assert error <= 0.001 * len(agents)
+    assert ({key for key, _, _ in approximate.heavy_hitters.top(5)}
+            == {key for key, _ in exact.counts.most_common(5)})
+
+
+# user-013: report files and the merge command
+
+def test_saved_reports_merge_like_a_single_run(tmp_path):
+    lines = sample_lines()
+    halves = [tmp_path / 'first.log', tmp_path / 'second.log']
+    write_log(halves[0], lines[:len(lines) // 2])
+    write_log(halves[1], lines[len(lines) // 2:])
+    specs = [(('status',), ('bytes', 'ips')), (('hour', 'method'), ()),
+             (('user_agent',), (), (0.01, 0.02))]
+    report_paths = []
+    for index, half in enumerate(halves):
+        report_path = str(tmp_path / f'{index}.reports')
+        log_reports.save_reports(report_path, log_analysis.analyze_access_logs([str(half)], specs,
+                                                                               jobs=1))
+        report_paths.append(report_path)
+    merged = log_reports.merge_reports(log_reports.load_reports(path) for path in report_paths)
+    whole = log_analysis.analyze_access_logs([str(half) for half in halves], specs, jobs=1)
+    for merged_report, report in zip(merged[:2], whole):
+        assert merged_report.counts == report.counts
+        assert merged_report.sizes == report.sizes
+        assert merged_report.ips == report.ips
+    assert merged[2].requests == whole[2].requests
+    assert merged[2].distinct.registers == whole[2].distinct.registers
+
+
+def test_merge_rejects_other_specs(tmp_path):
+    write_log(tmp_path / 'a.log', LINES)
+    first = log_analysis.analyze_access_logs([str(tmp_path / 'a.log')], [(('status',), ())],
+                                             jobs=1)
+    second = log_analysis.analyze_access_logs([str(tmp_path / 'a.log')], [(('ip',), ())], jobs=1)
+    with pytest.raises(ValueError):
+        log_reports.merge_reports([first, second])
+
+
+def test_damaged_report_files_are_rejected(tmp_path):
+    report_path = str(tmp_path / 'reports')
+    write_log(tmp_path / 'a.log', LINES)
+    reports = log_analysis.analyze_access_logs([str(tmp_path / 'a.log')], jobs=1)
+    log_reports.save_reports(report_path, reports)
+    with open(report_path, 'rb') as file:
+        data = file.read()
+    with open(report_path, 'wb') as file:
+        file.write(data[:-5])
+    with pytest.raises(ValueError, match='damaged'):
+        log_reports.load_reports(report_path)
+    with open(report_path, 'wb') as file:
+        file.write(b'not a report file')
+    with pytest.raises(ValueError, match='not a report file'):
+        log_reports.load_reports(report_path)
+
+
+# user-014: User-Agent classification
+
+@pytest.mark.parametrize('agent, expected', [
+    (b'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+     b'Chrome/91.0.4472.124 Safari/537.36', (b'Chrome', b'91', b'Windows 10', b'browser')),
+    (b'Mozilla/5.0 (Windows NT 6.1; rv:45.0) Gecko/20100101 Firefox/45.0 JavaScript',
+     (b'Firefox', b'45', b'Windows 7', b'browser')),
+    (b'Mozilla/5.0 (Linux; Android 8.1.0; Cubot P30) AppleWebKit/537.36 (KHTML, like Gecko) '
+     b'Chrome/70.0.3538.110 Mobile Safari/537.36', (b'Chrome', b'70', b'Android', b'browser')),
+    (b'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
+     b'HeadlessChrome/74.0.3729.157 Safari/537.36', (b'HeadlessChrome', b'74', b'Linux', b'bot')),
+    (b'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+     (b'Googlebot', b'2', b'Other', b'bot')),
+    (b'Nimbostratus-Bot/v1.3.2 (http://cloudsystemnetworks.com)',
+     (b'Nimbostratus-Bot', b'1', b'Other', b'bot')),
+    (b'Java/1.8.0_151', (b'Java', b'1', b'Other', b'bot')),
+    (b'curl/7.68.0', (b'curl', b'7', b'Other', b'bot')),
+    (b'-', (b'Other', b'', b'Other', b'other')),
+])
+def test_classify_user_agent(agent, expected):
+    assert log_dimensions.classify_user_agent(agent) == expected
+
+
+# user-015: time ranges
+
+def sorted_log_lines(count=2000, start=1563951065):
+    """Returns log lines dated 7 seconds apart, in time order."""
+    lines = []
+    for index in range(count):
+        date = time.strftime('%d/%b/%Y:%H:%M:%S +0000', time.gmtime(start + index * 7))
+        lines.append(log_line(b'10.0.%d.%d' % (index // 256 % 256, index % 256),
+                              date.encode(), path=f'/{index % 13}'))
+    return lines
+
+
+def test_parse_time_option():
+    assert log_formats.parse_time_option('1563951065') == 1563951065
+    assert log_formats.parse_time_option('24/Jul/2019:06:51:05 +0000') == 1563951065
+    assert log_formats.parse_time_option('2019-07-24T06:51:05') == 1563951065
+    assert log_formats.parse_time_option('2019-07-24T08:51:05+02:00') == 1563951065
+    with pytest.raises(ValueError):
+        log_formats.parse_time_option('yesterday')
+
+
+def test_find_time_range_covers_the_range(tmp_path):
+    lines = sorted_log_lines()
+    write_log(tmp_path / 'a.log', lines)
+    since, until = 1563951065 + 3000, 1563951065 + 6000
+    start, end = log_files.find_time_range(str(tmp_path / 'a.log'), (since, until))
+    with open(tmp_path / 'a.log', 'rb') as file:
+        data = file.read()
+    assert 0 < start < end < len(data)
+    assert data[start - 1:start] == b'\n' and data[end - 1:end] == b'\n'
+    inside = [line for line in lines
+              if log_formats.in_time_range(log_formats.parse_log_line(line), (since, until))]
+    assert set(inside) <= set(data[start:end].splitlines())
+
+
+@pytest.mark.parametrize('time_range', [
+    (1563951065 + 3000, 1563951065 + 6000),
+    (None, 1563951065 + 100),
+    (1563951065 + 13000, None),
+    (0, 1),
+])
+def test_time_range_matches_line_filter(tmp_path, time_range):
+    lines = sorted_log_lines()
+    write_log(tmp_path / 'a.log', lines)
+    expected = Counter(log_formats.parse_log_line(line)[4] for line in lines
+                       if log_formats.in_time_range(log_formats.parse_log_line(line), time_range))
+    for sorted_logs in (True, False):
+        report, = log_analysis.analyze_access_logs(
+            [str(tmp_path / 'a.log')], [(('request',), ())], jobs=1,
+            chunk_size=4096, time_range=time_range, sorted_logs=sorted_logs)
+        assert report.counts == {path.decode(): count for path, count in expected.items()}
+
+
+# user-016: time indexes
+
+def index_minutes(lines):
+    """Returns the number of distinct minutes of log lines, one index entry each."""
+    return len({log_formats.parse_log_time(log_formats.parse_log_line(line)[3]) // 60
+                for line in lines})
+
+
+def test_time_index_round_trip(tmp_path):
+    lines = sorted_log_lines(200)
+    log_path = str(tmp_path / 'sorted.log')
+    write_log(log_path, lines)
+    index = log_files.update_time_index(log_path, None)
+    loaded = log_files.read_time_index(log_files.time_index_path(log_path))
+    assert loaded == index
+    assert len(loaded['times']) == index_minutes(lines)
+    assert loaded['scanned'] == os.path.getsize(log_path)
+    with open(log_files.time_index_path(log_path), 'wb') as file:
+        file.write(b'\x80\x04not an index')
+    assert log_files.read_time_index(log_files.time_index_path(log_path)) is None
+
+
+def test_time_index_follows_appends_and_truncation(tmp_path):
+    lines = sorted_log_lines(300)
+    log_path = str(tmp_path / 'sorted.log')
+    write_log(log_path, lines[:100])
+    assert len(log_files.update_time_index(log_path, None)['times']) == index_minutes(lines[:100])
+    with open(log_path, 'ab') as file:
+        file.writelines(line + b'\n' for line in lines[100:])
+    index = log_files.update_time_index(log_path, None)
+    assert len(index['times']) == index_minutes(lines)
+    assert index['scanned'] == os.path.getsize(log_path)
+    write_log(log_path, lines[:50])
+    index = log_files.update_time_index(log_path, None)
+    assert len(index['times']) == index_minutes(lines[:50])
+    assert log_files.update_time_index(log_path, bz2.open) is None
+
+
+def test_indexed_gzip_ranges_match_line_filter(tmp_path):
+    lines = sorted_log_lines()
+    log_path = str(tmp_path / 'sorted.log.gz')
+    with open(log_path, 'wb') as file:
+        for start in range(0, len(lines), 100):
+            file.write(gzip.compress(b''.join(line + b'\n' for line in lines[start:start + 100])))
+    time_range = (1563951065 + 3000, 1563951065 + 6000)
+    tasks = log_analysis.plan_log_tasks([log_path], chunk_size=4096, time_range=time_range,
+                                        time_index=True)
+    assert len(tasks) > 1
+    assert all(start is not None for _, start, _ in tasks)
+    expected = sum(log_formats.in_time_range(log_formats.parse_log_line(line), time_range)
+                   for line in lines)
+    report, = log_analysis.analyze_access_logs([log_path], [(('status',), ())], jobs=1,
+                                               chunk_size=4096, time_range=time_range,
+                                               time_index=True)
+    assert sum(report.counts.values()) == expected
+
+
+# user-017: malformed lines and options of incremental mode
+
+def test_malformed_samples_are_kept(tmp_path):
+    log_path = str(tmp_path / 'bad.log')
+    write_log(log_path, [b'bad line %d' % i for i in range(20)])
+    malformed = log_reports.MalformedLines(max_samples=10)
+    log_analysis.analyze_access_logs([log_path], [(('status',), ())], jobs=1, malformed=malformed)
+    assert malformed.count == 20
+    assert malformed.samples == [f'bad line {i}' for i in range(10)]
+
+
+@pytest.mark.parametrize('lenient', [False, True])
+def test_checkpoint_counts_malformed_appended_lines(tmp_path, lenient):
+    log_path = str(tmp_path / 'a.log')
+    checkpoint_path = str(tmp_path / 'checkpoint')
+    write_log(log_path, LINES)
+    expected = log_reports.MalformedLines(lenient)
+    whole, = log_analysis.analyze_access_logs([log_path], [(('status',), ())], jobs=1,
+                                              malformed=expected)
+    malformed = log_reports.MalformedLines(lenient)
+    report, = log_checkpoint.analyze_appended_logs([log_path], checkpoint_path,
+                                                   [(('status',), ())], malformed=malformed)
+    assert report.counts == whole.counts
+    assert (malformed.count, malformed.recovered) == (expected.count, expected.recovered)
+    assert malformed.samples == expected.samples
+    assert expected.count + expected.recovered > 0
+    malformed = log_reports.MalformedLines(lenient)
+    log_checkpoint.analyze_appended_logs([log_path], checkpoint_path, [(('status',), ())],
+                                         malformed=malformed)
+    assert (malformed.count, malformed.recovered) == (0, 0)
+
+
+@pytest.mark.parametrize('option', [['-j', '2'], ['--cache-dir', 'cache'], ['--time-index']])
+def test_checkpoint_rejects_parallel_options(tmp_path, monkeypatch, capsys, option):
+    write_log(tmp_path / 'a.log', LINES)
+    monkeypatch.setattr('sys.argv', ['task1_3.py', str(tmp_path / 'a.log'), '--checkpoint',
+                                     str(tmp_path / 'checkpoint')] + option)
+    with pytest.raises(SystemExit):
+        task1_3.main()
+    assert 'cannot be used with --checkpoint' in capsys.readouterr().err
+    assert not os.path.exists(tmp_path / 'checkpoint')
+
+
+# user-018: log formats
+
+def test_json_iso_dates():
+    line = json.dumps({'remote_addr': '1.2.3.4', 'time': '2019-07-24T06:51:05.250+02:00',
+                       'request': 'GET / HTTP/1.1', 'status': 200}).encode()
+    fields = log_formats.parse_json_line(line)
+    assert fields[3] == b'24/Jul/2019:06:51:05 +0200'
+    assert log_formats.parse_log_time(fields[3]) == 1563943865
+    assert log_formats.log_date('2019-07-24T06:51:05Z') == '24/Jul/2019:06:51:05 +0000'
+    assert log_formats.log_date('yesterday') == 'yesterday'
+
+
+def test_nginx_iso_dates(tmp_path):
+    log_format = ('$remote_addr - $remote_user [$time_iso8601] "$request" $status '
+                  '$body_bytes_sent "$http_referer" "$http_user_agent"')
+    parse_line = log_formats.compile_log_format(log_format)
+    fields = parse_line(b'1.2.3.4 - - [2019-07-24T06:51:05+02:00] "GET /a HTTP/1.1" 200 5 '
+                        b'"-" "agent"')
+    assert fields == (b'1.2.3.4', b'-', b'-', b'24/Jul/2019:06:51:05 +0200',
+                      b'GET /a HTTP/1.1', b'200', b'5', b'-', b'agent')
+    write_log(tmp_path / 'a.log', [
+        b'1.2.3.4 - - [2019-07-24T06:%02d:00+00:00] "GET / HTTP/1.1" 200 5 "-" "agent"' % minute
+        for minute in range(10)])
+    report, = log_analysis.analyze_access_logs(
+        [str(tmp_path / 'a.log')], [(('hour',), ())], jobs=1, log_format=log_format,
+        time_range=(1563948000, 1563948000 + 300))
+    assert sum(report.counts.values()) == 5
+
+
+def test_custom_formats():
+    apache = log_formats.compile_log_format('%h %l %u %t "%r" %>s %b %D')
+    fields = apache(b'1.2.3.4 - bob [24/Jul/2019:06:51:05 +0000] "GET / HTTP/1.1" 200 5 123')
+    assert fields[:6] == (b'1.2.3.4', b'-', b'bob', b'24/Jul/2019:06:51:05 +0000',
+                          b'GET / HTTP/1.1', b'200')
+    assert log_formats.compile_log_format('nginx') is log_formats.parse_log_line
+    with pytest.raises(ValueError):
+        log_formats.compile_log_format('%D %T')
+
+
+# user-019: output formats
+
+def output_reports(output_format, top=0, sort=False):
+    """Returns the reports of the bundled log written in an output format."""
+    reports = log_analysis.analyze_access_logs(
+        [LOG_PATH], [(('status',), ('bytes', 'ips')), (('method', 'status_class'), ())], jobs=1)
+    out = io.StringIO()
+    task1_3.write_reports(out, reports, output_format, top, sort)
+    return reports, out.getvalue()
+
+
+def test_text_output():
+    reports = log_analysis.analyze_access_logs([LOG_PATH], jobs=1)
+    out = io.StringIO()
+    task1_3.write_reports(out, reports)
+    lines = out.getvalue().splitlines()
+    assert lines[0] == f"Total number of different User Agents: {len(reports[0].counts)}"
+    assert lines[1] == "Number of requests from each User Agent:"
+    counts = {agent: int(count) for agent, count in
+              (line.rsplit(': ', 1) for line in lines[2:])}
+    assert counts == reports[0].counts
+
+
+def test_csv_output():
+    reports, text = output_reports('csv')
+    tables = text.split('\n\n')
+    assert len(tables) == 2
+    rows = list(csv.reader(io.StringIO(tables[0])))
+    assert rows[0] == ['status', 'requests', 'bytes', 'ips']
+    assert {row[0]: int(row[1]) for row in rows[1:]} == reports[0].counts
+    rows = list(csv.reader(io.StringIO(tables[1])))
+    assert rows[0] == ['method', 'status_class', 'requests']
+    assert {tuple(row[:2]): int(row[2]) for row in rows[1:]} == reports[1].counts
+
+
+def test_json_output():
+    reports, text = output_reports('json', top=2, sort=True)
+    documents = json.loads(text)
+    assert [document['group_by'] for document in documents] == [['status'],
+                                                                ['method', 'status_class']]
+    assert documents[0]['groups'] == len(reports[0].counts)
+    top = documents[0]['rows']
+    assert [row['requests'] for row in top] == sorted(reports[0].counts.values(),
+                                                      reverse=True)[:2]
+    assert all(row['bytes'] == reports[0].sizes[row['status']] for row in top)
+
+
+def test_ndjson_output():
+    reports, text = output_reports('ndjson')
+    records = [json.loads(line) for line in text.splitlines()]
+    assert len(records) == len(reports[0].counts) + len(reports[1].counts)
+    by_status = {record['status']: record for record in records if record['report'] == 'status'}
+    counts = {status: record['requests'] for status, record in by_status.items()}
+    assert counts == reports[0].counts
+    assert all(record['ips'] == len(reports[0].ips[status])
+               for status, record in by_status.items())
+
+
+# user-021: client origins from an IP table
+
+def write_ip_table(table_path, text):
+    """Writes an IP table with a distinct modification time."""
+    with open(table_path, 'w', encoding='utf-8') as file:
+        file.write(text)
+    os.utime(table_path, ns=(0, random.randrange(1, 2 ** 40)))
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_origins_are_looked_up_in_the_ip_table(tmp_path, jobs):
+    table_path = str(tmp_path / 'table.csv')
+    write_ip_table(table_path, 'network,asn,country\n1.2.3.0/24,64500,NL\n'
+                               '10.0.0.0\t10.0.255.255\t64501\tBE\n')
+    logs = []
+    for index, ip in enumerate([b'1.2.3.4', b'10.0.7.1', b'10.0.8.2', b'192.0.2.1']):
+        logs.append(str(tmp_path / f'{index}.log'))
+        write_log(logs[-1], [log_line(ip, b'24/Jul/2019:06:51:05 +0000')])
+    asn, country = log_analysis.analyze_access_logs(logs, [(('asn',), ()), (('country',), ())],
+                                                    jobs=jobs, ip_table=table_path)
+    assert asn.counts == {'AS64500': 1, 'AS64501': 2, '-': 1}
+    assert country.counts == {'NL': 1, 'BE': 2, '-': 1}
+    report, = log_analysis.analyze_access_logs(logs, [(('asn',), ())], jobs=jobs)
+    assert report.counts == {'-': 4}
+
+
+def test_ip_table_changes_are_seen(tmp_path):
+    table_path = str(tmp_path / 'table.csv')
+    log_path = str(tmp_path / 'a.log')
+    write_log(log_path, [log_line(b'1.2.3.4', b'24/Jul/2019:06:51:05 +0000')])
+    write_ip_table(table_path, '1.2.3.0/24,64500,NL\n')
+    report, = log_analysis.analyze_access_logs([log_path], [(('asn', 'country'), ())], jobs=1,
+                                               ip_table=table_path)
+    assert report.counts == {('AS64500', 'NL'): 1}
+    write_ip_table(table_path, '1.2.0.0/16,64501,BE\n')
+    report, = log_analysis.analyze_access_logs([log_path], [(('asn', 'country'), ())], jobs=1,
+                                               ip_table=table_path)
+    assert report.counts == {('AS64501', 'BE'): 1}
+    write_ip_table(table_path, '# no ranges\n')
+    with pytest.raises(ValueError):
+        log_dimensions.load_ip_table(log_dimensions.ip_table_identity(table_path))
+
+
+# user-022: path trees
+
+def route_report(paths):
+    """Returns a decoded report of the requests of paths, grouped by route."""
+    report = log_reports.make_report((('route',), ()))
+    for path in paths:
+        report.add(log_formats.parse_log_line(log_line(b'1.1.1.1', b'24/Jul/2019:06:51:05 +0000',
+                                                       path)))
+    return report.decode()
+
+
+def test_path_trie_totals():
+    tree = log_reports.PathTrie()
+    for path, count in (('/a/b', 2), ('/a/c', 1), ('/a', 1), ('/d//e/', 4)):
+        tree.add(path, count)
+    assert (tree.total, tree.find('/a').total, tree.find('/a').count) == (8, 4, 1)
+    assert tree.find('/d/e').count == 4
+    assert tree.find('/x') is None
+    assert list(tree.rollup('/', 1, top=1)) == [(0, '/', 8), (1, '/a', 4)]
+
+
+def test_path_tree_rows():
+    report = route_report(['/a/b', '/a/b', '/a/c', '/d', '/a/b/c'])
+    assert task1_3.path_tree_rows(report, '/', 2) == [
+        (0, '/', 5), (1, '/a', 4), (2, '/a/b', 3), (2, '/a/c', 1), (1, '/d', 1)]
+    assert task1_3.path_tree_rows(report, '/a', 1, top=1) == [(0, '/a', 4), (1, '/a/b', 3)]
+    assert task1_3.path_tree_rows(report, '/missing', 1) == [(0, '/missing', 0)]
+
+
+@pytest.mark.parametrize('output_format', ['text', 'csv', 'json', 'ndjson'])
+def test_path_tree_output(output_format):
+    report = route_report(['/a/b', '/a/c', '/d'])
+    out = io.StringIO()
+    task1_3.write_reports(out, [report], output_format, path_tree=(report, '/', 1, 0))
+    text = out.getvalue()
+    expected = [(0, '/', 3), (1, '/a', 2), (1, '/d', 1)]
+    if output_format == 'text':
+        assert text.split('\n\n')[-1] == ("Number of requests under each Route prefix:\n"
+                                          "/: 3\n  /a: 2\n  /d: 1\n")
+    elif output_format == 'csv':
+        rows = list(csv.reader(io.StringIO(text.split('\n\n')[-1])))
+        assert rows == [['level', 'prefix', 'requests']] + [
+            [str(value) for value in row] for row in expected]
+    elif output_format == 'json':
+        tree = json.loads(text)[-1]
+        assert tree['path_tree'] == ['route']
+        assert [tuple(row.values()) for row in tree['rows']] == expected
+    else:
+        records = [json.loads(line) for line in text.splitlines()]
+        assert [(record['level'], record['prefix'], record['requests'])
+                for record in records if record['report'] == 'path_tree'] == expected
+
+
+# user-023: request rate spikes
+
+def timed_lines(start, seconds, ips_per_second):
+    """Yields (timestamp, line) pairs with the given client IPs every second."""
+    for offset in range(seconds):
+        timestamp = start + offset
+        date = time.strftime('%d/%b/%Y:%H:%M:%S +0000', time.gmtime(timestamp)).encode()
+        for ip in ips_per_second(offset):
+            yield timestamp, log_line(ip, date)
+
+
+def steady_ips(offset):
+    """Returns ten background clients, each requesting every 10 seconds."""
+    return [b'10.0.0.%d' % (offset % 10)]
+
+
+def test_detector_flags_a_spike_once():
+    detector = log_follow.RateAnomalyDetector(('ip',))
+    start = 1563951065
+    alerts = []
+
+    def spiking_ips(offset):
+        if 3600 <= offset < 3720:
+            return steady_ips(offset) + [b'192.0.2.1'] * 5
+        # The spiking client also requests once a minute before and after
+        return steady_ips(offset) + ([b'192.0.2.1'] if offset % 60 == 0 else [])
+
+    for timestamp, line in timed_lines(start, 7200, spiking_ips):
+        detector.add(log_formats.parse_log_line(line), timestamp)
+        alerts.extend(detector.alerts)
+        detector.alerts.clear()
+    assert [(dimension, key) for _, dimension, key, _, _ in alerts] == [('ip', b'192.0.2.1')]
+    timestamp, _, _, rate, baseline = alerts[0]
+    assert start + 3600 <= timestamp < start + 3660
+    assert rate >= 10 * baseline and rate >= log_follow.ANOMALY_MIN_RATE
+    assert log_follow.format_alert(alerts[0]).startswith('[2019-07-24 07:51:')
+
+
+def test_detector_ignores_keys_busy_from_the_start():
+    detector = log_follow.RateAnomalyDetector(('ip',))
+    for timestamp, line in timed_lines(1563951065, 1800, lambda offset: [b'192.0.2.1'] * 3):
+        detector.add(log_formats.parse_log_line(line), timestamp)
+    assert detector.alerts == []
+
+
+def test_detector_evicts_the_least_active_keys():
+    detector = log_follow.RateAnomalyDetector(('ip',), max_keys=5)
+    for timestamp, line in timed_lines(1563951065, 100, lambda offset: [b'10.0.1.%d' % offset]):
+        detector.add(log_formats.parse_log_line(line), timestamp)
+    assert detector.tracked()['ip'] <= 10
+    assert detector.evicted >= 90 - 5
+
+
+def test_rotated_logs_are_replayed_oldest_first(tmp_path):
+    start = 1563951065
+    spike = range(3600, 3720)
+    lines = [line for _, line in timed_lines(start, 7200, lambda offset: steady_ips(offset) + (
+        [b'192.0.2.1'] * 5 if offset in spike else []))]
+    # access.log.1 holds the first hour, which must be replayed first
+    write_log(tmp_path / 'access.log.1', lines[:3600])
+    write_log(tmp_path / 'access.log', lines[3600:])
+    file_paths = log_files.expand_log_paths([str(tmp_path / 'access.log*')])
+    assert file_paths == [str(tmp_path / 'access.log'), str(tmp_path / 'access.log.1')]
+    detector = log_follow.RateAnomalyDetector(('ip',))
+    alerts = list(log_follow.detect_log_anomalies(file_paths, detector))
+    assert [key for _, _, key, _, _ in alerts] == [b'192.0.2.1']
+    assert alerts[0][0] >= start + 3600
+
+
+# user-024: SQLite log store
+
+def expected_statuses(report):
+    """Returns the (status, count) pairs of a report grouped by status and method."""
+    statuses = Counter()
+    for (status, _), count in report.counts.items():
+        statuses[status] += count
+    return statuses.items()
+
+
+def test_ingest_and_query_match_analysis(tmp_path):
+    database_path = str(tmp_path / 'logs.db')
+    valid = sum(log_formats.parse_log_line(line) is not None for line in sample_lines())
+    write_log(tmp_path / 'a.log', sample_lines())
+    assert log_store.ingest_access_logs([str(tmp_path / 'a.log')], database_path) == valid
+    expected, = log_analysis.analyze_access_logs([str(tmp_path / 'a.log')],
+                                                 [(('status', 'method'), ('bytes',))], jobs=1)
+    report = log_store.query_log_store(database_path, ('status', 'method'), ('bytes',))
+    assert report.counts == expected.counts
+    assert report.sizes == expected.sizes
+    errors = log_store.query_log_store(database_path, ('status',), where='status >= 400')
+    assert errors.counts == {status: count for status, count in expected_statuses(expected)
+                             if int(status) >= 400}
+    with pytest.raises(ValueError):
+        log_store.query_log_store(database_path, ('browser',))
+
+
+def test_ingest_only_loads_appended_lines(tmp_path):
+    database_path = str(tmp_path / 'logs.db')
+    lines = sorted_log_lines(100)
+    write_log(tmp_path / 'a.log', lines[:60])
+    assert log_store.ingest_access_logs([str(tmp_path / 'a.log')], database_path) == 60
+    assert log_store.ingest_access_logs([str(tmp_path / 'a.log')], database_path) == 0
+    with open(tmp_path / 'a.log', 'ab') as file:
+        file.writelines(line + b'\n' for line in lines[60:])
+    assert log_store.ingest_access_logs([str(tmp_path / 'a.log')], database_path) == 40
+    report = log_store.query_log_store(database_path, ('day',),
+                                       time_range=(1563951065, 1563951065 + 7 * 50))
+    assert report.counts == {'2019-07-24': 50}
+    connection = sqlite3.connect(database_path)
+    try:
+        value, = connection.execute(
+            "SELECT value FROM metadata WHERE name = 'logs'").fetchone()
+    finally:
+        connection.close()
+    state, = json.loads(value)
+    assert state['offset'] == os.path.getsize(tmp_path / 'a.log')
+
+
+def test_ingest_stores_out_of_range_sizes_as_missing(tmp_path):
+    database_path = str(tmp_path / 'logs.db')
+    write_log(tmp_path / 'a.log', [
+        log_line(b'1.1.1.1', b'24/Jul/2019:06:51:05 +0000', size=b'9' * 30),
+        log_line(b'1.1.1.1', b'24/Jul/2019:06:51:05 +0000', size=b'-'),
+        log_line(b'1.1.1.1', b'24/Jul/2019:06:51:05 +0000', size=b'7')])
+    assert log_store.ingest_access_logs([str(tmp_path / 'a.log')], database_path) == 3
+    columns, rows = log_store.execute_store_query(database_path,
+                                                  'SELECT size FROM requests ORDER BY rowid')
+    assert columns == ['size']
+    assert rows == [(None,), (None,), (7,)]
+
+
+def test_damaged_store_states_are_rejected(tmp_path):
+    database_path = str(tmp_path / 'logs.db')
+    write_log(tmp_path / 'a.log', LINES)
+    log_store.ingest_access_logs([str(tmp_path / 'a.log')], database_path)
+    connection = sqlite3.connect(database_path)
+    with connection:
+        connection.execute("UPDATE metadata SET value = ? WHERE name = 'logs'",
+                           (pickle.dumps([]),))
+    connection.close()
+    with pytest.raises(ValueError):
+        log_store.ingest_access_logs([str(tmp_path / 'a.log')], database_path)
+
+
+# user-025: column files
+
+def test_column_files_analyze_like_their_logs(tmp_path):
+    column_path = str(tmp_path / 'access.columns')
+    specs = [(('user_agent',), ()), (('status', 'method'), ('bytes',)), (('browser',), ())]
+    whole = log_analysis.analyze_access_logs([LOG_PATH], specs, jobs=1)
+    rows = log_analysis.export_log_columns([LOG_PATH], column_path, row_group_size=500)
+    assert rows == sum(whole[0].counts.values())
+    assert log_columns.is_column_file(column_path)
+    assert len(log_columns.column_file_groups(column_path)) == -(-rows // 500)
+    exported = log_analysis.analyze_access_logs([column_path], specs, jobs=2, chunk_size=4096)
+    for report, expected in zip(exported, whole):
+        assert report.counts == expected.counts
+        assert report.sizes == expected.sizes
+
+
+def test_column_files_skip_row_groups_outside_time_ranges(tmp_path):
+    log_path, column_path = str(tmp_path / 'a.log'), str(tmp_path / 'a.columns')
+    write_log(log_path, sorted_log_lines())
+    log_analysis.export_log_columns([log_path], column_path, row_group_size=100)
+    time_range = (1563951065 + 7 * 250, 1563951065 + 7 * 730)
+    tasks = log_columns.plan_column_tasks(column_path, chunk_size=1, time_range=time_range)
+    assert len(tasks) == 6
+    specs = [(('path',), ())]
+    expected, = log_analysis.analyze_access_logs([log_path], specs, jobs=1,
+                                                 time_range=time_range)
+    report, = log_analysis.analyze_access_logs([column_path], specs, jobs=1,
+                                               time_range=time_range)
+    assert report.counts == expected.counts
+    assert sum(report.counts.values()) == 480
+
+
+def test_damaged_row_groups_are_rejected(tmp_path):
+    column_path = str(tmp_path / 'access.columns')
+    log_analysis.export_log_columns([LOG_PATH], column_path, row_group_size=500)
+    with open(column_path, 'rb') as file:
+        data = bytearray(file.read())
+    offset = len(log_columns.COLUMN_FILE_MAGIC) + 1
+    header = list(log_columns.ROW_GROUP_HEADER.unpack_from(data, offset))
+    header[-1] += 1
+    log_columns.ROW_GROUP_HEADER.pack_into(data, offset, *header)
+    with open(column_path, 'wb') as file:
+        file.write(data)
+    with pytest.raises(ValueError, match='Damaged row group'):
+        log_columns.column_file_groups(column_path)
+    with pytest.raises(SystemExit):
+        log_analysis.analyze_access_logs([column_path], jobs=1)
+    with open(column_path, 'wb') as file:
+        file.write(data[:offset + log_columns.ROW_GROUP_HEADER.size + 3])
+    with pytest.raises(EOFError):
+        log_columns.column_file_groups(column_path)